@@ -7,12 +7,14 @@ porting over to a future version.
 """
 
 # Python Imports
+import fcntl
 import hashlib
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
+import time
 import unittest
 
 # Library Imports
@@ -23,7 +25,10 @@ cur_dir, _ = os.path.split(__file__)
 root_dir = os.path.abspath(os.path.join(cur_dir, '..', '..'))
 
 # Project imports
+from xpkg import build
 from xpkg import core
+from xpkg import executor
+from xpkg import farm
 from xpkg import linux
 from xpkg import util
 from tests import build_tree
@@ -153,8 +158,13 @@ class TestBase(unittest.TestCase):
         # Run the command directly calling the python xpkg implementation
         cmd = [sys.executable, '-m', 'xpkg.main'] + args + env_args
 
+        # Run from our work directory so build logs don't pollute anything
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+
         try:
-            output = util.shellcmd(cmd, shell=False, stream=False)
+            with util.cd(self.work_dir):
+                output = util.shellcmd(cmd, shell=False, stream=False,
+                                       env=env)
 
             # If we got here but we should of failed error out
             if should_fail:
@@ -775,6 +785,16 @@ class FullTests(TestBase):
         self.assertIn(['libmulti-dev', '1.0.0'], install_info)
         self.assertEqual(4, len(install_info))
 
+        # The build time is split across the packages, not given to each
+        db_dir = core.InstallDatabase.db_dir(self.env_dir)
+        times = yaml.load(open(os.path.join(db_dir, 'build-times.yml')))
+
+        seconds = [times['multi-tools']['1.5.0']['local'],
+                   times['libmulti']['1.0.0']['local'],
+                   times['libmulti-dev']['1.0.0']['local']]
+
+        self.assertEqual(1, len(set(seconds)))
+
 
     def test_multi_tree(self):
         """
@@ -825,6 +845,512 @@ class FullTests(TestBase):
         self.assertEqual('I\'m patched!\n', output)
 
 
+    def test_compiler_cache(self):
+        """
+        Make sure the compiler cache wraps our compilers and reports its
+        statistics in the build log.
+        """
+
+        # Create a fake ccache, which logs a hit for every compile
+        bin_dir = os.path.join(self.work_dir, 'bin')
+        util.ensure_dir(bin_dir)
+
+        ccache_path = os.path.join(bin_dir, 'ccache')
+
+        with open(ccache_path, 'w') as f:
+            f.write('#! /bin/sh\n'
+                    'if [ -n "$CCACHE_STATSLOG" ]; then\n'
+                    '    echo "# $PWD" >> "$CCACHE_STATSLOG"\n'
+                    '    echo direct_cache_hit >> "$CCACHE_STATSLOG"\n'
+                    'fi\n'
+                    'exec "$@"\n')
+        os.chmod(ccache_path, 0755)
+
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['XPKG_COMPILER_CACHE'] = os.path.join(self.work_dir, 'cc')
+
+        # Create our environment with the cache turned on
+        self._xpkg_cmd(['init', self.env_dir, 'test', '--compiler-cache'])
+
+        # Make sure the compilers are wrapped
+        output = self._xpkg_cmd(['jump', '-c', 'printenv CC'])
+        self.assertEqual('ccache cc\n', output)
+
+        # Build something which compiles twice, and make sure we got our
+        # stats
+        xpd_path = os.path.join(self.work_dir, 'cached.xpd')
+
+        util.yaml_dump({
+            'name' : 'cached',
+            'version' : '1.0.0',
+            'description' : 'Compiles things',
+            'files' : {},
+            'build' : [
+                'echo "int main() { return 0; }" > main.c',
+                '$CC -c main.c -o one.o',
+                '$CC -c main.c -o two.o',
+            ],
+            'install' : [
+                'mkdir -p %(prefix)s/share',
+                'cp one.o %(prefix)s/share',
+            ],
+        }, open(xpd_path, 'w'))
+
+        self._xpkg_cmd(['install', xpd_path])
+
+        log_dir = core.Environment.log_dir(self.env_dir)
+        log_path = os.path.join(log_dir, 'cached-1.0.0_build.log')
+
+        self.assertIn('[ccache] hits: 2 misses: 0', open(log_path).read())
+
+
+    def test_build_resume(self):
+        """
+        Make sure a failed build can be resumed without redoing the finished
+        phases.
+        """
+
+        # Create a package that fails to install until we say so, and that
+        # records every time it's been built
+        phase_log = os.path.join(self.work_dir, 'phases')
+        allow_path = os.path.join(self.work_dir, 'allow-install')
+
+        data = util.load_xpd(self.hello_xpd)
+        data['name'] = 'resumeme'
+        data['build'] = ['make', 'echo built >> %s' % phase_log]
+        data['install'] = ['test -f %s' % allow_path, 'make install']
+
+        xpd_path = os.path.join(self.work_dir, 'resumeme.xpd')
+
+        with open(xpd_path, 'w') as f:
+            util.yaml_dump(data, f)
+
+        # The first build fails
+        self._xpkg_cmd(['build', xpd_path, '--dest', self.repo_dir,
+                        '--resume'], should_fail=True)
+
+        self.assertEqual([], os.listdir(self.repo_dir))
+
+        # Now let the install happen and finish the build
+        util.touch(allow_path)
+
+        self._xpkg_cmd(['build', xpd_path, '--dest', self.repo_dir,
+                        '--resume'])
+
+        self.assertEqual(1, len(os.listdir(self.repo_dir)))
+
+        # We should have only built once
+        self.assertEqual('built\n', open(phase_log).read())
+
+        # Changing how the package is made starts the build over
+        os.remove(allow_path)
+        os.remove(phase_log)
+
+        self._xpkg_cmd(['init', self.env_dir, 'test'])
+
+        build_args = ['build', xpd_path, '--dest', self.repo_dir, '--resume',
+                      '--use-env']
+
+        self._xpkg_cmd(build_args, should_fail=True)
+
+        util.touch(allow_path)
+        self._xpkg_cmd(build_args + ['-c', 'bz2'])
+
+        self.assertEqual('built\nbuilt\n', open(phase_log).read())
+
+
+    def test_autoconf_cache(self):
+        """
+        Make sure configure scripts get pointed at the shared cache.
+        """
+
+        self._xpkg_cmd(['init', self.env_dir, 'test', '--autoconf-cache'])
+
+        # Package which just saves the site file it's given
+        data = {
+            'name' : 'siteprobe',
+            'version' : '1.0.0',
+            'files' : {},
+            'build' : 'true',
+            'install' : ['mkdir -p %(prefix)s/share',
+                         'cp $CONFIG_SITE %(prefix)s/share/config.site'],
+        }
+
+        xpd_path = os.path.join(self.work_dir, 'siteprobe.xpd')
+
+        with open(xpd_path, 'w') as f:
+            util.yaml_dump(data, f)
+
+        self._xpkg_cmd(['install', xpd_path])
+
+        # Make sure we got a site file that points into our environment
+        site_path = os.path.join(self.env_dir, 'share', 'config.site')
+        contents = open(site_path).read()
+
+        cache_dir = core.Environment.autoconf_cache_dir(self.env_dir)
+        self.assertRegexpMatches(contents, 'cache_file=%s/.*' % cache_dir)
+
+        # Old caches are only removed once no build holds them open
+        env = core.Environment(self.env_dir)
+        site_path, cache_lock = env.autoconf_config_site()
+
+        old_dir = os.path.join(cache_dir, 'old')
+        os.mkdir(old_dir)
+        old_lock = open(old_dir + '.lock', 'w')
+        fcntl.flock(old_lock, fcntl.LOCK_SH)
+
+        env.autoconf_config_site()[1].close()
+        self.assertTrue(os.path.exists(old_dir))
+
+        old_lock.close()
+
+        env.autoconf_config_site()[1].close()
+        self.assertFalse(os.path.exists(old_dir))
+
+        # Our own cache is untouched
+        self.assertEqual(contents, open(site_path).read())
+        cache_lock.close()
+
+
+    def test_build_times(self):
+        """
+        Make sure we record how long builds take, and use them for our
+        estimates.
+        """
+
+        os.environ[core.xpkg_tree_var] = self.tree_dir
+
+        self._xpkg_cmd(['install', 'greeter'])
+
+        # Make sure we have all the packages we built
+        db_dir = core.InstallDatabase.db_dir(self.env_dir)
+        times = yaml.load(open(os.path.join(db_dir, 'build-times.yml')))
+
+        self.assertEqual(['faketools', 'greeter', 'libgreet'], sorted(times))
+        self.assertIn('local', times['greeter']['2.0.0'])
+
+        # Now our estimates should be based on that
+        env = core.Environment(self.env_dir)
+        env.remove('greeter')
+
+        plan = env._plan_install('greeter')
+
+        self.assertEqual(['greeter'], [s['name'] for s in plan])
+
+        expected = times['greeter']['2.0.0']['local']
+        self.assertEqual(expected, plan[0]['estimate'])
+
+        # Only steps that will build count towards the ETA
+        steps = [
+            {'name' : 'libgreet', 'build' : True, 'estimate' : 600},
+            {'name' : 'prebuilt', 'build' : False, 'estimate' : 0},
+            {'name' : 'greeter', 'build' : True, 'estimate' : 90},
+            {'name' : 'newthing', 'build' : True, 'estimate' : None},
+        ]
+
+        self.assertEqual('1m30s + 1 unknown build(s)', env._format_eta(steps))
+
+        # Installs recording at the same time don't lose each others times
+        first = core.BuildTimes(self.env_dir)
+        second = core.BuildTimes(self.env_dir)
+
+        first.record('first', '1.0', 'local', 1.0)
+        second.record('second', '1.0', 'local', 2.0)
+
+        times = core.BuildTimes(self.env_dir)
+        self.assertEqual(1.0, times.lookup('first', '1.0', 'local'))
+        self.assertEqual(2.0, times.lookup('second', '1.0', 'local'))
+
+
+    def test_shared_builds(self):
+        """
+        Make sure a second environment uses the package built for the first
+        instead of building it again.
+        """
+
+        os.environ[core.xpkg_tree_var] = self.tree_dir
+
+        self._xpkg_cmd(['install', 'greeter'])
+
+        # Install into another environment
+        other_env_dir = os.path.join(self.work_dir, 'other-env')
+
+        output = self._xpkg_cmd(['install', 'greeter'], env_dir=other_env_dir)
+
+        self.assertIn('Using shared build:', output)
+        self.assertNotIn('Binary working in:', output)
+
+        # Make sure it still works
+        output = self._xpkg_cmd(['jump', '-c', 'greeter'],
+                                env_dir=other_env_dir)
+        self.assertEqual('Welcome to a better world!\n', output)
+
+        # Packages made with other settings aren't shared with these ones
+        xpd_path = os.path.join(self.tree_dir, 'greeter2.xpd')
+        dest_dir = os.path.join(self.work_dir, 'dest')
+        util.ensure_dir(dest_dir)
+
+        build_args = ['build', '-e', xpd_path, '--dest', dest_dir,
+                      '-c', 'bz2', '--reproducible']
+
+        output = self._xpkg_cmd(build_args)
+        self.assertNotIn('Using shared build:', output)
+
+        output = self._xpkg_cmd(build_args, env_dir=other_env_dir)
+        self.assertIn('Using shared build:', output)
+
+
+    def test_build_farm(self):
+        """
+        Make sure we can have a worker process build our packages.
+        """
+
+        os.environ[core.xpkg_tree_var] = self.tree_dir
+
+        spool_dir = os.path.join(self.work_dir, 'spool')
+        farm_repo_dir = os.path.join(self.work_dir, 'farm-repo')
+
+        # Start up our worker
+        cmd = [sys.executable, '-m', 'xpkg.main', 'worker', spool_dir,
+               farm_repo_dir, '--tree', self.tree_dir, '--poll', '0.1']
+
+        with open(os.path.join(self.work_dir, 'worker.log'), 'w') as log:
+            worker = subprocess.Popen(cmd, stdout=log, stderr=log)
+
+        try:
+            self._xpkg_cmd(['install', 'greeter', '--farm', spool_dir])
+        finally:
+            worker.terminate()
+            worker.wait()
+
+        # Make sure it installed
+        output = self._xpkg_cmd(['jump', '-c', 'greeter'])
+        self.assertEqual('Welcome to a better world!\n', output)
+
+        # Make sure it was built by the worker, and the results published
+        done_dir = os.path.join(spool_dir, 'done')
+        self.assertEqual(3, len(os.listdir(done_dir)))
+
+        xpas = [f for f in os.listdir(farm_repo_dir) if f.endswith('.xpa')]
+        self.assertEqual(['faketools', 'greeter', 'libgreet'],
+                         sorted(f.split('_')[0] for f in xpas))
+
+        logs_dir = os.path.join(farm_repo_dir, 'logs')
+        self.assertEqual(3, len(os.listdir(logs_dir)))
+
+        self.assertEqual([], os.listdir(os.path.join(spool_dir, 'new')))
+        self.assertEqual([], os.listdir(os.path.join(spool_dir, 'failed')))
+
+
+    def test_build_farm_parallel(self):
+        """
+        Make sure every package whose dependencies are ready is sent to the
+        farm at once, instead of one at a time.
+        """
+
+        tree_dir = os.path.join(self.work_dir, 'tree')
+        util.ensure_dir(tree_dir)
+
+        packages = [
+            {'name' : 'left'},
+            {'name' : 'right'},
+            {'name' : 'top', 'dependencies' : ['left', 'right']},
+        ]
+
+        for data in packages:
+            data.update({
+                'version' : '1.0.0',
+                'files' : {},
+                'build' : 'true',
+                'install' : 'true',
+            })
+
+            with open(os.path.join(tree_dir, data['name'] + '.xpd'), 'w') as f:
+                util.yaml_dump(data, f)
+
+        os.environ[core.xpkg_tree_var] = tree_dir
+
+        # With no workers we give up waiting, with both dependencies queued
+        spool_dir = os.path.join(self.work_dir, 'spool')
+        os.environ[farm.WAIT_TIMEOUT_VAR] = '0.5'
+
+        try:
+            self._xpkg_cmd(['install', 'top', '--farm', spool_dir],
+                           should_fail=True)
+        finally:
+            del os.environ[farm.WAIT_TIMEOUT_VAR]
+
+        queued = os.listdir(os.path.join(spool_dir, 'new'))
+        self.assertEqual(['left', 'right'],
+                         sorted(f.split('-')[3] for f in queued))
+
+
+    def test_build_executor(self):
+        """
+        Make sure we can build packages through the local build executor.
+        """
+
+        os.environ[core.xpkg_tree_var] = self.tree_dir
+
+        executor_dir = os.path.join(self.work_dir, 'executor')
+        util.ensure_dir(executor_dir)
+
+        cmd = '%s -m xpkg.main executor --work-dir %s' % (sys.executable,
+                                                          executor_dir)
+
+        self._xpkg_cmd(['install', 'greeter', '--executor', cmd])
+
+        # Make sure it works
+        output = self._xpkg_cmd(['jump', '-c', 'greeter'])
+        self.assertEqual('Welcome to a better world!\n', output)
+
+        # Make sure we got back the logs, and the executor cleaned up
+        log_dir = core.Environment.log_dir(self.env_dir)
+        self.assertPathExists(os.path.join(log_dir, 'greeter-2.0.0_build.log'))
+
+        self.assertEqual([], os.listdir(executor_dir))
+
+        # A failed build still shuts the executor down before we exit
+        data = {
+            'name' : 'broken',
+            'version' : '1.0.0',
+            'files' : {},
+            'build' : 'false',
+            'install' : 'true',
+        }
+
+        xpd_path = os.path.join(self.work_dir, 'broken.xpd')
+
+        with open(xpd_path, 'w') as f:
+            util.yaml_dump(data, f)
+
+        self._xpkg_cmd(['install', xpd_path, '--executor', cmd],
+                       should_fail=True)
+
+        self.assertEqual([], os.listdir(executor_dir))
+
+
+    def test_build_executor_broken_stream(self):
+        """
+        Make sure an executor which stops part way through a frame is thrown
+        away, instead of the next build reading the rest of it.
+        """
+
+        # An executor which sends a broken frame, then hangs
+        script_path = os.path.join(self.work_dir, 'bad_frame.py')
+
+        with open(script_path, 'w') as f:
+            f.write('import sys, time\n'
+                    'sys.stdout.write("\\x00\\x00\\x00\\x01\\x00\\x00'
+                    '\\x00\\x00{")\n'
+                    'sys.stdout.flush()\n'
+                    'time.sleep(60)\n')
+
+        client = executor.ExecutorClient('%s %s' % (sys.executable,
+                                                    script_path))
+
+        xpd = core.XPD(os.path.join(self.work_dir, 'broken.xpd'), data={
+            'name' : 'broken',
+            'version' : '1.0.0',
+            'files' : {},
+        })
+        toolset = build.Toolset('test', {})
+
+        for i in xrange(2):
+            start = time.time()
+
+            with self.assertRaises(ValueError):
+                client.build(xpd, toolset, [], self.work_dir)
+
+            self.assertLess(time.time() - start, 30)
+            self.assertIsNone(client._proc)
+
+
+    def test_keep_going(self):
+        """
+        Make sure a failed package only stops the packages which need it.
+        """
+
+        # Create a tree with a broken package, and one that depends on it
+        tree_dir = os.path.join(self.work_dir, 'tree')
+        shutil.copytree(self.tree_dir, tree_dir)
+
+        broken = {
+            'name' : 'broken',
+            'version' : '1.0.0',
+            'files' : {},
+            'build' : 'false',
+            'install' : 'true',
+        }
+
+        needs_broken = dict(broken)
+        needs_broken.update({
+            'name' : 'needs-broken',
+            'dependencies' : ['broken'],
+            'build' : 'true',
+        })
+
+        for data in [broken, needs_broken]:
+            with open(os.path.join(tree_dir, data['name'] + '.xpd'), 'w') as f:
+                util.yaml_dump(data, f)
+
+        os.environ[core.xpkg_tree_var] = tree_dir
+
+        # Install with the broken package in the middle
+        output = self._xpkg_cmd(['install', '--keep-going', 'needs-broken',
+                                 'hello'], should_fail=True)
+
+        self.assertRegexpMatches(output, '- broken: .*')
+        self.assertIn('- needs-broken (needs: broken)', output)
+
+        # Everything else should be there
+        output = self._xpkg_cmd(['list'])
+
+        self.assertEqual('  hello - 1.0.0\n', output)
+
+
+    def test_keep_going_shared_dep(self):
+        """
+        Make sure a failed package is only tried once, even when several of
+        the requested packages need it.
+        """
+
+        tree_dir = os.path.join(self.work_dir, 'tree')
+        shutil.copytree(self.tree_dir, tree_dir)
+
+        broken = {
+            'name' : 'broken',
+            'version' : '1.0.0',
+            'files' : {},
+            'build' : 'false',
+            'install' : 'true',
+        }
+
+        packages = [broken]
+
+        for name in ['needs-broken', 'also-needs-broken']:
+            data = dict(broken)
+            data.update({
+                'name' : name,
+                'dependencies' : ['broken'],
+                'build' : 'true',
+            })
+            packages.append(data)
+
+        for data in packages:
+            with open(os.path.join(tree_dir, data['name'] + '.xpd'), 'w') as f:
+                util.yaml_dump(data, f)
+
+        os.environ[core.xpkg_tree_var] = tree_dir
+
+        output = self._xpkg_cmd(['install', '--keep-going', 'needs-broken',
+                                 'also-needs-broken'], should_fail=True)
+
+        self.assertEqual(1, output.count('FAILED: broken:'))
+        self.assertIn('- needs-broken (needs: broken)', output)
+        self.assertIn('- also-needs-broken (needs: broken)', output)
+
+
 class LinuxTests(TestBase):
 
     def test_local_elf_interp(self):
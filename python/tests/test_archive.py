@@ -0,0 +1,183 @@
+# Author: Joseph Lisee <jlisee@gmail.com>
+
+__doc__ = """Tests for the archive module
+"""
+
+# Python Imports
+import os
+import shutil
+import tempfile
+import unittest
+
+# Project Imports
+from xpkg import archive
+from xpkg import compression
+from xpkg import util
+
+
+class ArchiveTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(suffix = '-testing-xpkg')
+
+        # Some files to archive, one big enough for several blocks
+        self.files = {
+            'bin/tool' : '#!/bin/sh\necho hi\n',
+            'share/empty' : '',
+            'share/numbers' : ''.join('%d\n' % i for i in xrange(20000)),
+        }
+
+        self.src_dir = os.path.join(self.work_dir, 'src')
+
+        for name, data in self.files.iteritems():
+            path = os.path.join(self.src_dir, name)
+            util.ensure_dir(os.path.dirname(path))
+
+            with open(path, 'wb') as f:
+                f.write(data)
+
+        os.chmod(os.path.join(self.src_dir, 'bin', 'tool'), 0755)
+        os.symlink('../share/numbers',
+                   os.path.join(self.src_dir, 'bin', 'numbers'))
+
+        self.names = sorted(self.files.keys() + ['bin/numbers'])
+
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+    def _write(self, threads=None, codec='gzip'):
+        file_name = 'test-%s-%s.xpa' % (codec, threads)
+        path = os.path.join(self.work_dir, file_name)
+
+        writer = archive.ArchiveWriter(path, compression.lookup(codec),
+                                       threads=threads, block_size=10000)
+
+        for name in self.names:
+            writer.add_file(os.path.join(self.src_dir, name), name)
+
+        writer.add_data('xpkg.yml', 'name: test\n')
+
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(path, writer.commit())
+
+        return path
+
+
+    def test_round_trip(self):
+        """
+        Make sure we read back what we wrote, with any number of threads.
+        """
+
+        for threads in [1, 4]:
+            path = self._write(threads)
+            self.assertTrue(archive.is_archive(path))
+
+            reader = archive.ArchiveReader(path)
+
+            self.assertEqual('name: test\n', reader.metadata('xpkg.yml'))
+            self.assertEqual(self.names, [e.name for e in reader.entries])
+
+            for name, data in self.files.iteritems():
+                self.assertEqual(data, reader.read(name))
+
+            self.assertEqual('../share/numbers', reader.read('bin/numbers'))
+
+            # Extract everything and check it all matches
+            dest_dir = os.path.join(self.work_dir, 'dest-%d' % threads)
+            reader.extract_all(dest_dir, threads=threads)
+
+            for name, data in self.files.iteritems():
+                self.assertEqual(data,
+                                 open(os.path.join(dest_dir, name)).read())
+
+            tool_path = os.path.join(dest_dir, 'bin', 'tool')
+            self.assertEqual(0755, os.stat(tool_path).st_mode & 0777)
+
+            link_path = os.path.join(dest_dir, 'bin', 'numbers')
+            self.assertEqual('../share/numbers', os.readlink(link_path))
+
+
+    def test_compressed_files(self):
+        """
+        Make sure files that are already compressed are stored as they are,
+        unless we ask for a codec.
+        """
+
+        gzip = compression.lookup('gzip')
+        data = gzip.compress(self.files['share/numbers'])
+
+        src_path = os.path.join(self.src_dir, 'share', 'numbers.gz')
+
+        with open(src_path, 'wb') as f:
+            f.write(data)
+
+        path = os.path.join(self.work_dir, 'test.xpa')
+        writer = archive.ArchiveWriter(path, compression.lookup('bz2'))
+
+        writer.add_file(src_path, 'numbers.gz')
+        writer.add_file(src_path, 'forced.gz', codec=gzip)
+        writer.add_file(os.path.join(self.src_dir, 'bin', 'tool'), 'tool')
+        writer.commit()
+
+        reader = archive.ArchiveReader(path)
+
+        self.assertEqual(['store', 'gzip', 'bz2'],
+                         [e.codec for e in reader.entries])
+        self.assertEqual(len(data), reader.entry('numbers.gz').stored_size)
+
+        for name in ['numbers.gz', 'forced.gz']:
+            self.assertEqual(data, reader.read(name))
+
+
+    def test_concurrent_writers(self):
+        """
+        Make sure two writers of the same archive don't get in each others
+        way.
+        """
+
+        path = os.path.join(self.work_dir, 'test.xpa')
+        writers = [archive.ArchiveWriter(path, compression.lookup('gzip'))
+                   for i in xrange(2)]
+
+        for i, writer in enumerate(writers):
+            writer.add_data('xpkg.yml', 'name: test%d\n' % i)
+
+        for writer in writers:
+            writer.commit()
+
+        reader = archive.ArchiveReader(path)
+        self.assertEqual('name: test1\n', reader.metadata('xpkg.yml'))
+
+        self.assertEqual(0644, os.stat(path).st_mode & 0777)
+        self.assertEqual(['src', 'test.xpa'], sorted(os.listdir(self.work_dir)))
+
+
+    def test_corrupt(self):
+        """
+        Make sure damaged contents are caught.
+        """
+
+        path = self._write(codec='bz2')
+
+        reader = archive.ArchiveReader(path)
+        entry = reader.entry('share/numbers')
+
+        with open(path, 'r+b') as f:
+            f.seek(entry.offset + entry.stored_size // 2)
+            f.write('corrupt')
+
+        self.assertRaises(Exception, reader.read, 'share/numbers')
+        self.assertEqual(self.files['bin/tool'], reader.read('bin/tool'))
+
+
+    def test_not_archive(self):
+        path = os.path.join(self.work_dir, 'src', 'share', 'numbers')
+
+        self.assertFalse(archive.is_archive(path))
+        self.assertRaises(Exception, archive.ArchiveReader, path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1071 @@
+# Author: Joseph Lisee <jlisee@gmail.com>
+
+__doc__ = """Tests for the build module
+"""
+
+# Python Imports
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+# Project Imports
+from xpkg import archive
+from xpkg import build
+from xpkg import compression
+from xpkg import core
+from xpkg import linux
+from xpkg import util
+
+
+class PackageBuilderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(suffix = '-testing-xpkg')
+
+        self.target_dir = os.path.join(self.work_dir, 'target')
+        util.ensure_dir(self.target_dir)
+
+
+    def tearDown(self):
+        if os.path.exists(self.work_dir):
+            shutil.rmtree(self.work_dir)
+
+
+    def _make_xpd(self, **kwargs):
+        """
+        Create a simple XPD which needs no source files.
+        """
+
+        data = {
+            'name' : 'simple',
+            'version' : '1.0.0',
+            'files' : {},
+            'build' : 'true',
+        }
+        data.update(kwargs)
+
+        return core.XPD(os.path.join(self.work_dir, 'simple.xpd'), data=data)
+
+
+    def test_staged_install(self):
+        """
+        Make sure installing into a populated directory only records the
+        new files, and merges them in.
+        """
+
+        # Put some existing files in our target
+        share_dir = os.path.join(self.target_dir, 'share')
+        util.ensure_dir(share_dir)
+        util.touch(os.path.join(share_dir, 'old.txt'))
+
+        # Install through DESTDIR
+        xpd = self._make_xpd(install=[
+            'mkdir -p $DESTDIR%(prefix)s/share/simple',
+            'echo hi > %(destdir)s%(prefix)s/share/simple/note.txt',
+        ])
+        xpd._data['install-destdir'] = True
+
+        builder = build.PackageBuilder(xpd)
+        infos = builder.build(self.target_dir, output_to_file=False)
+
+        self.assertEqual(['share/simple'], infos[0]['dirs'])
+        self.assertEqual(['share/simple/note.txt'], infos[0]['files'])
+
+        # Make sure everything ended up in the right spot
+        note_path = os.path.join(share_dir, 'simple', 'note.txt')
+        self.assertEqual('hi\n', open(note_path).read())
+
+        expected = ['lib', 'share']
+        self.assertEqual(expected, sorted(os.listdir(self.target_dir)))
+
+
+    def test_staged_install_conflicts(self):
+        """
+        Make sure a staged symlink and an existing directory, or the reverse,
+        are an error instead of breaking the target.
+        """
+
+        share_dir = os.path.join(self.target_dir, 'share')
+        util.ensure_dir(os.path.join(share_dir, 'docs'))
+        util.touch(os.path.join(share_dir, 'docs', 'old.txt'))
+
+        # Symlink staged where there is a directory
+        xpd = self._make_xpd(install=[
+            'mkdir -p $DESTDIR%(prefix)s/share',
+            'ln -s elsewhere $DESTDIR%(prefix)s/share/docs',
+        ])
+        xpd._data['install-destdir'] = True
+
+        builder = build.PackageBuilder(xpd)
+
+        with self.assertRaisesRegexp(Exception, 'existing directory'):
+            builder.build(self.target_dir, output_to_file=False)
+
+        self.assertTrue(os.path.exists(os.path.join(share_dir, 'docs',
+                                                    'old.txt')))
+
+        # Directory staged where there is a symlink to one
+        outside_dir = os.path.join(self.work_dir, 'outside')
+        util.ensure_dir(outside_dir)
+        os.symlink(outside_dir, os.path.join(share_dir, 'linked'))
+
+        xpd = self._make_xpd(install=[
+            'mkdir -p $DESTDIR%(prefix)s/share/linked',
+            'touch $DESTDIR%(prefix)s/share/linked/new.txt',
+        ])
+        xpd._data['install-destdir'] = True
+
+        builder = build.PackageBuilder(xpd)
+
+        with self.assertRaisesRegexp(Exception, 'existing symlink'):
+            builder.build(self.target_dir, output_to_file=False)
+
+        self.assertEqual([], os.listdir(outside_dir))
+
+
+    def test_staged_install_ignored(self):
+        """
+        Installs are only staged when the XPD says they use DESTDIR.
+        """
+
+        util.touch(os.path.join(self.target_dir, 'existing'))
+
+        install = 'mkdir -p %(prefix)s/bin && touch %(prefix)s/bin/tool'
+
+        # By default we scan the target
+        builder = build.PackageBuilder(self._make_xpd(install=install))
+        infos = builder.build(self.target_dir, output_to_file=False)
+
+        self.assertEqual(['bin/tool'], infos[0]['files'])
+
+        shutil.rmtree(os.path.join(self.target_dir, 'bin'))
+
+        # Saying it uses DESTDIR when it doesn't is an error
+        xpd = self._make_xpd(install=install)
+        xpd._data['install-destdir'] = True
+
+        builder = build.PackageBuilder(xpd)
+
+        self.assertRaises(Exception, builder.build, self.target_dir,
+                          output_to_file=False)
+
+
+    def test_shell_session(self):
+        """
+        Make sure a shell session keeps state between commands, and still
+        catches failures.
+        """
+
+        xpd = self._make_xpd(**{
+            'shell-session' : True,
+            'build' : [
+                'mkdir -p sub',
+                'cd sub',
+                'export GREETING=hi',
+                'echo $GREETING > out.txt',
+            ],
+            'install' : [
+                'mkdir -p %(prefix)s/share',
+                'cp sub/out.txt %(prefix)s/share',
+            ],
+        })
+
+        builder = build.PackageBuilder(xpd)
+        infos = builder.build(self.target_dir, output_to_file=False)
+
+        out_path = os.path.join(self.target_dir, 'share', 'out.txt')
+        self.assertEqual('hi\n', open(out_path).read())
+
+        # Now make sure we stop on the first failure
+        xpd = self._make_xpd(**{
+            'shell-session' : True,
+            'build' : ['false', 'touch %s/never' % self.work_dir],
+            'install' : 'true',
+        })
+
+        builder = build.PackageBuilder(xpd)
+
+        self.assertRaises(subprocess.CalledProcessError, builder.build,
+                          self.target_dir, output_to_file=False)
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'never')))
+
+        # Pipes opened by other builds shouldn't leak into our commands, the
+        # shell and the commands it runs only get their status descriptor
+        read_fd, write_fd = os.pipe()
+
+        try:
+            for session in [True, False]:
+                xpd = self._make_xpd(**{
+                    'shell-session' : session,
+                    'build' : 'test ! -e /proc/self/fd/%d' % write_fd,
+                    'install' : 'true',
+                })
+
+                build.PackageBuilder(xpd).build(self.target_dir,
+                                                output_to_file=False)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+
+    def test_timeouts(self):
+        """
+        Make sure hung commands, and everything they started, are killed
+        when they run out of time or stop making output.
+        """
+
+        marker = os.path.join(self.work_dir, 'never')
+
+        cases = [
+            ({'timeout' : {'build' : 0.5}}, 'timed out'),
+            ({'timeout' : 0.5, 'shell-session' : True}, 'timed out'),
+            ({'stall-timeout' : 0.5}, 'no output for'),
+        ]
+
+        poll_interval = build.Watchdog.POLL_INTERVAL
+        build.Watchdog.POLL_INTERVAL = 0.1
+
+        try:
+            for settings, reason in cases:
+                xpd = self._make_xpd(**dict(settings, **{
+                    'build' : 'echo started; (sleep 1; touch %s) & '
+                              'sleep 30' % marker,
+                }))
+
+                builder = build.PackageBuilder(xpd)
+                start = time.time()
+
+                # The output has to go to a log file to be watched, so keep
+                # it out of the current directory
+                with self.assertRaises(Exception) as cm:
+                    with util.cd(self.work_dir):
+                        builder.build(self.target_dir)
+
+                self.assertLess(time.time() - start, 10)
+                self.assertIn(reason, str(cm.exception))
+                self.assertIn('started', str(cm.exception))
+        finally:
+            build.Watchdog.POLL_INTERVAL = poll_interval
+
+        # The background command was killed along with the rest
+        time.sleep(1.5)
+        self.assertFalse(os.path.exists(marker))
+
+
+    def test_find_path_offsets(self):
+        """
+        Make sure the install path is found as a literal string, by both the
+        serial and parallel scans.
+        """
+
+        # A '.' in the path would match anything as a regex
+        target_dir = os.path.join(self.work_dir, 'tar.et')
+        other_dir = os.path.join(self.work_dir, 'tarXet')
+
+        files = {
+            'bin/prog' : 'ELF\0%s/lib\0%s\0%s:%s/x\0' % (target_dir,
+                         target_dir, target_dir, target_dir),
+            'share/msg.txt' : 'Look in %s and %s\n' % (target_dir, other_dir),
+            'share/other.txt' : 'Nothing in %s\n' % other_dir,
+            'share/empty' : '',
+        }
+
+        for rel_path, contents in files.iteritems():
+            full_path = os.path.join(target_dir, rel_path)
+            util.ensure_dir(os.path.dirname(full_path))
+
+            with open(full_path, 'w') as f:
+                f.write(contents)
+
+        # Find where each copy of the path is in our binary
+        prog = files['bin/prog']
+        first = prog.index(target_dir)
+        second = prog.index(target_dir, first + 1)
+        third = prog.index(target_dir, second + 1)
+        fourth = prog.index(target_dir, third + 1)
+
+        expected = {
+            'install_dir' : target_dir,
+            'binary_files' : {'bin/prog' : [second]},
+            'sub_binary_files' : {
+                'bin/prog' : [[first, prog.index('\0', first)],
+                              [third, fourth, prog.index('\0', third)]],
+            },
+            'text_files' : {'share/msg.txt' : [len('Look in ')]},
+        }
+
+        builder = build.PackageBuilder(self._make_xpd())
+        builder._target_dir = target_dir
+
+        parallel_scan_bytes = build.PARALLEL_SCAN_BYTES
+
+        try:
+            for scan_bytes in [parallel_scan_bytes, 0]:
+                build.PARALLEL_SCAN_BYTES = scan_bytes
+
+                offsets = builder._find_path_offsets(files.keys())
+                self.assertEqual(expected, offsets)
+        finally:
+            build.PARALLEL_SCAN_BYTES = parallel_scan_bytes
+
+
+    def test_find_path_offsets_elf(self):
+        """
+        Make sure we only scan the data of ELF files, and still find the
+        install path in them.
+        """
+
+        source_path = os.path.join(self.work_dir, 'prog.c')
+        prog_path = os.path.join(self.target_dir, 'bin', 'prog')
+        util.ensure_dir(os.path.dirname(prog_path))
+
+        with open(source_path, 'w') as f:
+            f.write('#include <stdio.h>\n'
+                    'int main() { puts("%s/share"); return 0; }\n' %
+                    self.target_dir)
+
+        subprocess.check_call(['cc', '-o', prog_path, source_path])
+
+        # We skip the code, but not the string
+        with open(prog_path, 'rb') as f:
+            contents = f.read()
+            ranges = linux.elf_data_ranges(f)
+
+        self.assertLess(sum(end - start for start, end in ranges),
+                        len(contents))
+
+        offset = contents.index(self.target_dir + '/share')
+        self.assertTrue(any(start <= offset < end for start, end in ranges))
+
+        builder = build.PackageBuilder(self._make_xpd())
+        builder._target_dir = self.target_dir
+
+        offsets = builder._find_path_offsets(['bin/prog'])
+        self.assertEqual({'bin/prog' : [[offset, offset + len(self.target_dir)
+                                         + len('/share')]]},
+                         offsets['sub_binary_files'])
+
+        # Non-ELF files are scanned whole
+        self.assertIsNone(linux.elf_data_ranges(open(source_path)))
+
+        # So are files that only look like ELF
+        bad_path = os.path.join(self.work_dir, 'bad.elf')
+
+        with open(bad_path, 'wb') as f:
+            f.write('\x7fELF\x02\x01\x01' + '\0' * 9 +
+                    '\x02\x00\x3e\x00' + '\xff' * 60)
+
+        self.assertIsNone(linux.elf_data_ranges(open(bad_path, 'rb')))
+
+
+    def test_packed_offsets(self):
+        """
+        Make sure packages store their install path offsets packed in their
+        own member, and still relocate on install.
+        """
+
+        storage_dir = os.path.join(self.work_dir, 'repo')
+        util.ensure_dir(storage_dir)
+
+        xpd = self._make_xpd(**{
+            'install' : [
+                'mkdir -p %(prefix)s/share',
+                'echo "%(prefix)s/bin %(prefix)s/lib" > %(prefix)s/share/a',
+            ],
+        })
+
+        builder = build.BinaryPackageBuilder(xpd)
+        paths = builder.build(storage_dir, output_to_file=False)
+
+        xpa = core.XPA(paths[0])
+        self.assertEqual(['install_dir', 'member'],
+                         sorted(xpa.info['install_path_offsets']))
+
+        offsets = xpa.install_path_offsets()
+        install_dir = offsets['install_dir']
+
+        self.assertEqual(build.INSTALL_DIR_LENGTH, len(install_dir))
+
+        self.assertEqual({'share/a' : [0, len(install_dir) + 5]},
+                         offsets['text_files'])
+
+        # Any reasonable path fits in the padded install dir
+        dest_dir = os.path.join(self.work_dir, 'dest-' + 'd' * 150)
+        xpa.install(dest_dir)
+
+        contents = open(os.path.join(dest_dir, 'share', 'a')).read()
+        self.assertEqual('%s/bin %s/lib\n' % (dest_dir, dest_dir), contents)
+
+        # Round trip a bit of everything
+        offsets = {
+            'install_dir' : '/tmp/install',
+            'binary_files' : {'bin/a' : [12947, 57290], 'bin/b' : [5]},
+            'sub_binary_files' : {'bin/a' : [[1000, 1050], [7562, 7590, -1]]},
+            'text_files' : {},
+        }
+
+        packed = build.pack_path_offsets(offsets)
+        self.assertEqual(offsets, build.unpack_path_offsets(packed,
+                                                            '/tmp/install'))
+
+
+    def test_relative_rpath(self):
+        """
+        Make sure RPATHs into the install directory are made relative, so the
+        binaries work wherever they are moved without changes.
+        """
+
+        xpd = self._make_xpd(**{
+            'build' : [
+                'echo "int greet() { return 42; }" > greet.c',
+                'echo "int greet(); int main() { return greet() - 42; }" '
+                '> main.c',
+            ],
+            'install' : [
+                'mkdir -p %(prefix)s/lib %(prefix)s/bin',
+                'cc -shared -fPIC -o %(prefix)s/lib/libgreet.so greet.c',
+                'cc -o %(prefix)s/bin/prog main.c -L%(prefix)s/lib -lgreet '
+                '-Wl,-rpath,%(prefix)s/lib:/opt/other',
+            ],
+        })
+
+        builder = build.PackageBuilder(xpd)
+        info = builder.build(self.target_dir, output_to_file=False)[0]
+
+        # Nothing left to fix up on install
+        offsets = info['install_path_offsets']
+        self.assertNotIn('bin/prog', offsets['binary_files'])
+        self.assertNotIn('bin/prog', offsets['sub_binary_files'])
+
+        prog_path = os.path.join(self.target_dir, 'bin', 'prog')
+        self.assertIn('$ORIGIN/../lib:/opt/other\0',
+                      open(prog_path, 'rb').read())
+
+        # Move it and make sure it still runs
+        moved_dir = os.path.join(self.work_dir, 'moved')
+        os.rename(self.target_dir, moved_dir)
+
+        subprocess.check_call([os.path.join(moved_dir, 'bin', 'prog')])
+
+        # Files that only look like ELF are left alone
+        bad_path = os.path.join(self.work_dir, 'bad.elf')
+        contents = ('\x7fELF\x02\x01\x01' + '\0' * 9 + '\x02\x00\x3e\x00' +
+                    '\xff' * 60)
+
+        with open(bad_path, 'wb') as f:
+            f.write(contents)
+
+        self.assertFalse(linux.make_rpaths_relative(bad_path, moved_dir))
+        self.assertEqual(contents, open(bad_path, 'rb').read())
+
+
+    def test_build_stats(self):
+        """
+        Make sure we record the resources used by each build phase.
+        """
+
+        xpd = self._make_xpd(**{
+            'build' : 'dd if=/dev/zero of=data bs=1024 count=64 2> /dev/null',
+            'install' : [
+                'mkdir -p %(prefix)s/share',
+                'cp data %(prefix)s/share',
+            ],
+        })
+
+        builder = build.PackageBuilder(xpd)
+        infos = builder.build(self.target_dir, output_to_file=False)
+
+        stats = infos[0]['build_stats']
+
+        for phase in ['fetch', 'unpack', 'configure', 'build', 'install']:
+            self.assertIn(phase, stats)
+
+        build_stats = stats['build']
+
+        for name, _, _ in build.USAGE_FIELDS:
+            self.assertIn(name, build_stats)
+
+        self.assertGreater(build_stats['wall_time'], 0)
+        self.assertGreater(build_stats['max_rss_kb'], 0)
+
+        # Phases without commands use nothing
+        self.assertEqual(0, stats['fetch']['max_rss_kb'])
+
+
+    def test_concurrent_builds(self):
+        """
+        Make sure builds in separate threads get their own environment and
+        build directory, and leave ours alone.
+        """
+
+        env_before = dict(os.environ)
+        cwd_before = os.getcwd()
+
+        results = {}
+
+        def run_build(name):
+            target_dir = os.path.join(self.work_dir, name)
+
+            xpd = self._make_xpd(**{
+                'name' : name,
+                'build-dir' : name + '-build',
+                'build' : 'pwd > where.txt',
+                'install' : [
+                    'mkdir -p %(prefix)s/share',
+                    'cp where.txt %(prefix)s/share',
+                    'echo $DESTDIR > %(prefix)s/share/destdir.txt',
+                ],
+            })
+
+            builder = build.PackageBuilder(xpd)
+
+            try:
+                builder.build(target_dir, output_to_file=False)
+                results[name] = target_dir
+            except BaseException as e:
+                results[name] = e
+
+        threads = [threading.Thread(target=run_build, args=(name,))
+                   for name in ['first', 'second', 'third']]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        # Each build ran in its own directory
+        for name, target_dir in results.iteritems():
+            self.assertIsInstance(target_dir, str)
+
+            share_dir = os.path.join(target_dir, 'share')
+            where = open(os.path.join(share_dir, 'where.txt')).read()
+
+            self.assertTrue(where.strip().endswith(name + '-build'))
+
+        # And we are left how we started
+        self.assertEqual(env_before, dict(os.environ))
+        self.assertEqual(cwd_before, os.getcwd())
+
+
+    def test_check(self):
+        """
+        Make sure the check phase runs in the build directory, and the
+        package is only published when it passes.
+        """
+
+        storage_dir = os.path.join(self.work_dir, 'repo')
+        util.ensure_dir(storage_dir)
+
+        xpd = self._make_xpd(**{
+            'build' : 'echo built > out.txt',
+            'check' : 'grep built out.txt',
+            'install' : [
+                'mkdir -p %(prefix)s/share',
+                'cp out.txt %(prefix)s/share',
+            ],
+        })
+
+        builder = build.BinaryPackageBuilder(xpd)
+        paths = builder.build(storage_dir, output_to_file=False)
+
+        self.assertEqual(1, len(paths))
+
+        xpa = core.XPA(paths[0])
+        self.assertIn('check', xpa.info['build_stats'])
+        self.assertIn('wall_time', xpa.info['build_stats']['check'])
+
+        # Now a failing check
+        os.remove(paths[0])
+
+        xpd = self._make_xpd(**{
+            'build' : 'echo built > out.txt',
+            'check' : 'grep broken out.txt',
+            'install' : [
+                'mkdir -p %(prefix)s/share',
+                'cp out.txt %(prefix)s/share',
+            ],
+        })
+
+        builder = build.BinaryPackageBuilder(xpd)
+
+        self.assertRaises(subprocess.CalledProcessError, builder.build,
+                          storage_dir, output_to_file=False)
+        self.assertEqual([], os.listdir(storage_dir))
+
+        # A failure to package doesn't wait for the check to finish
+        xpd = self._make_xpd(**{
+            'check' : 'sleep 60',
+            'install' : 'mkdir -p %(prefix)s/share',
+        })
+
+        builder = build.BinaryPackageBuilder(xpd)
+        missing_dir = os.path.join(self.work_dir, 'missing')
+
+        start = time.time()
+        self.assertRaises(OSError, builder.build, missing_dir,
+                          output_to_file=False)
+        self.assertLess(time.time() - start, 30)
+
+
+    def test_toolset_env_vars(self):
+        """
+        Make sure toolset variables are applied to the given dict only.
+        """
+
+        toolset = build.Toolset('test', {}, env_vars={
+            'A' : ('new', build.Toolset.REPLACE_VAR),
+            'B' : (':after', build.Toolset.APPEND_VAR),
+            'C' : ('before:', build.Toolset.PREPEND_VAR),
+        })
+
+        env = {'A' : 'old', 'B' : 'b', 'C' : 'c'}
+
+        toolset.apply_env_vars({}, env)
+
+        expected = {'A' : 'new', 'B' : 'b:after', 'C' : 'before:c'}
+        self.assertEqual(expected, env)
+
+
+    def test_performance_profiles(self):
+        """
+        Make sure the profile flags go on top of the toolset ones, and are
+        part of the build input hash.
+        """
+
+        # Give ourselves a fast linker
+        bin_dir = os.path.join(self.work_dir, 'bin')
+        util.ensure_dir(bin_dir)
+
+        linker_path = os.path.join(bin_dir, 'ld.gold')
+        util.touch(linker_path)
+        os.chmod(linker_path, 0755)
+
+        env_vars = {'CFLAGS' : ('-Ibase', build.Toolset.REPLACE_VAR)}
+
+        toolset = build.Toolset('test', {}, env_vars=env_vars,
+                                profile='build-speed')
+
+        env = {'PATH' : bin_dir}
+        toolset.apply_env_vars({}, env)
+
+        self.assertEqual('-Ibase -pipe -g0', env['CFLAGS'])
+        self.assertEqual(' -fuse-ld=gold', env['LDFLAGS'])
+
+        # No linker means no flag
+        env = {'PATH' : ''}
+        toolset.apply_env_vars({}, env)
+
+        self.assertNotIn('LDFLAGS', env)
+
+        # Now make sure the profile changes our hash
+        xpd = self._make_xpd()
+
+        runtime_toolset = build.Toolset('test', {}, env_vars=env_vars,
+                                        profile='runtime-speed')
+
+        self.assertNotEqual(build.build_input_hash(xpd, toolset),
+                            build.build_input_hash(xpd, runtime_toolset))
+
+        # The CPU we tune for is part of the toolset, and so the build inputs
+        old_cpu = build.Toolset('test', {}, env_vars=env_vars,
+                                profile='runtime-speed', march='x86-64')
+        new_cpu = build.Toolset.create_from_dict(dict(old_cpu.to_dict(),
+                                                      march='skylake'))
+
+        self.assertNotEqual(build.build_input_hash(xpd, old_cpu),
+                            build.build_input_hash(xpd, new_cpu))
+
+        env = {'PATH' : ''}
+        new_cpu.apply_env_vars({}, env)
+        self.assertIn(' -march=skylake', env['CFLAGS'])
+
+        # And survives serialization
+        loaded = build.Toolset.create_from_dict(toolset.to_dict())
+        self.assertEqual('build-speed', loaded.profile)
+
+        self.assertRaises(Exception, build.Toolset, 'test', {},
+                          profile='not-a-profile')
+
+
+    def test_compression(self):
+        """
+        Make sure packages can be built and installed with every codec, and
+        the codec is noted in the package.
+        """
+
+        xpd = self._make_xpd(**{
+            'install' : [
+                'mkdir -p %(prefix)s/share',
+                'seq 100000 > %(prefix)s/share/numbers',
+                'echo "%(prefix)s" > %(prefix)s/share/prefix',
+            ],
+        })
+
+        for codec in sorted(compression.CODECS):
+            storage_dir = os.path.join(self.work_dir, 'repo-' + codec)
+            util.ensure_dir(storage_dir)
+
+            builder = build.BinaryPackageBuilder(xpd, codec=codec, level=1)
+            paths = builder.build(storage_dir, output_to_file=False)
+
+            xpa = core.XPA(paths[0])
+            self.assertEqual(codec, xpa.info['payload']['codec'])
+
+            dest_dir = os.path.join(self.work_dir, 'dest-' + codec)
+            xpa.install(dest_dir)
+
+            numbers_path = os.path.join(dest_dir, 'share', 'numbers')
+            self.assertEqual(100000, len(open(numbers_path).readlines()))
+
+            prefix_path = os.path.join(dest_dir, 'share', 'prefix')
+            self.assertEqual(dest_dir + '\n', open(prefix_path).read())
+
+
+    def test_reproducible(self):
+        """
+        Make sure building the same thing twice gives the same package, even
+        when the files have different times after SOURCE_DATE_EPOCH.
+        """
+
+        xpd = self._make_xpd(**{
+            'install' : [
+                'mkdir -p %(prefix)s/share %(prefix)s/bin',
+                'for i in $(seq 50); do echo $i > %(prefix)s/share/$i; done',
+                'echo "%(prefix)s" > %(prefix)s/bin/prefix',
+                'touch -d @$XPKG_TEST_TIME %(prefix)s/share/*',
+                'touch -d @1000000000 %(prefix)s/share/1',
+            ],
+        })
+
+        for xpa_format in [1, 2]:
+            contents = []
+
+            for stamp in ['1300000000', '1400000000']:
+                storage_dir = os.path.join(self.work_dir,
+                                           'repo-%d-%s' % (xpa_format, stamp))
+                util.ensure_dir(storage_dir)
+
+                with util.save_env():
+                    os.environ['XPKG_TEST_TIME'] = stamp
+                    os.environ['SOURCE_DATE_EPOCH'] = '1200000000'
+
+                    builder = build.BinaryPackageBuilder(xpd,
+                                                         xpa_format=xpa_format)
+                    paths = builder.build(storage_dir, output_to_file=False)
+
+                contents.append(open(paths[0], 'rb').read())
+
+            self.assertEqual(contents[0], contents[1])
+
+            # The file times are clamped, but otherwise kept
+            xpa = core.XPA(paths[0])
+            self.assertNotIn('build_stats', xpa.info)
+
+            if xpa_format == 1:
+                with tarfile.open(paths[0]) as tar:
+                    self.assertEqual(1200000000,
+                                     tar.getmember('xpkg.yml').mtime)
+
+                    stream = compression.lookup('gzip').open(
+                        tar.extractfile('files.tar.gz'))
+
+                    with tarfile.open(fileobj=stream, mode='r|') as files:
+                        members = [(m.name, m.mtime) for m in files]
+            else:
+                reader = archive.ArchiveReader(paths[0])
+                members = [(e.name, e.mtime) for e in reader.entries]
+
+            self.assertEqual(sorted(members), members)
+            self.assertIn(('bin/prefix', 1200000000), members)
+            self.assertIn(('share/1', 1000000000), members)
+            self.assertIn(('share/2', 1200000000), members)
+
+
+    def test_xpa_formats(self):
+        """
+        Make sure packages in both formats install the same, and single files
+        can be read out of them.
+        """
+
+        xpd = self._make_xpd(**{
+            'install' : [
+                'mkdir -p %(prefix)s/share %(prefix)s/bin',
+                'seq 100000 > %(prefix)s/share/numbers',
+                'touch %(prefix)s/share/empty',
+                'echo "%(prefix)s" > %(prefix)s/share/prefix',
+                'printf "#!/bin/sh\necho hi\n" > %(prefix)s/bin/hi',
+                'chmod 755 %(prefix)s/bin/hi',
+                'ln -s ../share/numbers %(prefix)s/bin/numbers',
+            ],
+        })
+
+        for xpa_format in [1, 2]:
+            storage_dir = os.path.join(self.work_dir, 'repo-%d' % xpa_format)
+            util.ensure_dir(storage_dir)
+
+            builder = build.BinaryPackageBuilder(xpd, xpa_format=xpa_format)
+            paths = builder.build(storage_dir, output_to_file=False)
+
+            self.assertEqual(xpa_format == 2, archive.is_archive(paths[0]))
+
+            xpa = core.XPA(paths[0])
+            self.assertEqual('simple', xpa.name)
+            self.assertEqual('1\n2\n', xpa.read_file('share/numbers')[:4])
+            self.assertEqual('../share/numbers', xpa.read_file('bin/numbers'))
+
+            dest_dir = os.path.join(self.work_dir, 'dest-%d' % xpa_format)
+            xpa.install(dest_dir)
+
+            numbers_path = os.path.join(dest_dir, 'bin', 'numbers')
+            self.assertEqual(100000, len(open(numbers_path).readlines()))
+
+            prefix_path = os.path.join(dest_dir, 'share', 'prefix')
+            self.assertEqual(dest_dir + '\n', open(prefix_path).read())
+
+            empty_path = os.path.join(dest_dir, 'share', 'empty')
+            self.assertEqual('', open(empty_path).read())
+
+            hi_path = os.path.join(dest_dir, 'bin', 'hi')
+            self.assertEqual(0755, os.stat(hi_path).st_mode & 0777)
+
+
+    def test_file_compression(self):
+        """
+        Make sure already compressed files are stored as they are, and the
+        XPD can pick the codec for files.
+        """
+
+        xpd = self._make_xpd(**{
+            'install' : [
+                'mkdir -p %(prefix)s/share',
+                'seq 10000 > %(prefix)s/share/numbers',
+                'seq 10000 | gzip > %(prefix)s/share/numbers.gz',
+                'seq 20000 > %(prefix)s/share/raw',
+                'seq 30000 > %(prefix)s/share/small',
+            ],
+            'file-compression' : {
+                'store' : ['share/raw'],
+                'bz2' : ['share/sm.*'],
+            },
+        })
+
+        builder = build.BinaryPackageBuilder(xpd, codec='gzip', xpa_format=2)
+        paths = builder.build(self.work_dir, output_to_file=False)
+
+        reader = archive.ArchiveReader(paths[0])
+        codecs = dict((e.name, e.codec) for e in reader.entries)
+
+        self.assertEqual({
+            'share/numbers' : 'gzip',
+            'share/numbers.gz' : 'store',
+            'share/raw' : 'store',
+            'share/small' : 'bz2',
+        }, codecs)
+
+        dest_dir = os.path.join(self.work_dir, 'dest')
+        core.XPA(paths[0]).install(dest_dir)
+
+        small_path = os.path.join(dest_dir, 'share', 'small')
+        self.assertEqual(30000, len(open(small_path).readlines()))
+
+        # Unknown codecs are caught up front
+        xpd._data['file-compression'] = {'rar' : ['.*']}
+        self.assertRaises(Exception, build.BinaryPackageBuilder, xpd)
+
+
+    def test_resume_dir(self):
+        """
+        Make sure builds outside an environment resume from a directory of
+        their own user and inputs, which only one build can use at a time.
+        """
+
+        builder = build.BinaryPackageBuilder(self._make_xpd())
+
+        resume_dir = builder._resume_dir(None, 'abc123')
+        self.assertIn('-%d' % os.getuid(), resume_dir)
+        self.assertTrue(resume_dir.endswith('-abc123'))
+        self.assertNotEqual(resume_dir, builder._resume_dir(None, 'def456'))
+
+        # Another process has to wait for the lock
+        lock_path = os.path.join(self.work_dir, 'locked')
+        lock_file = builder._lock_dir(lock_path)
+
+        cmd = ['flock', '-n', lock_path + '.lock', 'true']
+
+        try:
+            self.assertNotEqual(0, subprocess.call(cmd))
+        finally:
+            lock_file.close()
+
+        self.assertEqual(0, subprocess.call(cmd))
+
+
+    def test_private_build_dir(self):
+        """
+        Make sure builds in the shared temporary directory use a directory
+        only our user can get into, and refuse one somebody else could have
+        made.
+        """
+
+        old_tempdir = tempfile.tempdir
+        tempfile.tempdir = self.work_dir
+
+        try:
+            builder = build.BinaryPackageBuilder(self._make_xpd(),
+                                                 reproducible=True)
+
+            work_dir, lock_file = builder._lock_reproducible_dir(None)
+            lock_file.close()
+
+            root = os.path.join(self.work_dir, 'xpkg-build-%d' % os.getuid())
+            self.assertEqual(root, os.path.dirname(work_dir))
+            self.assertEqual(0700, os.stat(root).st_mode & 0777)
+
+            # Others can get into it
+            os.chmod(root, 0755)
+            self.assertRaises(Exception, builder._lock_reproducible_dir, None)
+
+            # It's a link to somewhere else
+            shutil.rmtree(root)
+            os.symlink(self.target_dir, root)
+            self.assertRaises(Exception, builder._resume_dir, None, 'abc123')
+        finally:
+            tempfile.tempdir = old_tempdir
+
+
+    def test_xpa_writer(self):
+        """
+        Make sure the XPA writer makes normal tar files, and only shows them
+        once they are finished.
+        """
+
+        dest_path = os.path.join(self.work_dir, 'test.xpa')
+        stream_data = ''.join(chr(i % 251) for i in xrange(100000))
+
+        writer = build.XPAWriter(dest_path)
+        writer.add_data('xpkg.yml', 'name: test\n')
+
+        with writer.open_member('files.tar.gz') as stream:
+            for i in xrange(0, len(stream_data), 999):
+                stream.write(stream_data[i:i + 999])
+
+        self.assertFalse(os.path.exists(dest_path))
+        self.assertEqual(dest_path, writer.commit())
+        self.assertEqual(['target', 'test.xpa'],
+                         sorted(os.listdir(self.work_dir)))
+
+        with tarfile.open(dest_path) as tar:
+            self.assertEqual(['xpkg.yml', 'files.tar.gz'], tar.getnames())
+            self.assertEqual('name: test\n',
+                             tar.extractfile('xpkg.yml').read())
+            self.assertEqual(stream_data,
+                             tar.extractfile('files.tar.gz').read())
+
+        # Aborting leaves nothing behind
+        os.remove(dest_path)
+
+        writer = build.XPAWriter(dest_path)
+        writer.add_data('xpkg.yml', 'name: test\n')
+        writer.abort()
+
+        self.assertEqual(['target'], os.listdir(self.work_dir))
+
+        # Two writers of the same package don't get in each others way
+        writers = [build.XPAWriter(dest_path) for i in xrange(2)]
+
+        for i, writer in enumerate(writers):
+            writer.add_data('xpkg.yml', 'name: test%d\n' % i)
+
+        for writer in writers:
+            writer.commit()
+
+        with tarfile.open(dest_path) as tar:
+            self.assertEqual('name: test1\n',
+                             tar.extractfile('xpkg.yml').read())
+
+        self.assertEqual(0644, os.stat(dest_path).st_mode & 0777)
+        self.assertEqual(['target', 'test.xpa'],
+                         sorted(os.listdir(self.work_dir)))
+
+
+class SharedBuildsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(suffix = '-testing-xpkg')
+
+        self.shared = build.SharedBuilds(os.path.join(self.work_dir, 'shared'))
+
+
+    def tearDown(self):
+        if os.path.exists(self.work_dir):
+            shutil.rmtree(self.work_dir)
+
+
+    def test_one_build(self):
+        """
+        Make sure concurrent requests for the same build only build once.
+        """
+
+        calls = []
+
+        def build_func(storage_dir):
+            calls.append(storage_dir)
+
+            # Give the other threads time to start waiting
+            time.sleep(0.5)
+
+            path = os.path.join(storage_dir, 'pkg.xpa')
+            util.touch(path)
+
+            return [path]
+
+        results = []
+
+        def run():
+            results.append(self.shared.build('abc', build_func))
+
+        threads = [threading.Thread(target=run) for i in xrange(3)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(calls))
+
+        expected = [os.path.join(self.shared.root, 'abc', 'pkg.xpa')]
+        self.assertEqual([expected] * 3, results)
+        self.assertTrue(os.path.exists(expected[0]))
+
+
+    def test_failed_build(self):
+        """
+        Make sure a failed build leaves nothing behind, so the next try
+        builds again.
+        """
+
+        def bad_build(storage_dir):
+            util.touch(os.path.join(storage_dir, 'partial.xpa'))
+            raise Exception('Build failed')
+
+        self.assertRaises(Exception, self.shared.build, 'abc', bad_build)
+        self.assertEqual(['abc.lock'], os.listdir(self.shared.root))
+
+        def good_build(storage_dir):
+            path = os.path.join(storage_dir, 'pkg.xpa')
+            util.touch(path)
+            return [path]
+
+        paths = self.shared.build('abc', good_build)
+        self.assertEqual(['pkg.xpa'], [os.path.basename(p) for p in paths])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# Author: Joseph Lisee <jlisee@gmail.com>
+
+__doc__ = """Tests for the compression module
+"""
+
+# Python Imports
+import random
+import unittest
+
+from StringIO import StringIO
+
+# Project Imports
+from xpkg import compression
+
+
+class CompressionTests(unittest.TestCase):
+
+    def setUp(self):
+        # Some compressible, and some not so compressible data
+        rand = random.Random(42)
+
+        self.data = ''.join(
+            'line %d\n' % i + chr(rand.randint(0, 255)) * rand.randint(0, 5)
+            for i in xrange(50000))
+
+
+    def _read_all(self, stream, size):
+        parts = []
+
+        while True:
+            data = stream.read(size)
+
+            if not data:
+                break
+
+            parts.append(data)
+
+        return ''.join(parts)
+
+
+    def test_round_trip(self):
+        """
+        Make sure every codec reads back what it wrote, over many blocks and
+        threads.
+        """
+
+        for name, codec in sorted(compression.CODECS.iteritems()):
+            for threads in [1, 4]:
+                output = StringIO()
+
+                with compression.ParallelCompressor(output, codec,
+                                                    threads=threads,
+                                                    block_size=10000) as f:
+                    for i in xrange(0, len(self.data), 777):
+                        f.write(self.data[i:i + 777])
+
+                compressed = output.getvalue()
+
+                if name != 'store':
+                    self.assertLess(len(compressed), len(self.data), name)
+
+                for read_size in [1000, 2**20]:
+                    stream = codec.open(StringIO(compressed))
+                    result = self._read_all(stream, read_size)
+
+                    self.assertEqual(self.data, result, name)
+
+
+    def test_empty(self):
+        """
+        Make sure we write a valid stream even with no data.
+        """
+
+        for name, codec in sorted(compression.CODECS.iteritems()):
+            output = StringIO()
+
+            with compression.ParallelCompressor(output, codec) as f:
+                pass
+
+            if name != 'store':
+                self.assertNotEqual('', output.getvalue(), name)
+
+            stream = codec.open(StringIO(output.getvalue()))
+            self.assertEqual('', self._read_all(stream, 100), name)
+
+
+    def test_is_compressed(self):
+        for name, codec in sorted(compression.CODECS.iteritems()):
+            compressed = codec.compress(self.data)
+            self.assertEqual(name != 'store',
+                             compression.is_compressed(compressed), name)
+
+        self.assertTrue(compression.is_compressed('\x89PNG\r\n\x1a\n...'))
+        self.assertFalse(compression.is_compressed(''))
+        self.assertFalse(compression.is_compressed('BZhello'))
+
+
+    def test_lookup(self):
+        self.assertEqual('.gz', compression.lookup('gzip').suffix)
+        self.assertRaises(Exception, compression.lookup, 'rar')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+# Author: Joseph Lisee <jlisee@gmail.com>
+
+__doc__ = """Tests for the build farm module
+"""
+
+# Python Imports
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+# Project Imports
+from xpkg import build
+from xpkg import core
+from xpkg import farm
+
+
+class BuildSpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(suffix = '-testing-xpkg')
+
+        self.spool = farm.BuildSpool(os.path.join(self.work_dir, 'spool'))
+
+        data = {
+            'name' : 'simple',
+            'version' : '1.0.0',
+            'files' : {},
+            'build' : 'true',
+        }
+
+        self.xpd = core.XPD(os.path.join(self.work_dir, 'simple.xpd'),
+                            data=data)
+
+        self.toolset = build.Toolset.lookup_by_name('local')
+
+
+    def tearDown(self):
+        if os.path.exists(self.work_dir):
+            shutil.rmtree(self.work_dir)
+
+
+    def test_claim_once(self):
+        """
+        Make sure each job is only claimed by one worker.
+        """
+
+        job_ids = [self.spool.submit(self.xpd, self.toolset, ['dep==1.0'])
+                   for i in xrange(10)]
+
+        claimed = []
+
+        def claim(name):
+            while True:
+                job_id, job = self.spool.claim(name)
+
+                if job_id is None:
+                    break
+
+                claimed.append(job_id)
+
+        threads = [threading.Thread(target=claim, args=('worker%d' % i,))
+                   for i in xrange(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(job_ids), sorted(claimed))
+
+        state, job = self.spool.status(job_ids[0])
+        self.assertEqual('claimed', state)
+        self.assertEqual(['dep==1.0'], job['deps'])
+        self.assertEqual(self.xpd._data, job['xpd'])
+
+
+    def test_finish(self):
+        """
+        Make sure waiters get the results of a job, or its error.
+        """
+
+        good_id = self.spool.submit(self.xpd, self.toolset, [])
+        bad_id = self.spool.submit(self.xpd, self.toolset, [])
+
+        job_id, job = self.spool.claim('worker')
+        self.assertEqual(good_id, job_id)
+        self.spool.finish(job, packages=['simple.xpa'])
+
+        job_id, job = self.spool.claim('worker')
+        self.assertEqual(bad_id, job_id)
+        self.spool.finish(job, error='it broke')
+
+        job = self.spool.wait(good_id, poll_interval=0.01)
+        self.assertEqual(['simple.xpa'], job['packages'])
+        self.assertEqual('worker', job['worker'])
+
+        self.assertRaises(core.Exception, self.spool.wait, bad_id,
+                          poll_interval=0.01)
+
+
+    def test_stale_claim(self):
+        """
+        Make sure the jobs of dead workers go to another worker, and that
+        waiting gives up.
+        """
+
+        spool = farm.BuildSpool(self.spool.root, lease=0.2)
+
+        job_id = spool.submit(self.xpd, self.toolset, [])
+        self.assertEqual(job_id, spool.claim('dead')[0])
+
+        # A renewed claim is kept
+        time.sleep(0.1)
+        self.assertTrue(spool.renew(spool.status(job_id)[1]))
+        time.sleep(0.1)
+
+        self.assertEqual((None, None), spool.claim('alive'))
+
+        # But once it runs out another worker gets the job
+        time.sleep(0.3)
+
+        claimed_id, job = spool.claim('alive')
+        self.assertEqual(job_id, claimed_id)
+        self.assertEqual('alive', job['worker'])
+
+        # Nobody finishes it
+        self.assertRaises(core.Exception, spool.wait, job_id,
+                          poll_interval=0.01, timeout=0.05)
+
+        # A worker that finishes after losing its claim leaves nothing queued
+        time.sleep(0.3)
+        self.assertEqual([job_id], spool.requeue_stale())
+
+        spool.finish(job, packages=['simple.xpa'])
+
+        self.assertEqual('done', spool.status(job_id)[0])
+        self.assertEqual((None, None), spool.claim('alive'))
+
+
+    def test_lost_claim(self):
+        """
+        Make sure a worker that loses its claim on a job stops, and leaves
+        the job to its new owner.
+        """
+
+        spool = farm.BuildSpool(self.spool.root, lease=0.2)
+        job_id = spool.submit(self.xpd, self.toolset, [])
+
+        worker = farm.Worker(spool, os.path.join(self.work_dir, 'repo'))
+        saw_lost = []
+
+        def build(job, lost):
+            # The second time around we have the job for good
+            if saw_lost:
+                return ['simple.xpa']
+
+            # Somebody decides we are dead and takes our job
+            os.rename(spool._job_path('claimed', job_id),
+                      spool._job_path('new', job_id))
+
+            lost.wait(5)
+            saw_lost.append(lost.is_set())
+
+            raise core.Exception('Lost our claim')
+
+        worker.build = build
+
+        self.assertEqual(2, worker.run(once=True))
+        self.assertEqual([True], saw_lost)
+
+        # The lost attempt didn't fail the job for its new owner
+        self.assertEqual('done', spool.status(job_id)[0])
+        self.assertEqual([], os.listdir(os.path.join(spool.root, 'failed')))
+
+
+    def test_late_failure(self):
+        """
+        Make sure a job done by one worker stays done when a second worker,
+        which had lost its claim, fails it later.
+        """
+
+        job_id = self.spool.submit(self.xpd, self.toolset, [])
+
+        first_id, first_job = self.spool.claim('first')
+
+        # The job went back to the queue and another worker finished it
+        os.rename(self.spool._job_path('claimed', job_id),
+                  self.spool._job_path('new', job_id))
+
+        second_id, second_job = self.spool.claim('second')
+        self.spool.finish(second_job, packages=['simple.xpa'])
+
+        self.spool.finish(first_job, error='it broke')
+
+        job = self.spool.wait(job_id, poll_interval=0.01)
+        self.assertEqual('second', job['worker'])
+        self.assertEqual([], os.listdir(os.path.join(self.spool.root,
+                                                     'failed')))
+
+        # Even if the failure gets written anyway
+        with open(self.spool._job_path('failed', job_id), 'w') as f:
+            f.write('{}')
+
+        self.assertEqual('done', self.spool.status(job_id)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,8 @@ __doc__ = """Tests for the util module
 """
 
 # Python Imports
+import os
+import tempfile
 import unittest
 
 # Project Imports
@@ -176,6 +178,45 @@ class UtilTests(unittest.TestCase):
         self.assertEqual(expected, wrapped)
 
 
+    def test_format_duration(self):
+        self.assertEqual('42s', util.format_duration(42.2))
+        self.assertEqual('5m03s', util.format_duration(303))
+        self.assertEqual('1h20m', util.format_duration(4830))
+
+
+    def test_varints(self):
+        values = [0, 1, -1, 63, -64, 64, 127, 128, 300, -300, 2**40, -2**40]
+
+        data = util.pack_varints(values)
+        self.assertEqual(1, len(util.pack_varints([-64])))
+        self.assertEqual(2, len(util.pack_varints([64])))
+
+        self.assertEqual((values, len(data)), util.unpack_varints(data))
+
+        # Read just part of it, then the rest
+        first, pos = util.unpack_varints('AB' + data, pos=2, count=3)
+        self.assertEqual(values[:3], first)
+        self.assertEqual((values[3:], len(data) + 2),
+                         util.unpack_varints('AB' + data, pos=pos))
+
+
+    def test_tail_lines(self):
+        fd, path = tempfile.mkstemp()
+
+        try:
+            lines = ['line %d\n' % i for i in xrange(1000)]
+
+            with os.fdopen(fd, 'w') as f:
+                f.writelines(lines)
+
+            self.assertEqual(lines[-3:], util.tail_lines(path, 3))
+            self.assertEqual(lines[-300:], util.tail_lines(path, 300,
+                                                           block_size=64))
+            self.assertEqual(lines, util.tail_lines(path, 5000))
+        finally:
+            os.remove(path)
+
+
 class SortTests(unittest.TestCase):
 
     def test_topological_sort(self):
@@ -219,5 +260,47 @@ class SortTests(unittest.TestCase):
         self.assertEqual(expected, topo_graph)
 
 
+    def test_critical_path_sort(self):
+        """
+        Make sure the long chains of work get started first.
+        """
+
+        # The app needs two libraries, one of which needs a slow compiler
+        graph = {
+            'app' : ['liba', 'libb'],
+            'liba' : ['gcc'],
+            'libb' : [],
+            'gcc' : [],
+        }
+
+        weights = {
+            'app' : 1,
+            'liba' : 1,
+            'libb' : 5,
+            'gcc' : 100,
+        }
+
+        actual = util.critical_path_sort(graph, weights)
+        expected = ['gcc', 'libb', 'liba', 'app']
+
+        self.assertEqual(expected, actual)
+
+        # Now make libb the bottleneck
+        weights['libb'] = 500
+
+        actual = util.critical_path_sort(graph, weights)
+        expected = ['libb', 'gcc', 'liba', 'app']
+
+        self.assertEqual(expected, actual)
+
+        # A cycle is an error, not a silently shorter order
+        graph['gcc'] = ['app']
+
+        with self.assertRaises(ValueError) as cm:
+            util.critical_path_sort(graph, weights)
+
+        self.assertIn('app -> liba -> gcc -> app', str(cm.exception))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,580 @@
+# Author: Joseph Lisee <jlisee@gmail.com>
+
+__doc__ = """
+The indexed package archive format (XPA version 2).  Unlike the original tar
+based format, the manifest can be read without scanning the archive, and every
+file is compressed on its own so it can be read, or installed in parallel,
+without decompressing anything else.  The layout is:
+
+  header - fixed size, see HEADER:
+    MAGIC
+    format version (32 bits)
+    offset and size of the metadata block (64 bits each)
+    offset and size of the index (64 bits each)
+
+  file data - the compressed contents of each file, one after another.
+    Large files are compressed in blocks, each a complete stream of the codec
+    (see the compression module), so they can be compressed in parallel.
+
+  metadata block - named strings, for the manifest and such:
+    util.pack_varints([length of the names, number of strings])
+    the '\\0' separated names
+    util.pack_varints(the length of each string)
+    the strings
+
+  index - one entry for each file:
+    util.pack_varints([length of the names, number of codecs, entries])
+    the '\\0' separated codec names, then the path of each entry, followed
+      by its link target for symlinks
+    util.pack_varints, for each entry:
+      1 if a symlink, otherwise 0
+      mode, mtime, offset, stored size, size, codec number
+    the raw SHA-256 digest of each entry's contents (the target of symlinks)
+
+The header is written last, so a partly written archive is never mistaken for
+a complete one.  All integers are big endian.
+"""
+
+# Python Imports
+import collections
+import hashlib
+import os
+import stat
+import struct
+import tempfile
+
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+# Project Imports
+from xpkg import compression
+from xpkg import util
+
+
+# Starts every archive, the first byte is never in plain text, and the line
+# endings catch any newline translation
+MAGIC = '\x89XPA\r\n\x1a\n'
+
+# The format version written into the header
+VERSION = 2
+
+# Magic, version, then the metadata and index offsets and sizes
+HEADER = struct.Struct('!8sIQQQQ')
+
+# Size of the digests of the entry contents
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+
+# A file in the archive, link is the target of symlinks (and None otherwise)
+Entry = collections.namedtuple('Entry', ['name', 'link', 'mode', 'mtime',
+                                         'offset', 'stored_size', 'size',
+                                         'codec', 'digest'])
+
+
+def is_archive(path):
+    """
+    Returns true if the file at path is an indexed archive, and not an older
+    tar based package.
+    """
+
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class ArchiveWriter(object):
+    """
+    Writes an indexed archive straight to a temporary file next to its
+    destination, compressing files on a pool of threads.  Once done commit
+    moves it into place atomically.  Example:
+
+        writer = ArchiveWriter('/repo/hello_1.0.0_x86_64_elf_linux.xpa',
+                               compression.lookup('zstd'))
+
+        try:
+            writer.add_file('/tmp/install/bin/hello', 'bin/hello')
+            writer.add_data('xpkg.yml', manifest)
+        except:
+            writer.abort()
+            raise
+
+        writer.commit()
+
+    When max_mtime is given file times later than it are clamped to it.
+    """
+
+    def __init__(self, dest_path, codec, level=None, threads=None,
+                 max_mtime=None, block_size=compression.BLOCK_SIZE):
+        self.dest_path = dest_path
+
+        self._codec = codec
+        self._level = level
+        self._max_mtime = max_mtime
+        self._block_size = block_size
+
+        if threads is None:
+            threads = util.cpu_count()
+
+        self._pool = ThreadPool(threads) if threads > 1 else None
+        self._max_pending = threads * 2
+        self._pending = collections.deque()
+
+        self._entries = []
+        self._metadata = []
+
+        # A unique temp file, so several builds can write the same package
+        # into one directory at once
+        dest_dir, file_name = os.path.split(dest_path)
+        fd, self._temp_path = tempfile.mkstemp(dir=dest_dir,
+                                               prefix='.' + file_name)
+        os.fchmod(fd, 0644)
+
+        self._file = os.fdopen(fd, 'wb')
+
+        # Leave room for the header, it's filled in by commit
+        self._file.write('\0' * HEADER.size)
+
+
+    def add_file(self, full_path, name, codec=None, level=None):
+        """
+        Adds the file, or symlink, at full_path to the archive under the given
+        name.  It's compressed with the given codec and level, otherwise the
+        ones for the archive, unless it's already compressed (see
+        compression.is_compressed) when it's stored as is.
+        """
+
+        sniff = codec is None
+
+        if codec is None:
+            codec = self._codec
+            level = self._level
+
+        file_stat = os.lstat(full_path)
+        mtime = int(file_stat.st_mtime)
+
+        if self._max_mtime is not None:
+            mtime = min(mtime, self._max_mtime)
+
+        entry = {
+            'name' : name,
+            'link' : None,
+            'mode' : stat.S_IMODE(file_stat.st_mode),
+            'mtime' : mtime,
+            'offset' : 0,
+            'stored_size' : 0,
+            'size' : 0,
+            'codec' : codec.name,
+        }
+
+        hash_state = hashlib.sha256()
+
+        if stat.S_ISLNK(file_stat.st_mode):
+            entry['link'] = os.readlink(full_path)
+            hash_state.update(entry['link'])
+        else:
+            with open(full_path, 'rb') as f:
+                data = f.read(self._block_size)
+
+                # Don't waste time compressing it again
+                if sniff and compression.is_compressed(data):
+                    codec = compression.lookup('store')
+                    entry['codec'] = codec.name
+
+                while data:
+                    hash_state.update(data)
+                    entry['size'] += len(data)
+
+                    self._submit(entry, codec, level, data)
+
+                    data = f.read(self._block_size)
+
+        entry['digest'] = hash_state.digest()
+
+        self._entries.append(entry)
+
+
+    def add_data(self, name, data):
+        """
+        Adds the string to the metadata block under the given name.
+        """
+
+        self._metadata.append((name, data))
+
+
+    def flush(self):
+        """
+        Waits until all the files added so far are written.
+        """
+
+        while len(self._pending):
+            self._write(*self._pending.popleft())
+
+
+    def commit(self):
+        """
+        Writes the metadata and index, then moves the archive into place,
+        returning its path.
+        """
+
+        self.flush()
+        self._shutdown()
+
+        metadata = self._pack_metadata()
+        metadata_offset = self._file.tell()
+        self._file.write(metadata)
+
+        index = self._pack_index()
+        index_offset = self._file.tell()
+        self._file.write(index)
+
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION,
+                                     metadata_offset, len(metadata),
+                                     index_offset, len(index)))
+        self._file.close()
+
+        os.rename(self._temp_path, self.dest_path)
+
+        return self.dest_path
+
+
+    def abort(self):
+        """
+        Throws away the partly written archive.
+        """
+
+        self._shutdown()
+        self._file.close()
+
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+
+    def _submit(self, entry, codec, level, data):
+        """
+        Starts compressing a block of the entry.
+        """
+
+        if self._pool is None:
+            self._write(entry, codec.compress(data, level))
+            return
+
+        result = self._pool.apply_async(codec.compress, (data, level))
+        self._pending.append((entry, result))
+
+        # Write out finished blocks once enough are queued up
+        while len(self._pending) > self._max_pending:
+            self._write(*self._pending.popleft())
+
+
+    def _write(self, entry, data):
+        """
+        Writes a compressed block of the entry, data can be a pending result.
+        """
+
+        if hasattr(data, 'get'):
+            data = data.get()
+
+        if entry['stored_size'] == 0:
+            entry['offset'] = self._file.tell()
+
+        self._file.write(data)
+        entry['stored_size'] += len(data)
+
+
+    def _shutdown(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+    def _pack_metadata(self):
+        names = '\0'.join(name for name, data in self._metadata)
+
+        return util.pack_varints([len(names), len(self._metadata)]) + names + \
+            util.pack_varints([len(data) for name, data in self._metadata]) + \
+            ''.join(data for name, data in self._metadata)
+
+
+    def _pack_index(self):
+        codecs = sorted(set(entry['codec'] for entry in self._entries))
+        codec_ids = dict((name, i) for i, name in enumerate(codecs))
+
+        names = list(codecs)
+        values = []
+
+        for entry in self._entries:
+            names.append(entry['name'])
+
+            if entry['link'] is None:
+                values.append(0)
+            else:
+                names.append(entry['link'])
+                values.append(1)
+
+            values.extend([entry['mode'], entry['mtime'], entry['offset'],
+                           entry['stored_size'], entry['size'],
+                           codec_ids[entry['codec']]])
+
+        # Paths can come back from JSON as unicode
+        names = [name.encode('utf-8') if isinstance(name, unicode) else name
+                 for name in names]
+        names_data = '\0'.join(names)
+
+        counts = [len(names_data), len(codecs), len(self._entries)]
+
+        return util.pack_varints(counts) + names_data + \
+            util.pack_varints(values) + \
+            ''.join(entry['digest'] for entry in self._entries)
+
+
+class ArchiveReader(object):
+    """
+    Reads an indexed archive, only the header and metadata are read up front
+    and the index the first time it's needed.  No file is kept open between
+    calls.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._by_name = None
+
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+
+            if len(header) < HEADER.size or not header.startswith(MAGIC):
+                raise Exception('Not an indexed package archive: ' + path)
+
+            magic, version, metadata_offset, metadata_size, \
+                self._index_offset, self._index_size = HEADER.unpack(header)
+
+            if version != VERSION:
+                args = (version, path)
+                raise Exception('Unknown archive version %d: %s' % args)
+
+            f.seek(metadata_offset)
+            self._metadata = self._unpack_metadata(f.read(metadata_size))
+
+
+    def metadata(self, name):
+        """
+        Returns the string stored in the metadata block under name.
+        """
+
+        return self._metadata[name]
+
+
+    @property
+    def entries(self):
+        """
+        The list of Entry objects for all the files, in the archive order.
+        """
+
+        if self._entries is None:
+            with open(self.path, 'rb') as f:
+                f.seek(self._index_offset)
+                index = f.read(self._index_size)
+
+            self._entries = self._unpack_index(index)
+            self._by_name = dict((e.name, e) for e in self._entries)
+
+        return self._entries
+
+
+    def entry(self, name):
+        """
+        Returns the Entry with the given name.
+        """
+
+        self.entries
+
+        if not name in self._by_name:
+            raise Exception('No file "%s" in %s' % (name, self.path))
+
+        return self._by_name[name]
+
+
+    def read(self, name):
+        """
+        Returns the contents of the named file (or the target of a symlink).
+        """
+
+        entry = self.entry(name)
+
+        if entry.link is not None:
+            return entry.link
+
+        output = StringIO()
+
+        with open(self.path, 'rb') as f:
+            self._copy(f, entry, output)
+
+        return output.getvalue()
+
+
+    def extract(self, name, dest_dir):
+        """
+        Extracts the named file into dest_dir, keeping its path.
+        """
+
+        with open(self.path, 'rb') as f:
+            self._extract(f, self.entry(name), dest_dir)
+
+
+    def extract_all(self, dest_dir, threads=None):
+        """
+        Extracts every file into dest_dir, spread over a pool of threads.
+        """
+
+        entries = self.entries
+
+        # Make the directories up front, so the threads don't race on them
+        for dir_path in sorted(set(os.path.dirname(e.name) for e in entries)):
+            util.ensure_dir(os.path.join(dest_dir, dir_path))
+
+        if threads is None:
+            threads = util.cpu_count()
+
+        if threads <= 1 or len(entries) <= 1:
+            with open(self.path, 'rb') as f:
+                for entry in entries:
+                    self._extract(f, entry, dest_dir)
+
+            return
+
+        def extract_entries(chunk):
+            with open(self.path, 'rb') as f:
+                for entry in chunk:
+                    self._extract(f, entry, dest_dir)
+
+        # Every thread gets its own file handle, and a slice of the files
+        chunks = [entries[i::threads] for i in xrange(threads)]
+
+        pool = ThreadPool(threads)
+
+        try:
+            pool.map(extract_entries, chunks)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def _extract(self, f, entry, dest_dir):
+        """
+        Extracts the entry into dest_dir, using the open archive file f.
+        """
+
+        dest_path = os.path.join(dest_dir, entry.name)
+        util.ensure_dir(os.path.dirname(dest_path))
+
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+
+        if entry.link is not None:
+            os.symlink(entry.link, dest_path)
+            return
+
+        with open(dest_path, 'wb') as output:
+            self._copy(f, entry, output)
+
+        os.chmod(dest_path, entry.mode)
+        os.utime(dest_path, (entry.mtime, entry.mtime))
+
+
+    def _copy(self, f, entry, output):
+        """
+        Decompresses the entry's contents from the open archive file f into
+        the output file, checking they are intact.
+        """
+
+        hash_state = hashlib.sha256()
+        size = 0
+
+        if entry.stored_size > 0:
+            f.seek(entry.offset)
+
+            codec = compression.lookup(entry.codec)
+            stream = codec.open(_Section(f, entry.stored_size))
+
+            while True:
+                data = stream.read(compression.READ_SIZE)
+
+                if not data:
+                    break
+
+                hash_state.update(data)
+                output.write(data)
+                size += len(data)
+
+        if size != entry.size or hash_state.digest() != entry.digest:
+            args = (entry.name, self.path)
+            raise Exception('Corrupt file "%s" in %s' % args)
+
+
+    def _unpack_metadata(self, data):
+        (names_len, count), pos = util.unpack_varints(data, 0, 2)
+
+        names = data[pos:pos + names_len].split('\0') if count else []
+        sizes, pos = util.unpack_varints(data, pos + names_len, count)
+
+        metadata = {}
+
+        for name, size in zip(names, sizes):
+            metadata[name] = data[pos:pos + size]
+            pos += size
+
+        return metadata
+
+
+    def _unpack_index(self, data):
+        (names_len, codec_count, count), pos = util.unpack_varints(data, 0, 3)
+
+        names = iter(data[pos:pos + names_len].split('\0'))
+        codecs = [next(names) for i in xrange(codec_count)]
+
+        values, pos = util.unpack_varints(data, pos + names_len, count * 7)
+        values = iter(values)
+
+        entries = []
+
+        for i in xrange(count):
+            name = next(names)
+            link = next(names) if next(values) else None
+
+            mode, mtime, offset, stored_size, size, codec_id = \
+                [next(values) for j in xrange(6)]
+
+            digest = data[pos:pos + DIGEST_SIZE]
+            pos += DIGEST_SIZE
+
+            entries.append(Entry(name, link, mode, mtime, offset, stored_size,
+                                 size, codecs[codec_id], digest))
+
+        return entries
+
+
+class _Section(object):
+    """
+    A read only file object for size bytes from the current position of
+    another file object.
+    """
+
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self._remaining = size
+
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+
+        data = self._fileobj.read(size)
+        self._remaining -= len(data)
+
+        return data
+
+
+    def close(self):
+        pass
+
@@ -1,17 +1,28 @@
 # Author: Joseph Lisee <jlisee@gmail.com>
 
 # Python Imports
+import errno
+import fcntl
 import hashlib
+import json
+import mmap
+import multiprocessing
 import os
 import platform
 import re
 import shutil
+import signal
+import stat
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
+import time
 
 # Project Imports
+from xpkg import archive
+from xpkg import compression
 from xpkg import linux
 from xpkg import paths
 from xpkg import util
@@ -23,49 +34,58 @@ def fetch_file(filehash, url):
     Download the desired URL with the given hash
     """
 
-    # Make sure cache exists
-    cache_dir = os.path.expanduser(os.path.join('~', '.xpkg', 'cache'))
+    # Get the path where the file will be placed in our cache
+    cache_path = source_cache_path(filehash)
+
+    # See if we need to download the file, it's mostly ok to verify the hash
+    # of the existing file because we need to read the file off disk to unpack
+    # it and the OS will cache it.
+    download_file = not source_file_valid(filehash, cache_path)
+
+    # Download if needed
+    if download_file:
+        p = util.fetch_url(url, cache_path)
+        print url,p
+
+    return cache_path
+
+
+def source_cache_path(filehash):
+    """
+    Returns the path the source file with the given hash is cached at, making
+    sure the cache exists.
+    """
+
+    cache_dir = paths.source_cache_dir()
 
     if not os.path.exists(cache_dir):
         os.makedirs(cache_dir)
 
-    # Get the path where the file will be placed in our cache
-    cache_path = os.path.join(cache_dir, filehash)
-
-    # See if we need to download the file
-    download_file = not os.path.exists(cache_path)
+    return os.path.join(cache_dir, filehash)
 
-    if os.path.exists(cache_path):
-        # Lets verify the hash of the existing file, it's mostly ok to do this
-        # because we need to read the file off disk to unpack it and the OS will
-        # cache it.
 
-        # Get the hash types
-        valid_types = set(['md5', 'sha1', 'sha224', 'sha256', 'sha384',
-                           'sha512'])
+def source_file_valid(filehash, path):
+    """
+    Returns true if the file exists and has the given hash, which is of the
+    form: <hash type>-<hex hash>
+    """
 
-        # Get the information we need to do the hashing
-        hash_typename, hex_hash = filehash.split('-')
+    if not os.path.exists(path):
+        return False
 
-        hash_type = getattr(hashlib, hash_typename)
+    # Get the information we need to do the hashing
+    hash_typename, hex_hash = filehash.split('-')
 
-        current_hash = util.hash_file(open(cache_path),
-                                      hash_type=hash_type)
+    hash_type = getattr(hashlib, hash_typename)
 
-        # Check if the hashes don't match and if they don't make sure we can the
-        # file
-        if current_hash != hex_hash:
-            download_file = True
+    with open(path, 'rb') as f:
+        current_hash = util.hash_file(f, hash_type=hash_type)
 
-    else:
-        download_file = True
+    return current_hash == hex_hash
 
-    # Download if needed
-    if download_file:
-        p = util.fetch_url(url, cache_path)
-        print url,p
 
-    return cache_path
+# What -march=native means for each compiler, it doesn't change while we run
+_native_marches = {}
 
 
 class Toolset(object):
@@ -79,15 +99,48 @@ class Toolset(object):
     APPEND_VAR = 2
     PREPEND_VAR = 3
 
-    def __init__(self, name, pkg_info, env_vars = None):
+    # Compiler variables we wrap with the compiler cache, and their defaults
+    # when the toolset doesn't set them
+    COMPILER_VARS = {
+        'CC' : 'cc',
+        'CXX' : 'c++',
+    }
+
+    # Variables which get the -march flag of profiles tuned for the CPU
+    MARCH_VARS = ['CFLAGS', 'CXXFLAGS', 'LDFLAGS']
+
+    # Linkers we can swap in to speed up builds, fastest first
+    FAST_LINKERS = [
+        ('ld.lld', 'lld'),
+        ('ld.gold', 'gold'),
+    ]
+
+    def __init__(self, name, pkg_info, env_vars = None, compiler_cache=False,
+                 profile=None, march=None):
         self.name = name
         self.build_deps = pkg_info
+        self.compiler_cache = compiler_cache
+
+        # Make sure we know about the performance profile
+        if not (profile is None or profile in PerformanceProfiles):
+            raise Exception("Can't find performance profile '%s'" % profile)
+
+        self.profile = profile
 
         if env_vars is None:
             self.env_vars = {}
         else:
             self.env_vars = env_vars
 
+        # Profiles which tune for the build machine get its CPU worked out
+        # now, so it's part of the toolset, and so the build inputs, and
+        # builds done elsewhere (farm, executor) target the same CPU
+        if march is None and profile and \
+           PerformanceProfiles[profile].get('native-arch', False):
+            march = self.native_march()
+
+        self.march = march
+
 
     def to_dict(self):
         """
@@ -96,7 +149,10 @@ class Toolset(object):
         return {
             'name' : self.name,
             'build-deps' : self.build_deps,
-            'env-vars' : self.env_vars
+            'env-vars' : self.env_vars,
+            'compiler-cache' : self.compiler_cache,
+            'profile' : self.profile,
+            'march' : self.march,
         }
 
 
@@ -139,15 +195,61 @@ class Toolset(object):
 
             vars_by_action.setdefault(action, {})[varname] = value
 
+        # Note the flags from our performance profile
+        if self.profile:
+            profile = PerformanceProfiles[self.profile]
+
+            for varname, inputs in profile['env-vars'].iteritems():
+                value, method = inputs
+                action = 'profile-' + actions_table[method]
+
+                vars_by_action.setdefault(action, {})[varname] = value
+
+            if self.march:
+                for varname in self.MARCH_VARS:
+                    vars_by_action.setdefault('profile-arch', {})[varname] = \
+                        '-march=%s' % self.march
+
+            if profile.get('fast-linker', False):
+                linkers = ' or '.join(l for _, l in self.FAST_LINKERS)
+                vars_by_action.setdefault('profile-linker', {})['LDFLAGS'] = \
+                    '-fuse-ld=(%s)' % linkers
+
+        # Note the compiler wrapping done for the compiler cache
+        if self.compiler_cache:
+            for varname in self.COMPILER_VARS:
+                vars_by_action.setdefault('wrap', {})[varname] = 'ccache'
+
         return vars_by_action
 
 
-    def apply_env_vars(self, subs):
+    def apply_env_vars(self, subs, env=None):
         """
-        Apply the configured environment vars to our current environment
+        Apply the configured environment vars to the given env dict, by
+        default our current environment.
         """
 
-        for varname, inputs in self.env_vars.iteritems():
+        if env is None:
+            env = os.environ
+
+        self._apply_vars(self.env_vars, subs, env)
+
+        # Add the flags for our performance profile on top
+        if self.profile:
+            self._apply_profile(env)
+
+        # Route the compilers through the compiler cache if we have one
+        if self.compiler_cache:
+            self._apply_compiler_cache(env)
+
+
+    def _apply_vars(self, env_vars, subs, env):
+        """
+        Apply the given variables, in the same form as our env_vars, to the
+        env dict.
+        """
+
+        for varname, inputs in env_vars.iteritems():
             raw_value, method = inputs
 
             # Sub the value
@@ -157,13 +259,153 @@ class Toolset(object):
             if method == self.REPLACE_VAR:
                 new_value = value
             elif method == self.APPEND_VAR:
-                new_value = os.environ.get(varname, '') + value
-            elif method == PREPEND_VAR:
-                new_value = value + os.environ.get(varname, '')
+                new_value = env.get(varname, '') + value
+            elif method == self.PREPEND_VAR:
+                new_value = value + env.get(varname, '')
             else:
                 raise Exception('Invalid method!')
 
-            os.environ[varname] = new_value
+            env[varname] = new_value
+
+
+    def _apply_profile(self, env):
+        """
+        Applies the compiler and linker flags of our performance profile to
+        the env dict.
+        """
+
+        profile = PerformanceProfiles[self.profile]
+
+        self._apply_vars(profile['env-vars'], {}, env)
+
+        # Tune for the CPU we worked out when the toolset was made
+        if self.march:
+            for varname in self.MARCH_VARS:
+                env[varname] = env.get(varname, '') + ' -march=' + self.march
+
+        # Use the fastest linker we can find
+        if profile.get('fast-linker', False):
+            linker = self.find_fast_linker(env)
+
+            if linker:
+                env['LDFLAGS'] = env.get('LDFLAGS', '') + ' -fuse-ld=' + linker
+            else:
+                # TODO: LOG THIS
+                print 'WARNING: no fast linker found, using the default'
+
+
+    def native_march(self):
+        """
+        Returns the CPU the compiler picks for -march=native on this machine,
+        like 'skylake', or None if the compiler won't tell us.
+        """
+
+        # Use the C compiler the toolset sets, if it's a plain one
+        compiler, method = self.env_vars.get('CC', (None, None))
+
+        if method != self.REPLACE_VAR or '%' in compiler:
+            compiler = self.COMPILER_VARS['CC']
+
+        if not compiler in _native_marches:
+            cmd = compiler.split() + ['-march=native', '-Q', '--help=target']
+
+            try:
+                with open(os.devnull, 'w') as devnull:
+                    output = subprocess.check_output(cmd, stderr=devnull)
+            except (OSError, subprocess.CalledProcessError):
+                output = ''
+
+            march = None
+
+            for line in output.splitlines():
+                parts = line.split()
+
+                if len(parts) == 2 and parts[0] == '-march=' and \
+                   parts[1] != 'native':
+                    march = parts[1]
+
+            _native_marches[compiler] = march
+
+        return _native_marches[compiler]
+
+
+    def find_fast_linker(self, env=None):
+        """
+        Returns the name of the fastest linker in the PATH of the given env
+        dict (by default the current one), for use with -fuse-ld, or None if
+        there is none.
+        """
+
+        for program, name in self.FAST_LINKERS:
+            if util.find_executable(program, env):
+                return name
+
+        return None
+
+
+    def _apply_compiler_cache(self, env):
+        """
+        Wraps the compilers in the env dict with ccache, and points it at the
+        cache directory shared by all environments.
+        """
+
+        # Only wrap when we can actually find ccache
+        if self.find_compiler_cache(env) is None:
+            # TODO: LOG THIS
+            print 'WARNING: compiler cache enabled, but ccache not found'
+            return
+
+        for varname, default in self.COMPILER_VARS.iteritems():
+            compiler = env.get(varname, default)
+
+            if not compiler.startswith('ccache '):
+                env[varname] = 'ccache ' + compiler
+
+        # Share the cache across environments unless the user picked one
+        if not 'CCACHE_DIR' in env:
+            env['CCACHE_DIR'] = paths.compiler_cache_dir()
+
+
+    def find_compiler_cache(self, env=None):
+        """
+        Returns the path to the ccache executable in the PATH of the given env
+        dict (by default the current one), None if the compiler cache is
+        disabled or ccache can't be found.
+        """
+
+        if not self.compiler_cache:
+            return None
+
+        return util.find_executable('ccache', env)
+
+
+    @staticmethod
+    def compiler_cache_stats(stats_log):
+        """
+        Returns a dict of the compiler cache 'hits' and 'misses' recorded in
+        the given ccache stats log (see CCACHE_STATSLOG), None if nothing was
+        recorded.  Every compile adds a '#' comment line naming the file,
+        then a line for each counter it bumped.
+        """
+
+        if not os.path.exists(stats_log):
+            return None
+
+        hit_keys = set(['direct_cache_hit', 'preprocessed_cache_hit'])
+        miss_keys = set(['cache_miss'])
+
+        stats = {'hits' : 0, 'misses' : 0}
+
+        with open(stats_log) as f:
+            for line in f:
+                line = line.strip()
+
+                if line in hit_keys:
+                    stats['hits'] += 1
+                elif line in miss_keys:
+                    stats['misses'] += 1
+
+        return stats
 
 
     @staticmethod
@@ -173,7 +415,10 @@ class Toolset(object):
         """
         return Toolset(name=d['name'],
                        pkg_info=d['build-deps'],
-                       env_vars=d['env-vars'])
+                       env_vars=d['env-vars'],
+                       compiler_cache=d.get('compiler-cache', False),
+                       profile=d.get('profile', None),
+                       march=d.get('march', None))
 
 
     @staticmethod
@@ -207,6 +452,30 @@ class LocalToolset(Toolset):
 # Sets up dynamic linker to point to our indirection path
 LD_VAR = (' -Wl,--dynamic-linker=%(LD_SO_PATH)s', Toolset.APPEND_VAR)
 
+# Compiler and linker flags applied on top of a toolset, in the same form as
+# the toolset env vars, to get faster builds or faster programs
+PerformanceProfiles = {
+    # Quick to compile and link, but slower and harder to debug results
+    'build-speed' : {
+        'env-vars' : {
+            'CFLAGS' : (' -pipe -g0', Toolset.APPEND_VAR),
+            'CXXFLAGS' : (' -pipe -g0', Toolset.APPEND_VAR),
+        },
+        'fast-linker' : True,
+    },
+
+    # Slow to build, with programs optimized for the CPU of the machine the
+    # toolset was set up on
+    'runtime-speed' : {
+        'env-vars' : {
+            'CFLAGS' : (' -O3 -flto', Toolset.APPEND_VAR),
+            'CXXFLAGS' : (' -O3 -flto', Toolset.APPEND_VAR),
+            'LDFLAGS' : (' -O3 -flto', Toolset.APPEND_VAR),
+        },
+        'native-arch' : True,
+    },
+}
+
 # Default GNU toolset
 GNUToolset = Toolset(
     'GNU',
@@ -249,232 +518,1253 @@ BuiltInToolsets = {
 DefaultToolsetName = 'local'
 
 
-class PackageBuilder(object):
+def build_input_hash(xpd, toolset=None, deps=None, package_settings=None):
     """
-    Assuming all the dependency conditions for the XPD are met, this builds
-    and install the a package based on it's XPD into the target directory.
+    Hash of everything that goes into a build, the package description itself,
+    the toolset it's built with, the versions of the packages it's built
+    against (a dict of name to version), and how the results are packaged (see
+    BinaryPackageBuilder.package_settings).  The source files are covered by
+    the hashes in the description.
     """
 
-    def __init__(self, package_xpd):
-        self._xpd = package_xpd
-        self._work_dir = None
-        self._target_dir = None
-        self._output = None
+    inputs = {
+        'xpd' : xpd._data,
+    }
 
+    if toolset:
+        inputs['toolset'] = toolset.to_dict()
 
-    def build(self, target_dir, environment = None, output_to_file=True):
-        """
-        Right now this just executes instructions inside the XPD, but in the
-        future we can make this a little smarter.
+    if deps:
+        inputs['deps'] = deps
 
-        It returns the info structure for the created package.  See the XPA
-        class for the structure of the data returned.
-        """
+    if package_settings:
+        inputs['package'] = package_settings
 
-        # Create our temporary directory
-        self._work_dir = tempfile.mkdtemp(suffix = '-xpkg-' + self._xpd.name)
+    return util.hash_string(json.dumps(inputs, sort_keys=True, default=str))
 
-        # TODO: LOG THIS
-        print 'Working in:',self._work_dir
 
-        # Create our output
-        if output_to_file:
-            # Form a hopefully unique name for the output file
-            args = (self._xpd.name, self._xpd.version)
-            output_file = '%s-%s_build.log' % args
+class SharedBuilds(object):
+    """
+    A directory of built packages shared by every environment on the host,
+    keyed by build input hash.  Each build holds a lock on its hash, so when
+    two processes want the same package one builds it and the other waits
+    then uses the result.
 
-            # Put the file in our environment if we have, or the current
-            # directory
-            if environment:
-                # Find out log dir
-                log_dir = environment.log_dir(environment.root)
+    The layout of the directory is:
 
-                # Make sure it exists
-                util.ensure_dir(log_dir)
+      <hash>.lock - lock file for the build
+      <hash>/packages.yml - list of the package files, written last
+      <hash>/<package>.xpa - the built packages
+    """
 
-                # Now finally commit to our path
-                output_path = os.path.join(log_dir, output_file)
-            else:
-                output_path = os.path.abspath(os.path.join('.', output_file))
+    MANIFEST = 'packages.yml'
 
-            # TODO: LOG THIS
-            print 'Log file:',output_path
+    def __init__(self, root):
+        self.root = root
 
-            # Open our file for writing
-            self._output = open(output_path, 'w')
-        else:
-            self._output = None
 
-        # Store our target dir
-        self._target_dir = target_dir
-        util.ensure_dir(self._target_dir)
+    def build(self, input_hash, build_func):
+        """
+        Returns the paths to the packages built for the given input hash,
+        first calling build_func with the directory to put them in if nobody
+        has built them yet.  The build_func must return the package paths.
+        """
 
-        # Determine our environment directory
-        if environment:
-            self._env_dir = environment._env_dir
-        else:
-            self._env_dir = ''
+        # Most of the time it's already built, or nobody is building it
+        paths = self._lookup(input_hash)
 
-        # Setup the ld.so symlink in the target dir pointing to either
-        # the system ld.so, or the current environments
-        ld_target_dir = self._target_dir
-        update_root = self._env_dir if len(self._env_dir) else self._target_dir
+        if paths is not None:
+            return paths
 
-        linux.update_ld_so_symlink(update_root, ld_target_dir)
+        util.ensure_dir(self.root)
 
-        try:
-            # Store the current environment
-            env_vars = util.EnvStorage(store = True)
+        lock_path = os.path.join(self.root, input_hash + '.lock')
 
-            # If we have an environment apply it's variables so the build can
-            # reference the libraries installed in it
-            if environment:
-                environment.apply_env_variables()
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
 
-            # Fetches and unpacks all the required sources for the package
-            self._get_sources()
+                # TODO: LOG THIS
+                print 'Waiting for another build of the same package:', \
+                    input_hash
 
-            # Determine what directory we have to do the build in
-            dirs = [d for d in os.listdir(self._work_dir) if
-                    os.path.isdir(os.path.join(self._work_dir, d))]
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
 
-            if 'build-dir' in self._xpd._data:
-                # If the user specifies a build directory use it
-                rel_build_dir = self._xpd._data['build-dir']
-                build_dir = os.path.join(self._work_dir, rel_build_dir)
+            try:
+                # See if the build we waited on worked out
+                paths = self._lookup(input_hash)
 
-                # Make sure the directory exists
-                util.ensure_dir(build_dir)
-            elif len(dirs) == 1:
-                build_dir = os.path.join(self._work_dir, dirs[0])
-            else:
-                build_dir = self._work_dir
+                if paths is None:
+                    paths = self._build(input_hash, build_func)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-            with util.cd(build_dir):
-                # Standard build configure install
-                self._configure()
+        return paths
 
-                self._build()
 
-                new_paths = self._install()
-        finally:
-            # Put back our environment
-            env_vars.restore()
+    def _lookup(self, input_hash):
+        """
+        Returns the paths of the packages for the hash, or None if they have
+        not been built.
+        """
 
-            self._env_dir = ''
+        build_dir = os.path.join(self.root, input_hash)
+        manifest_path = os.path.join(build_dir, self.MANIFEST)
 
-            # Close our output file if it exists
-            if self._output:
-                self._output.close()
-                self._output = None
+        if not os.path.exists(manifest_path):
+            return None
 
-            # Make sure we cleanup after we are done
-            shutil.rmtree(self._work_dir)
+        with open(manifest_path) as f:
+            names = util.yaml_load(f)
 
+        paths = [os.path.join(build_dir, name) for name in names]
 
-        return self._create_info(new_paths)
+        if not all(os.path.exists(p) for p in paths):
+            return None
 
+        # TODO: LOG THIS
+        print 'Using shared build:',build_dir
+
+        return paths
 
-    def _get_sources(self):
+
+    def _build(self, input_hash, build_func):
         """
-        Fetches and unpacks all the needed source files.
+        Builds the packages in a temporary directory, then moves them into
+        place so they only show up once they are complete.
         """
 
-        # Download and unpack our files
-        for filehash, info in self._xpd._data['files'].iteritems():
+        build_dir = os.path.join(self.root, input_hash)
+        temp_dir = tempfile.mkdtemp(prefix='.' + input_hash + '-',
+                                    dir=self.root)
 
-            # Translate the URL as needed, this is so we can address files
-            # (like patches) in the tree
-            base_url = info['url']
+        try:
+            paths = build_func(temp_dir)
 
-            if base_url.startswith('xpd://'):
-                # Pull out the relative file path from our URL
-                rel_path = base_url[len('xpd://'):]
+            names = [os.path.basename(p) for p in paths]
 
-                # Get the directory of our XPD
-                xpd_dir, _ = os.path.split(self._xpd.path)
+            with open(os.path.join(temp_dir, self.MANIFEST), 'w') as f:
+                util.yaml_dump(names, f)
 
-                # Build the path to the file relative to that dir
-                file_path = os.path.join(xpd_dir, rel_path)
+            # Remove the remains of any broken build
+            if os.path.exists(build_dir):
+                shutil.rmtree(build_dir)
 
-                # Build the final absolute path
-                final_url = 'file://' + os.path.abspath(file_path)
-            else:
-                final_url = base_url
+            os.rename(temp_dir, build_dir)
+        except:
+            shutil.rmtree(temp_dir)
+            raise
 
-            # Fetch our file
-            download_path = fetch_file(filehash, final_url)
+        return [os.path.join(build_dir, name) for name in names]
 
-            # Unpack or copy file
-            end_match = [final_url.endswith(e) for e in
-                         ('.tar.gz', 'tar.bz2', '.tar.xz')]
-            is_tar = reduce(lambda x,y: x | y, end_match)
 
-            if is_tar:
-                # Unpack into the working directory
-                root_dir = util.unpack_tarball(download_path, self._work_dir)
-            else:
-                # Copy the file into the working dir
-                _, file_name = os.path.split(final_url)
+class BuildCheckpoint(object):
+    """
+    Keeps track of which phases of a build have finished in a persistent build
+    directory, so that a failed build can pick up where it left off.  If the
+    build inputs change the directory is cleared and the build starts over.
 
-                dest_path = os.path.join(self._work_dir, file_name)
+    The state is stored in 'checkpoint.yml' in the root directory:
 
-                shutil.copyfile(download_path, dest_path)
+        {
+          'input_hash' : '5d41402abc4b2a76b9719d911017c592',
+          'phases' : ['fetch', 'unpack', 'configure'],
+        }
+    """
 
-            # Move if needed
-            relative_path = info.get('location', None)
+    STATE_FILE = 'checkpoint.yml'
 
-            if relative_path:
-                dst_path = os.path.join(self._work_dir, relative_path)
+    def __init__(self, root, input_hash):
+        self.root = root
+        self.work_dir = os.path.join(root, 'work')
 
-                # TODO: LOG THIS
-                print root_dir,'->',dst_path
+        self._state_path = os.path.join(root, self.STATE_FILE)
 
-                shutil.move(root_dir, dst_path)
+        # Load the previous state if there was one
+        if os.path.exists(self._state_path):
+            state = util.yaml_load(open(self._state_path))
+        else:
+            state = None
 
+        if state and state.get('input_hash', None) == input_hash:
+            self._state = state
+        else:
+            # Our inputs have changed, so throw away the old results
+            self.clear()
 
-    def _configure(self):
-        """
-        Run a configure step for the package if it has one.
-        """
+            self._state = {
+                'input_hash' : input_hash,
+                'phases' : [],
+            }
 
-        # Configure if needed
-        if 'configure' in self._xpd._data:
-            # TODO: log this
-            print 'Configuring...'
-            self._run_cmds(self._xpd._data['configure'])
+            self._save()
 
 
-    def _build(self):
+    @property
+    def phases(self):
         """
-        Builds the desired package.
+        The list of phases completed so far.
         """
-
-        # TODO: log this
-        print 'Building...'
-        self._run_cmds(self._xpd._data['build'])
+        return self._state['phases']
 
 
-    def _install(self):
+    def done(self, phase):
         """
-        Installs the package, keeping track of what files it creates.
+        Returns true if the given phase has already been completed.
         """
+        return phase in self._state['phases']
 
-        # TODO: log this
-        print 'Installing...'
 
-        pre_paths = set(util.list_files(self._target_dir))
+    def mark_done(self, phase, **data):
+        """
+        Records the phase as complete, along with any extra data needed to
+        resume after it.
+        """
 
-        self._run_cmds(self._xpd._data['install'])
+        self._state['phases'].append(phase)
+        self._state.update(data)
 
-        post_paths = set(util.list_files(self._target_dir))
+        self._save()
 
-        new_paths = post_paths - pre_paths
 
-        return new_paths
+    def get(self, key, default=None):
+        """
+        Returns extra data stored with a phase.
+        """
+        return self._state.get(key, default)
 
 
-    def _run_cmds(self, raw):
+    def clear(self):
+        """
+        Removes the build directory and everything in it.
+        """
+
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+
+
+    def _save(self):
+        util.ensure_dir(self.root)
+
+        with open(self._state_path, 'w') as f:
+            util.yaml_dump(self._state, f)
+
+
+# Resource usage fields we record for a build, and how to combine them
+USAGE_FIELDS = [
+    ('user_cpu', 'ru_utime', sum),
+    ('sys_cpu', 'ru_stime', sum),
+    ('max_rss_kb', 'ru_maxrss', max),
+    ('block_in', 'ru_inblock', sum),
+    ('block_out', 'ru_oublock', sum),
+    ('voluntary_switches', 'ru_nvcsw', sum),
+    ('involuntary_switches', 'ru_nivcsw', sum),
+]
+
+
+def empty_usage():
+    """
+    Resource usage of nothing at all.
+    """
+    return dict((name, 0) for name, _, _ in USAGE_FIELDS)
+
+
+def add_usage(a, b):
+    """
+    Combine two resource usage dicts.
+    """
+    return dict((name, combine([a[name], b[name]]))
+                for name, _, combine in USAGE_FIELDS)
+
+
+def wait_with_usage(proc):
+    """
+    Waits for the subprocess.Popen process to finish, returning its exit code
+    and the resources used by it and all of its children, as a dict:
+
+      {
+        'user_cpu' : 10.2,
+        'sys_cpu' : 1.5,
+        'max_rss_kb' : 104252,
+        'block_in' : 0,
+        'block_out' : 4096,
+        'voluntary_switches' : 1200,
+        'involuntary_switches' : 80,
+      }
+    """
+
+    while True:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+    # Let the Popen object know we have it's exit code
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    usage = dict((name, getattr(rusage, field))
+                 for name, field, _ in USAGE_FIELDS)
+
+    return proc.returncode, usage
+
+
+# Environment variables giving the default limits, in seconds, for every build
+# phase and for how long a build command can go without output
+PHASE_TIMEOUT_VAR = 'XPKG_PHASE_TIMEOUT'
+STALL_TIMEOUT_VAR = 'XPKG_STALL_TIMEOUT'
+
+
+def start_new_group():
+    """
+    Puts a child process in its own process group (as a preexec_fn), so it
+    and everything it starts can be killed together.
+    """
+    os.setsid()
+
+
+def close_fds_except(keep):
+    """
+    Closes every descriptor above stderr apart from keep (as part of a
+    preexec_fn), so a child started with close_fds=False doesn't hold open
+    pipes belonging to builds in other threads.  Descriptors marked close on
+    exec are left alone, exec closes them itself, which keeps the pipe
+    subprocess reports exec errors through working.
+    """
+
+    if os.path.exists('/proc/self/fd'):
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    else:
+        fds = xrange(3, subprocess.MAXFD)
+
+    for fd in fds:
+        if fd < 3 or fd == keep:
+            continue
+
+        try:
+            if not fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC:
+                os.close(fd)
+        except (IOError, OSError):
+            # Already closed, like the one listdir used
+            pass
+
+
+def kill_group(proc):
+    """
+    Kills the process group lead by the given subprocess.Popen process.
+    """
+
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+class Watchdog(object):
+    """
+    Watches a running process, killing its whole process group if it runs
+    past the deadline (a time.time() value), or its output file doesn't grow
+    for stall_timeout seconds.  Example:
+
+        with Watchdog(proc, log_file, deadline=time.time() + 60) as watchdog:
+            proc.wait()
+
+        if watchdog.reason:
+            print 'Killed:', watchdog.reason
+
+    Output which isn't a regular file, like a terminal, can't be watched for
+    stalls.
+    """
+
+    # How often we check on the process
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, proc, output=None, deadline=None, stall_timeout=None):
+        self._proc = proc
+        self._output = output
+        self._deadline = deadline
+        self._stall_timeout = stall_timeout
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Why we killed the process, None if we haven't
+        self.reason = None
+
+        if output is None or \
+           not stat.S_ISREG(os.fstat(output.fileno()).st_mode):
+            self._stall_timeout = None
+
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+
+    def _watch(self):
+        last_size = None
+        last_change = time.time()
+
+        while not self._stop.wait(self.POLL_INTERVAL):
+            now = time.time()
+
+            if self._stall_timeout:
+                size = os.fstat(self._output.fileno()).st_size
+
+                if size != last_size:
+                    last_size = size
+                    last_change = now
+
+            if self._deadline and now > self._deadline:
+                self.reason = 'timed out'
+            elif self._stall_timeout and \
+                 now - last_change > self._stall_timeout:
+                self.reason = 'no output for %gs' % self._stall_timeout
+
+            if self.reason:
+                kill_group(self._proc)
+                return
+
+
+class ShellSession(object):
+    """
+    A long running shell which runs a series of commands, so the shell is only
+    started once and state like the current directory and exported variables
+    carries between commands.  Example:
+
+        with ShellSession(log_file) as session:
+            session.run('cd src')
+            session.run('make')
+
+    Each command has its exit status checked, throwing a CalledProcessError
+    on failure, and its run time written to the output.  The shell starts in
+    the cwd directory with the env dict as its environment, by default our
+    own.
+    """
+
+    # Descriptor the shell writes command exit statuses to
+    STATUS_FD = 9
+
+    def __init__(self, output=None, shell='/bin/sh', env=None, cwd=None):
+        # Determine where our output goes
+        if output:
+            self._stdout = output
+            self._stderr = output
+        else:
+            self._stdout = sys.stdout
+            self._stderr = sys.stderr
+
+        # The shell reports the exit status of each command through this pipe
+        status_read, status_write = os.pipe()
+
+        # The shell can only redirect to single digit descriptors, so move
+        # the pipe onto a known one in the shell
+        def setup_status():
+            start_new_group()
+
+            os.close(status_read)
+
+            if status_write != self.STATUS_FD:
+                os.dup2(status_write, self.STATUS_FD)
+                os.close(status_write)
+
+            # close_fds would take our status pipe along with everything else
+            close_fds_except(self.STATUS_FD)
+
+        self._stdout.flush()
+        self._stderr.flush()
+
+        self._proc = subprocess.Popen([shell], stdin=subprocess.PIPE,
+                                      stdout=self._stdout, stderr=self._stderr,
+                                      close_fds=False, env=env, cwd=cwd,
+                                      preexec_fn=setup_status)
+
+        os.close(status_write)
+
+        self._status_fd = self.STATUS_FD
+        self._status = os.fdopen(status_read)
+
+        # Resources used by the shell and its commands, set once it exits
+        self.usage = None
+
+
+    @property
+    def pid(self):
+        return self._proc.pid
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def run(self, cmd):
+        """
+        Runs the command in our shell, and waits for it to finish.
+        """
+
+        # Describe our command
+        self._stdout.write('[cmd] {0}\n'.format(cmd))
+        self._stdout.flush()
+        self._stderr.flush()
+
+        # Run the command in the current shell with no input (stdin is our
+        # command stream) and without our status pipe, then report back
+        script = '{ %s\n} < /dev/null %d>&-\necho $? >&%d\n'
+        start = time.time()
+
+        try:
+            self._proc.stdin.write(script % (cmd, self._status_fd,
+                                             self._status_fd))
+            self._proc.stdin.flush()
+
+            status = self._status.readline()
+        except IOError:
+            status = ''
+
+        elapsed = time.time() - start
+
+        self._stdout.write('[time] %.2fs\n' % elapsed)
+        self._stdout.flush()
+
+        # If we got nothing back the shell itself has exited, which means the
+        # rest of our commands won't run
+        if len(status) == 0:
+            returncode = self._wait()
+
+            if returncode == 0:
+                msg = 'Shell session exited while running: %s' % cmd
+                raise Exception(msg)
+        else:
+            returncode = int(status)
+
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+
+    def close(self):
+        """
+        Shuts down the shell.
+        """
+
+        try:
+            self._proc.stdin.close()
+        except IOError:
+            pass
+
+        if self._proc.returncode is None:
+            self._wait()
+
+        self._status.close()
+
+
+    def kill(self):
+        """
+        Kills the shell and everything running in it.
+        """
+
+        kill_group(self._proc)
+
+
+    def _wait(self):
+        """
+        Wait for the shell to exit, recording the resources it used.
+        """
+
+        returncode, self.usage = wait_with_usage(self._proc)
+
+        return returncode
+
+
+class PackageBuilder(object):
+    """
+    Assuming all the dependency conditions for the XPD are met, this builds
+    and install the a package based on it's XPD into the target directory.
+    """
+
+    # Lines of the log to report when a command is killed
+    TAIL_LINES = 20
+
+    def __init__(self, package_xpd):
+        self._xpd = package_xpd
+        self._work_dir = None
+        self._target_dir = None
+        self._output = None
+        self._autoconf_lock = None
+        self._checkpoint = None
+        self._downloads = {}
+        self._staged = False
+        self._pre_paths = None
+        self._destdir = ''
+        self._build_stats = {}
+        self._usage = empty_usage()
+        self._env = None
+        self._build_dir = None
+        self._deadline = None
+        self._stall_timeout = None
+
+
+    def build(self, target_dir, environment = None, output_to_file=True,
+              checkpoint=None, defer_check=False, work_dir=None):
+        """
+        Right now this just executes instructions inside the XPD, but in the
+        future we can make this a little smarter.
+
+          checkpoint - a BuildCheckpoint, when given the work directory is kept
+                       on failure and finished phases are skipped on re-run
+          work_dir - build in this directory instead of a temporary one, it's
+                     removed afterwards unless there is a checkpoint
+          defer_check - don't run the check phase after install, instead keep
+                        the build around for start_check and finish_check
+
+        It returns the info structure for the created package.  See the XPA
+        class for the structure of the data returned.
+        """
+
+        self._checkpoint = checkpoint
+        self._build_stats = {}
+        self._check_thread = None
+        self._check_error = None
+
+        # The command (process or ShellSession) we are running, so a cancelled
+        # check can be killed
+        self._running = None
+        self._cancelled = False
+
+        # Create our temporary directory, or re-use our checkpointed one
+        if checkpoint:
+            self._work_dir = checkpoint.work_dir
+            util.ensure_dir(self._work_dir)
+        elif work_dir:
+            self._work_dir = work_dir
+            util.ensure_dir(self._work_dir)
+        else:
+            self._work_dir = tempfile.mkdtemp(suffix = '-xpkg-' + self._xpd.name)
+
+        # TODO: LOG THIS
+        print 'Working in:',self._work_dir
+
+        # Create our output
+        if output_to_file:
+            # Form a hopefully unique name for the output file
+            args = (self._xpd.name, self._xpd.version)
+            output_file = '%s-%s_build.log' % args
+
+            # Put the file in our environment if we have, or the current
+            # directory
+            if environment:
+                # Find out log dir
+                log_dir = environment.log_dir(environment.root)
+
+                # Make sure it exists
+                util.ensure_dir(log_dir)
+
+                # Now finally commit to our path
+                output_path = os.path.join(log_dir, output_file)
+            else:
+                output_path = os.path.abspath(os.path.join('.', output_file))
+
+            # TODO: LOG THIS
+            print 'Log file:',output_path
+
+            # Open our file for writing, keeping the log of the previous
+            # attempt when we are resuming
+            resuming = checkpoint and len(checkpoint.phases) > 0
+
+            self._output = open(output_path, 'a' if resuming else 'w')
+        else:
+            self._output = None
+
+        # Note where we are picking up from
+        if checkpoint and len(checkpoint.phases) > 0:
+            output = self._output if self._output else sys.stdout
+            output.write('[resume] finished phases: %s\n' %
+                         ', '.join(checkpoint.phases))
+            output.flush()
+
+        # Store our target dir
+        self._target_dir = target_dir
+        util.ensure_dir(self._target_dir)
+
+        # When the target already has files in it (like an environment) we
+        # install through a staging directory, so we never have to scan it.
+        # Plenty of installs write straight to the prefix, so the XPD has to
+        # say its install only writes under DESTDIR.
+        populated = len(os.listdir(self._target_dir)) > 0
+        use_destdir = self._xpd._data.get('install-destdir', False)
+
+        self._staged = populated and use_destdir
+
+        # Determine our environment directory
+        if environment:
+            self._env_dir = environment._env_dir
+        else:
+            self._env_dir = ''
+
+        # Setup the ld.so symlink in the target dir pointing to either
+        # the system ld.so, or the current environments
+        ld_target_dir = self._target_dir
+        update_root = self._env_dir if len(self._env_dir) else self._target_dir
+
+        linux.update_ld_so_symlink(update_root, ld_target_dir)
+
+        # An empty target only holds our ld.so link, so this is cheap
+        if populated:
+            self._pre_paths = None
+        else:
+            self._pre_paths = set(util.list_files(self._target_dir))
+
+        success = False
+
+        try:
+            # Our commands run with their own copy of the environment, so we
+            # never touch the environment of our process (or other builds)
+            self._env = dict(os.environ)
+
+            # If we have an environment apply it's variables so the build can
+            # reference the libraries installed in it
+            if environment:
+                # Programs use the ld.so link in the target, so the path gets
+                # relocated along with the rest of the package
+                environment.apply_env_variables(env=self._env,
+                                                ld_so_root=self._target_dir)
+
+                # Point configure scripts at the shared cache, if on
+                config_site, self._autoconf_lock = \
+                    environment.autoconf_config_site()
+
+                if config_site:
+                    self._env['CONFIG_SITE'] = config_site
+
+                # Have the compiler cache log just this build's results, the
+                # cache counters are shared with every other build
+                if environment.toolset.find_compiler_cache(self._env):
+                    stats_log = os.path.join(self._work_dir, 'ccache-stats.log')
+                    self._env['CCACHE_STATSLOG'] = stats_log
+                else:
+                    stats_log = None
+            else:
+                stats_log = None
+
+            # Fetches and unpacks all the required sources for the package
+            self._run_phase('fetch', self._fetch_sources)
+
+            self._run_phase('unpack', self._unpack_sources)
+
+            # Determine what directory we have to do the build in
+            dirs = [d for d in os.listdir(self._work_dir) if
+                    os.path.isdir(os.path.join(self._work_dir, d))]
+
+            if 'build-dir' in self._xpd._data:
+                # If the user specifies a build directory use it
+                rel_build_dir = self._xpd._data['build-dir']
+                build_dir = os.path.join(self._work_dir, rel_build_dir)
+
+                # Make sure the directory exists
+                util.ensure_dir(build_dir)
+            elif len(dirs) == 1:
+                build_dir = os.path.join(self._work_dir, dirs[0])
+            else:
+                build_dir = self._work_dir
+
+            # Our commands run in the build directory, we don't change our
+            # own current directory
+            self._build_dir = build_dir
+
+            # Standard build configure install
+            self._run_phase('configure', self._configure)
+
+            self._run_phase('build', self._build)
+
+            new_paths = self._run_phase('install', self._install)
+
+            if new_paths is None:
+                new_paths = set(checkpoint.get('new_paths'))
+
+            # Report how well the compiler cache did
+            if stats_log:
+                self._log_cache_stats(Toolset.compiler_cache_stats(stats_log))
+
+            # Test the build now, unless our caller wants to do it later
+            if not defer_check:
+                self._run_phase('check', self._check)
+
+            info = self._create_info(new_paths)
+
+            success = True
+        finally:
+            # A deferred check needs to keep the build around
+            if not (success and defer_check):
+                self._cleanup()
+
+        return info
+
+
+    def start_check(self):
+        """
+        Start running the check phase of the deferred build in the background,
+        the build directory is no longer used by anything else so the tests
+        can run in it while we package up the installed files.
+        """
+
+        def run_check():
+            try:
+                self._run_phase('check', self._check)
+            except BaseException as e:
+                self._check_error = e
+
+        self._check_thread = threading.Thread(target=run_check)
+        self._check_thread.start()
+
+
+    def finish_check(self):
+        """
+        Waits for the check started by start_check to finish, then cleans up
+        the build.  The error from the check is raised if it failed.
+        """
+
+        try:
+            if self._check_thread:
+                self._check_thread.join()
+                self._check_thread = None
+        finally:
+            self._cleanup()
+
+        if self._check_error:
+            error = self._check_error
+            self._check_error = None
+
+            raise error
+
+
+    def cancel_check(self):
+        """
+        Stops the check started by start_check, killing whatever it's running
+        instead of waiting for it to finish, then cleans up the build.  For
+        when packaging failed, so the result of the check doesn't matter.
+        """
+
+        self._cancelled = True
+
+        running = self._running
+
+        if running:
+            kill_group(running)
+
+        try:
+            if self._check_thread:
+                self._check_thread.join()
+                self._check_thread = None
+        finally:
+            self._check_error = None
+            self._cleanup()
+
+
+    def _track(self, proc):
+        """
+        Notes the process (or ShellSession) we just started, killing it
+        straight away if we've been cancelled.
+        """
+
+        self._running = proc
+
+        if self._cancelled:
+            kill_group(proc)
+
+
+    def _cleanup(self):
+        """
+        Closes the build log and removes the build directory.
+        """
+
+        self._env_dir = ''
+        self._env = None
+        self._build_dir = None
+
+        # Close our output file if it exists
+        if self._output:
+            self._output.close()
+            self._output = None
+
+        # Let the configure cache be cleaned up once we are done with it
+        if self._autoconf_lock:
+            self._autoconf_lock.close()
+            self._autoconf_lock = None
+
+        # Make sure we cleanup after we are done, checkpointed builds
+        # are cleaned up by their owner
+        if self._checkpoint is None:
+            shutil.rmtree(self._work_dir)
+
+
+    def _run_phase(self, phase, func):
+        """
+        Runs the given build phase, unless our checkpoint says it has already
+        been completed, recording the time and resources it used.
+
+        Returns the result of the phase function, or None if it was skipped.
+        """
+
+        checkpoint = self._checkpoint
+
+        if checkpoint and checkpoint.done(phase):
+            return None
+
+        # Track the resources used by the commands in this phase
+        self._usage = empty_usage()
+        start = time.time()
+
+        # Commands are killed once past the phase's time limit, or when they
+        # stop making output
+        limit, self._stall_timeout = self._timeouts(phase)
+        self._deadline = start + limit if limit else None
+
+        result = func()
+
+        stats = dict(self._usage)
+        stats['wall_time'] = time.time() - start
+
+        self._build_stats[phase] = stats
+        self._log_stats(phase, stats)
+
+        # Record we are done, install records the files it installed so we
+        # can still package them when resumed
+        if checkpoint:
+            if phase == 'install':
+                checkpoint.mark_done(phase, new_paths=sorted(result))
+            else:
+                checkpoint.mark_done(phase)
+
+        return result
+
+
+    def _timeouts(self, phase):
+        """
+        Returns the time limit for the phase and the stall timeout in seconds,
+        None meaning no limit.  The XPD can set them with:
+
+          timeout: 3600      # for every phase, or per phase:
+          timeout:
+            build: 7200
+            check: 600
+          stall-timeout: 900
+
+        Otherwise they come from the XPKG_PHASE_TIMEOUT and XPKG_STALL_TIMEOUT
+        environment variables.
+        """
+
+        timeout = self._xpd._data.get('timeout', None)
+
+        if isinstance(timeout, dict):
+            timeout = timeout.get(phase, None)
+
+        if timeout is None:
+            timeout = os.environ.get(PHASE_TIMEOUT_VAR, None)
+
+        stall_timeout = self._xpd._data.get('stall-timeout', None)
+
+        if stall_timeout is None:
+            stall_timeout = os.environ.get(STALL_TIMEOUT_VAR, None)
+
+        return [float(t) if t else None for t in (timeout, stall_timeout)]
+
+
+    def _log_stats(self, phase, stats):
+        """
+        Writes the time and resources used by the phase to the log.
+        """
+
+        msg = '[stats] %(phase)s: wall %(wall_time).2fs, ' \
+              'user %(user_cpu).2fs, sys %(sys_cpu).2fs, ' \
+              'max rss %(max_rss_kb)d KB, ' \
+              'blocks in/out %(block_in)d/%(block_out)d, ' \
+              'context switches %(voluntary_switches)d/' \
+              '%(involuntary_switches)d\n'
+
+        args = dict(stats)
+        args['phase'] = phase
+
+        output = self._output if self._output else sys.stdout
+        output.write(msg % args)
+        output.flush()
+
+
+    def _source_urls(self):
+        """
+        Returns a list of (filehash, url, info) for every source file, with
+        the file URL translated as needed.
+        """
+
+        results = []
+
+        for filehash, info in self._xpd._data['files'].iteritems():
+
+            # Translate the URL as needed, this is so we can address files
+            # (like patches) in the tree
+            base_url = info['url']
+
+            if base_url.startswith('xpd://'):
+                # Pull out the relative file path from our URL
+                rel_path = base_url[len('xpd://'):]
+
+                # Get the directory of our XPD
+                xpd_dir, _ = os.path.split(self._xpd.path)
+
+                # Build the path to the file relative to that dir
+                file_path = os.path.join(xpd_dir, rel_path)
+
+                # Build the final absolute path
+                final_url = 'file://' + os.path.abspath(file_path)
+            else:
+                final_url = base_url
+
+            results.append((filehash, final_url, info))
+
+        return results
+
+
+    def _fetch_sources(self):
+        """
+        Downloads all the needed source files into our cache.
+        """
+
+        for filehash, final_url, info in self._source_urls():
+            self._downloads[filehash] = fetch_file(filehash, final_url)
+
+
+    def _unpack_sources(self):
+        """
+        Unpacks all the source files into the working directory.
+        """
+
+        # Clear out anything left by a failed unpack
+        if self._checkpoint and len(os.listdir(self._work_dir)) > 0:
+            shutil.rmtree(self._work_dir)
+            util.ensure_dir(self._work_dir)
+
+        for filehash, final_url, info in self._source_urls():
+            # Get our file from the cache, when resuming the fetch happened
+            # in a previous run
+            if filehash in self._downloads:
+                download_path = self._downloads[filehash]
+            else:
+                download_path = fetch_file(filehash, final_url)
+
+            # Unpack or copy file
+            end_match = [final_url.endswith(e) for e in
+                         ('.tar.gz', 'tar.bz2', '.tar.xz')]
+            is_tar = reduce(lambda x,y: x | y, end_match)
+
+            if is_tar:
+                # Unpack into the working directory
+                root_dir = util.unpack_tarball(download_path, self._work_dir)
+            else:
+                # Copy the file into the working dir
+                _, file_name = os.path.split(final_url)
+
+                dest_path = os.path.join(self._work_dir, file_name)
+
+                shutil.copyfile(download_path, dest_path)
+
+            # Move if needed
+            relative_path = info.get('location', None)
+
+            if relative_path:
+                dst_path = os.path.join(self._work_dir, relative_path)
+
+                # TODO: LOG THIS
+                print root_dir,'->',dst_path
+
+                shutil.move(root_dir, dst_path)
+
+
+    def _configure(self):
+        """
+        Run a configure step for the package if it has one.
+        """
+
+        # Configure if needed
+        if 'configure' in self._xpd._data:
+            # TODO: log this
+            print 'Configuring...'
+            self._run_cmds(self._xpd._data['configure'])
+
+
+    def _build(self):
+        """
+        Builds the desired package.
+        """
+
+        # TODO: log this
+        print 'Building...'
+        self._run_cmds(self._xpd._data['build'])
+
+
+    def _check(self):
+        """
+        Runs the tests for the package, if it has any, and notes the result in
+        the log.
+        """
+
+        if not 'check' in self._xpd._data:
+            return
+
+        # TODO: log this
+        print 'Checking...'
+
+        output = self._output if self._output else sys.stdout
+
+        try:
+            self._run_cmds(self._xpd._data['check'])
+        except BaseException as e:
+            output.write('[check] failed: %s\n' % e)
+            output.flush()
+            raise
+
+        output.write('[check] passed\n')
+        output.flush()
+
+
+    def _install(self):
+        """
+        Installs the package, keeping track of what files it creates.
+        """
+
+        # TODO: log this
+        print 'Installing...'
+
+        if self._staged:
+            return self._staged_install()
+
+        # Get what was there before, when our target was empty we already
+        # know this
+        if self._pre_paths is None:
+            pre_paths = set(util.list_files(self._target_dir))
+        else:
+            pre_paths = self._pre_paths
+
+        self._run_cmds(self._xpd._data['install'])
+
+        post_paths = set(util.list_files(self._target_dir))
+
+        new_paths = post_paths - pre_paths
+
+        return new_paths
+
+
+    def _staged_install(self):
+        """
+        Installs the package with DESTDIR pointing to an empty staging
+        directory, then moves the results into the target directory.  This
+        way the work done only depends on the size of the package.
+        """
+
+        # Create the stage inside the target so the final moves are renames
+        stage_dir = tempfile.mkdtemp(prefix='.xpkg-stage-',
+                                     dir=self._target_dir)
+
+        try:
+            self._destdir = stage_dir
+
+            self._run_cmds(self._xpd._data['install'])
+
+            # The files will be under the full target path inside the stage
+            rel_target = os.path.relpath(self._target_dir, os.sep)
+            staged_root = os.path.join(stage_dir, rel_target)
+
+            if not os.path.exists(staged_root):
+                msg = 'Package %s did not install into DESTDIR, remove ' \
+                      '"install-destdir: true" from its XPD'
+                raise Exception(msg % self._xpd.name)
+
+            new_paths = self._merge_stage(staged_root)
+        finally:
+            self._destdir = ''
+
+            shutil.rmtree(stage_dir)
+
+        return new_paths
+
+
+    def _merge_stage(self, staged_root):
+        """
+        Move everything in the staging directory into the target directory,
+        returning the files and any directories which didn't already exist.
+        """
+
+        new_paths = set()
+
+        def conflict(rel_path, what):
+            msg = 'Package %s installs %s over an existing %s'
+            return Exception(msg % (self._xpd.name, rel_path, what))
+
+        for root, dirs, files in os.walk(staged_root):
+            rel_root = os.path.relpath(root, staged_root)
+
+            if rel_root == os.curdir:
+                rel_root = ''
+
+            # Directories are merged with what's already there
+            for d in list(dirs):
+                rel_path = os.path.join(rel_root, d)
+                src_path = os.path.join(root, d)
+                dst_path = os.path.join(self._target_dir, rel_path)
+
+                if os.path.islink(src_path):
+                    # Walk doesn't follow links, so move them like files
+                    files.append(d)
+                    dirs.remove(d)
+                elif os.path.islink(dst_path):
+                    # Merging through the link would put files outside the
+                    # path we record them under
+                    raise conflict(rel_path, 'symlink')
+                elif not os.path.lexists(dst_path):
+                    os.mkdir(dst_path)
+                    shutil.copymode(src_path, dst_path)
+
+                    new_paths.add(rel_path)
+                elif not os.path.isdir(dst_path):
+                    raise conflict(rel_path, 'file')
+
+            # Files (and symlinks) replace files and symlinks, but never a
+            # directory and what's in it
+            for f in files:
+                rel_path = os.path.join(rel_root, f)
+                dst_path = os.path.join(self._target_dir, rel_path)
+
+                if os.path.lexists(dst_path):
+                    if os.path.isdir(dst_path) and \
+                       not os.path.islink(dst_path):
+                        raise conflict(rel_path, 'directory')
+
+                    os.remove(dst_path)
+
+                os.rename(os.path.join(root, f), dst_path)
+
+                new_paths.add(rel_path)
+
+        return new_paths
+
+
+    def _run_cmds(self, raw):
         """
         Runs either a single or list of commands, subbing in all variables as
         needed for each command.
@@ -486,29 +1776,91 @@ class PackageBuilder(object):
         else:
             cmds = [raw]
 
-        # Run each command in turn
+        # Make sure we have env_root when needed
         for raw_cmd in cmds:
-            # Make sure we have env_root when needed
             if raw_cmd.count('%(env_root)s') and len(self._env_dir) == 0:
                 raise Exception('Package references environment root, '
                                 'must be built in an environment')
 
-            # Sub in our variables into the commands
-            cmd = raw_cmd % {
-                'jobs' : str(util.cpu_count()),
-                'prefix' : self._target_dir,
-                'arch' : platform.machine(),
-                'env_root' : self._env_dir,
-            }
+        # Sub in our variables into the commands
+        subs = {
+            'jobs' : str(util.cpu_count()),
+            'prefix' : self._target_dir,
+            'arch' : platform.machine(),
+            'env_root' : self._env_dir,
+            'destdir' : self._destdir,
+        }
+
+        cmds = [raw_cmd % subs for raw_cmd in cmds]
+
+        # Let make based installs know where we are staging files
+        env = self._env
+
+        if self._destdir:
+            env = dict(env)
+            env['DESTDIR'] = self._destdir
+
+        # Run each command in turn, either in one shell for the whole phase
+        # or a new shell for each command
+        if self._xpd._data.get('shell-session', False):
+            session = ShellSession(self._output, env=env,
+                                   cwd=self._build_dir)
+            self._track(session)
+            watchdog = self._watchdog(session)
 
-            # Run our command
-            self._shellcmd(cmd, self._output)
+            try:
+                with watchdog:
+                    for cmd in cmds:
+                        session.run(cmd)
+            except BaseException:
+                # Don't leave anything running behind us
+                session.kill()
 
+                if watchdog.reason:
+                    self._timed_out(cmd, watchdog.reason)
 
-    def _shellcmd(self, cmd, output=None):
+                raise
+            finally:
+                session.close()
+                self._running = None
+
+                self._usage = add_usage(self._usage, session.usage)
+        else:
+            for cmd in cmds:
+                self._shellcmd(cmd, self._output, env)
+
+
+    def _log_cache_stats(self, stats):
+        """
+        Writes the compiler cache hits and misses for this build to the log.
+        """
+
+        # Nothing compiled, or a ccache too old to keep a stats log
+        if stats is None:
+            return
+
+        hits = stats['hits']
+        misses = stats['misses']
+        total = hits + misses
+
+        if total > 0:
+            rate = 100.0 * hits / total
+        else:
+            rate = 0.0
+
+        args = (hits, misses, rate)
+        msg = '[ccache] hits: %d misses: %d (%.1f%% hit rate)\n' % args
+
+        output = self._output if self._output else sys.stdout
+        output.write(msg)
+        output.flush()
+
+
+    def _shellcmd(self, cmd, output=None, env=None):
         """
-        Runs the given shell command, either output to stderr/stdout or
-        the given file object.
+        Runs the given shell command in the build directory, either output to
+        stderr/stdout or the given file object.  The env dict is the commands
+        environment, by default our own.
 
         It will throw a CallProcessError if the process fails.
         """
@@ -530,7 +1882,60 @@ class PackageBuilder(object):
         stderr.flush()
 
         # Now lets get writing
-        subprocess.check_call(cmd, stderr=stderr, stdout=stdout, shell=True)
+        proc = subprocess.Popen(cmd, stderr=stderr, stdout=stdout, shell=True,
+                                env=env, cwd=self._build_dir, close_fds=True,
+                                preexec_fn=start_new_group)
+        self._track(proc)
+
+        watchdog = self._watchdog(proc)
+
+        try:
+            with watchdog:
+                returncode, usage = wait_with_usage(proc)
+        except BaseException:
+            # Our process group doesn't get interrupts from the terminal, so
+            # make sure nothing is left running
+            kill_group(proc)
+            raise
+        finally:
+            self._running = None
+
+        self._usage = add_usage(self._usage, usage)
+
+        if watchdog.reason and returncode != 0:
+            self._timed_out(cmd, watchdog.reason)
+
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+
+    def _watchdog(self, proc):
+        """
+        Returns a Watchdog which enforces the current phase's limits on the
+        given process.
+        """
+
+        return Watchdog(proc, self._output, deadline=self._deadline,
+                        stall_timeout=self._stall_timeout)
+
+
+    def _timed_out(self, cmd, reason):
+        """
+        Notes the killed command in the log, and throws an error holding the
+        last lines of the log so they show up wherever the failure is reported.
+        """
+
+        output = self._output if self._output else sys.stdout
+        output.write('[timeout] killed "%s": %s\n' % (cmd, reason))
+        output.flush()
+
+        msg = 'Command "%s" killed, %s' % (cmd, reason)
+
+        if self._output:
+            lines = util.tail_lines(self._output.name, self.TAIL_LINES)
+            msg += ', last output:\n' + ''.join(lines)
+
+        raise Exception(msg)
 
 
 
@@ -549,9 +1954,16 @@ class PackageBuilder(object):
             else:
                 new_files.add(path)
 
+        # Make RPATHs inside our prefix relative to the binaries, so fewer
+        # files have to be changed when the package is installed
+        if self._xpd._data.get('relative-rpath', True):
+            self._make_rpaths_relative(new_files)
+
         # Find all instances of our install path in our data
         install_path_offsets = self._find_path_offsets(new_files)
 
+        # The file and directory lists are sorted so the packages come out
+        # the same every build
         if len(self._xpd.packages()) == 1:
             # Single package path
             infos = [{
@@ -559,9 +1971,10 @@ class PackageBuilder(object):
                 'version' : self._xpd.version,
                 'description' : self._xpd.description,
                 'dependencies' : self._xpd.dependencies,
-                'dirs' : list(new_dirs),
-                'files' : list(new_files),
+                'dirs' : sorted(new_dirs),
+                'files' : sorted(new_files),
                 'install_path_offsets' : install_path_offsets,
+                'build_stats' : self._build_stats,
             }]
         else:
             # Find the catch all package if there is one, and make sure there is
@@ -588,9 +2001,9 @@ class PackageBuilder(object):
                 Get the subset of path offsets needed for these files.
                 """
 
-                # Create default empty offset list section
+                # Create default empty offset sections
                 offset_names = ['binary_files', 'sub_binary_files', 'text_files']
-                package_offsets = dict(zip(offset_names, [[]] * 3))
+                package_offsets = dict((n, {}) for n in offset_names)
                 package_offsets['install_dir'] = install_path_offsets['install_dir']
 
                 # Search the offset list and make sure to include any the
@@ -600,7 +2013,7 @@ class PackageBuilder(object):
 
                     for f in files:
                         if f in offset_files:
-                            package_offsets[offset_name].append(f)
+                            package_offsets[offset_name][f] = offset_files[f]
 
                 return package_offsets
 
@@ -660,9 +2073,10 @@ class PackageBuilder(object):
                     'version' : data['version'],
                     'description' : data['description'],
                     'dependencies' : data['dependencies'],
-                    'dirs' : dirs,
-                    'files' : list(used_files),
+                    'dirs' : sorted(set(dirs)),
+                    'files' : sorted(used_files),
                     'install_path_offsets' : package_offsets,
+                    'build_stats' : self._build_stats,
                 }
 
                 infos.append(new_info)
@@ -696,18 +2110,40 @@ class PackageBuilder(object):
                         'version' : data['version'],
                         'description' : data['description'],
                         'dependencies' : data['dependencies'],
-                        'dirs' : dirs + list(unused_dirs),
-                        'files' : list(file_set),
+                        'dirs' : sorted(set(dirs) | unused_dirs),
+                        'files' : sorted(file_set),
                         'install_path_offsets' : package_offsets,
+                        'build_stats' : self._build_stats,
                     }
 
-                    infos.append(new_info)
-            else:
-                # If we don't have a catch all warn we do have files
-                if num_files_left > 0:
-                     print 'WARNING: %d files left un-packaged' % num_files_left
+                    infos.append(new_info)
+            else:
+                # If we don't have a catch all warn we do have files
+                if num_files_left > 0:
+                     print 'WARNING: %d files left un-packaged' % num_files_left
+
+        return infos
+
+
+    def _make_rpaths_relative(self, paths):
+        """
+        Rewrites the RPATHs of all the ELF files in paths to use $ORIGIN for
+        directories in our target directory.
+        """
+
+        count = 0
+
+        for path in paths:
+            full_path = os.path.join(self._target_dir, path)
 
-        return infos
+            if os.path.isfile(full_path) and not os.path.islink(full_path):
+                if linux.make_rpaths_relative(full_path, self._target_dir):
+                    count += 1
+
+        if count > 0:
+            output = self._output if self._output else sys.stdout
+            output.write('[rpath] made relative in %d files\n' % count)
+            output.flush()
 
 
     def _find_path_offsets(self, paths):
@@ -739,34 +2175,39 @@ class PackageBuilder(object):
         files = [p for p in full_paths
                  if os.path.isfile(p[0]) and not os.path.islink(p[0])]
 
+        # Scan the files, spread over a process pool when there is enough
+        # data to be worth it
+        scan_args = [(full_path, install_dir) for full_path, _ in files]
+        total_size = sum(os.path.getsize(p) for p, _ in files)
+
+        if total_size >= PARALLEL_SCAN_BYTES and len(files) > 1:
+            pool = multiprocessing.Pool(util.cpu_count())
+
+            try:
+                scan_results = pool.map(_scan_file, scan_args)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            scan_results = [_scan_file(args) for args in scan_args]
+
         # State we are finding
         binary_files = {}
         sub_binary_files = {}
         text_files = {}
 
-        for full_path, filepath in files:
-            # Load file into memory
-            contents = open(full_path).read()
-
-            # Find the locations of all strings
-            offsets = [m.start() for m in re.finditer(install_dir, contents)]
-
-            # Count number of zero bytes to determine if we are binary or not
-            # WARNING: this will fail with UTF16 or UTF32 files
-            zeros = contents.count('\0')
+        for (full_path, filepath), (offsets, null_terms) in \
+                zip(files, scan_results):
 
             if len(offsets) > 0:
                 # If we found any record the fact
-                if zeros > 0:
+                if null_terms is not None:
                     binary_offsets = []
                     sub_binary_offsets = []
                     prev_null_term = None
 
                     # Stores each offset as full or a binary substring
-                    for offset in offsets:
-                        # Find the location of the null termination
-                        null_term = contents.find('\0', offset)
-
+                    for offset, null_term in zip(offsets, null_terms):
                         if null_term == offset + len(install_dir):
                             # Record strings that are just null terminated
                             binary_offsets.append(offset)
@@ -805,91 +2246,787 @@ class PackageBuilder(object):
         return results
 
 
+# Files are scanned for the install path in parallel processes once there is
+# at least this much to scan
+PARALLEL_SCAN_BYTES = 32 * 2**20
+
+
+def _scan_file(args):
+    """
+    Finds every instance of the literal path string in the file, returning
+    a tuple of the list of offsets, and for binary files (ones containing
+    zero bytes) the offset of the null terminating each instance, or None
+    for text files.
+
+    The file is memory mapped, so only the pages we search are read, and in
+    ELF files we skip the code, which can't hold the string.  It takes a
+    single tuple of (file path, search path) so it can be used with
+    multiprocessing.Pool.map.
+    """
+
+    full_path, path = args
+
+    if os.path.getsize(full_path) == 0:
+        return [], None
+
+    with open(full_path, 'rb') as f:
+        contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Only look in the parts of ELF files which can hold strings
+        ranges = linux.elf_data_ranges(f)
+
+    if ranges is None:
+        ranges = [(0, len(contents))]
+
+    try:
+        # Find the non-overlapping locations of the string
+        offsets = []
+
+        for start, end in ranges:
+            offset = contents.find(path, start, end)
+
+            while offset != -1:
+                offsets.append(offset)
+                offset = contents.find(path, offset + len(path), end)
+
+        # Any zero byte means we are binary, and need the string ends
+        # WARNING: this will fail with UTF16 or UTF32 files
+        if len(offsets) == 0 or contents.find('\0') == -1:
+            return offsets, None
+
+        null_terms = [contents.find('\0', offset) for offset in offsets]
+
+        return offsets, null_terms
+    finally:
+        contents.close()
+
+
+# Packages are built into a directory padded out to this length, binaries can
+# only be relocated to an environment with a path no longer than the one they
+# were built in
+INSTALL_DIR_LENGTH = 255
+
+# Repeated to pad out the install directory
+INSTALL_DIR_PADDING = '_placeholder'
+
+
+def padded_install_dir(root, name):
+    """
+    Returns a directory in root to build the named package in, padded out to
+    INSTALL_DIR_LENGTH characters if root leaves room.
+    """
+
+    install_dir = os.path.join(root, 'install-' + util.hash_string(name))
+
+    pad_len = INSTALL_DIR_LENGTH - len(install_dir)
+
+    if pad_len > 0:
+        repeats = pad_len // len(INSTALL_DIR_PADDING) + 1
+        install_dir += (INSTALL_DIR_PADDING * repeats)[:pad_len]
+
+    return install_dir
+
+
+# The XPA member holding the packed install path offsets, and the string that
+# starts it
+PATH_OFFSETS_MEMBER = 'offsets.bin'
+PATH_OFFSETS_MAGIC = 'XPO1'
+
+# The types of offsets, in the order they are packed
+PATH_OFFSET_TYPES = ['text_files', 'binary_files', 'sub_binary_files']
+
+
+def pack_path_offsets(offsets):
+    """
+    Packs the binary_files, sub_binary_files and text_files offsets from the
+    results of PackageBuilder._find_path_offsets into a compact string.  It
+    holds the magic string, then the length of the '\0' separated file names
+    and the names themselves, followed by integers packed by
+    util.pack_varints:
+
+      for each type of offset:
+        number of files
+        for each file:
+          number of offset lists (always 1 for non sub_binary_files)
+          for each list:
+            number of offsets
+            each offset minus the one before it, within the file
+
+    Storing the differences keeps the numbers, and so the string, small.
+    """
+
+    names = []
+    values = []
+
+    for offset_type in PATH_OFFSET_TYPES:
+        files = offsets[offset_type]
+        values.append(len(files))
+
+        for file_path in sorted(files):
+            # Paths can come back from JSON as unicode
+            if isinstance(file_path, unicode):
+                names.append(file_path.encode('utf-8'))
+            else:
+                names.append(file_path)
+
+            if offset_type == 'sub_binary_files':
+                offset_lists = files[file_path]
+            else:
+                offset_lists = [files[file_path]]
+
+            values.append(len(offset_lists))
+            prev = 0
+
+            for offset_list in offset_lists:
+                values.append(len(offset_list))
+
+                for offset in offset_list:
+                    values.append(offset - prev)
+                    prev = offset
+
+    names_data = '\0'.join(names)
+
+    return PATH_OFFSETS_MAGIC + util.pack_varints([len(names_data)]) + \
+        names_data + util.pack_varints(values)
+
+
+def unpack_path_offsets(data, install_dir):
+    """
+    Turns the string from pack_path_offsets back into the offsets dict, with
+    the given install_dir.
+    """
+
+    if not data.startswith(PATH_OFFSETS_MAGIC):
+        raise Exception('Unknown install path offsets format')
+
+    (names_len,), pos = util.unpack_varints(data, len(PATH_OFFSETS_MAGIC), 1)
+
+    names = iter(data[pos:pos + names_len].split('\0'))
+    values = iter(util.unpack_varints(data, pos + names_len)[0])
+
+    offsets = {'install_dir' : install_dir}
+
+    for offset_type in PATH_OFFSET_TYPES:
+        files = {}
+
+        for i in xrange(next(values)):
+            file_path = next(names)
+            offset_lists = []
+            prev = 0
+
+            for j in xrange(next(values)):
+                offset_list = []
+
+                for k in xrange(next(values)):
+                    prev += next(values)
+                    offset_list.append(prev)
+
+                offset_lists.append(offset_list)
+
+            if offset_type == 'sub_binary_files':
+                files[file_path] = offset_lists
+            else:
+                files[file_path] = offset_lists[0]
+
+        offsets[offset_type] = files
+
+    return offsets
+
+
+class XPAWriter(object):
+    """
+    Writes a package archive (an uncompressed tar) in a single pass, straight
+    to a temporary file next to its destination.  Members can be streamed in
+    without knowing their size up front.  Once done, commit moves it into
+    place atomically, so nobody sees part of a package.  Example:
+
+        writer = XPAWriter('/repo/hello_1.0.0_x86_64_elf_linux.xpa')
+
+        try:
+            with writer.open_member('files.tar.gz') as stream:
+                stream.write(data)
+
+            writer.add_data('xpkg.yml', manifest)
+        except:
+            writer.abort()
+            raise
+
+        writer.commit()
+
+    The members are given the mtime if set, otherwise the current time.
+    """
+
+    def __init__(self, dest_path, mtime=None):
+        self.dest_path = dest_path
+        self._mtime = mtime
+
+        # A unique temp file, so several builds can write the same package
+        # into one directory at once
+        dest_dir, file_name = os.path.split(dest_path)
+        fd, self._temp_path = tempfile.mkstemp(dir=dest_dir,
+                                               prefix='.' + file_name)
+        os.fchmod(fd, 0644)
+
+        self._file = os.fdopen(fd, 'wb')
+
+
+    def add_data(self, name, data):
+        """
+        Adds a member with the given string contents.
+        """
+
+        self._file.write(self._header(name, len(data)))
+        self._file.write(data)
+        self._pad()
+
+
+    def open_member(self, name):
+        """
+        Returns a file like object to write the contents of a new member to,
+        which must be closed before anything else is written.
+        """
+
+        return _XPAMemberStream(self, name)
+
+
+    def commit(self):
+        """
+        Ends the archive and moves it into place, returning its path.
+        """
+
+        # The end of archive marker is two empty blocks, and the archive is
+        # padded out to a full record
+        self._file.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+
+        remainder = self._file.tell() % tarfile.RECORDSIZE
+
+        if remainder > 0:
+            self._file.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+
+        self._file.close()
+
+        os.rename(self._temp_path, self.dest_path)
+
+        return self.dest_path
+
+
+    def abort(self):
+        """
+        Throws away the partly written archive.
+        """
+
+        self._file.close()
+
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+
+    def _header(self, name, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0644
+
+        if self._mtime is None:
+            info.mtime = int(time.time())
+        else:
+            info.mtime = self._mtime
+
+        return info.tobuf(tarfile.GNU_FORMAT)
+
+
+    def _pad(self):
+        remainder = self._file.tell() % tarfile.BLOCKSIZE
+
+        if remainder > 0:
+            self._file.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+
+class _XPAMemberStream(object):
+    """
+    Writes the data of a member straight to the archive, then fills in its
+    size in the header when closed.
+    """
+
+    def __init__(self, writer, name):
+        self._writer = writer
+        self._name = name
+        self._file = writer._file
+
+        # Leave room for the header, we fill it in once we know the size
+        self._header_offset = self._file.tell()
+        self._file.write(writer._header(name, 0))
+
+        self._size = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def write(self, data):
+        self._file.write(data)
+        self._size += len(data)
+
+
+    def flush(self):
+        pass
+
+
+    def close(self):
+        if self._file is None:
+            return
+
+        # GNU format headers are always one block, even for huge sizes, so
+        # we can write it over the placeholder
+        end_offset = self._file.tell()
+
+        self._file.seek(self._header_offset)
+        self._file.write(self._writer._header(self._name, self._size))
+        self._file.seek(end_offset)
+
+        self._writer._pad()
+        self._file = None
+
+
+# Environment variable with the time (seconds since the epoch) to record in
+# reproducible packages, see https://reproducible-builds.org/
+SOURCE_DATE_EPOCH_VAR = 'SOURCE_DATE_EPOCH'
+
+# Environment variable selecting the package format, and the format used when
+# it's not set
+XPA_FORMAT_VAR = 'XPKG_XPA_FORMAT'
+DEFAULT_XPA_FORMAT = archive.VERSION
+
+
 class BinaryPackageBuilder(object):
     """
     Turns XPD files into binary packages. They are built and installed into a
     temporary directory.
 
-    The binary package format starts with an uncompressed tar file containing:
+    Packages are written in the indexed archive format (see the archive
+    module), with the files each compressed on their own, and two strings in
+    the metadata block:
          xpkg.yml - Contains the package information
+         offsets.bin - The packed install path offsets (see pack_path_offsets)
+
+    The original format, still written when xpa_format is 1, is an
+    uncompressed tar file containing those two and:
          files.tar.gz - Archive of files rooted in the env
+
+    The files archive is compressed with the codec named by 'payload' in the
+    manifest (see the compression module), and named to match, for example
+    files.tar.zst.  Older packages have no 'payload' and are always gzip.
+
+    The format defaults to the XPKG_XPA_FORMAT environment variable, then 2.
+
+    In the indexed format files that are already compressed (.gz, .png, .jar
+    and such) are stored as they are.  The XPD can pick the codec for files
+    itself with regular expressions, like the package 'files', which take
+    precedence:
+
+      file-compression:
+        store: ['share/data/.*\.pak']
+        lz4: ['share/doc/.*']
+
+    The compression codec and level default to the XPKG_COMPRESSION and
+    XPKG_COMPRESSION_LEVEL environment variables, then gzip.
+
+    Reproducible builds, on by default when SOURCE_DATE_EPOCH is set, give
+    byte identical packages for the same inputs.  Every build is done in the
+    same directory (one at a time), no times from the build are recorded,
+    and file times are clamped to SOURCE_DATE_EPOCH (or 0).
     """
 
-    def __init__(self,  package_xpd):
+    def __init__(self,  package_xpd, codec=None, level=None,
+                 reproducible=None, xpa_format=None):
         self._xpd = package_xpd
         self._work_dir = None
         self._target_dir = None
 
+        if xpa_format is None:
+            xpa_format = int(os.environ.get(XPA_FORMAT_VAR,
+                                            DEFAULT_XPA_FORMAT))
+
+        if not xpa_format in (1, archive.VERSION):
+            raise Exception('Unknown package format: %d' % xpa_format)
+
+        self._xpa_format = xpa_format
+
+        if reproducible is None:
+            reproducible = SOURCE_DATE_EPOCH_VAR in os.environ
+
+        # The latest time recorded in the package, None if not reproducible
+        if reproducible:
+            self._mtime = int(os.environ.get(SOURCE_DATE_EPOCH_VAR, 0))
+        else:
+            self._mtime = None
+
+        default_codec, default_level = compression.default_settings()
 
-    def build(self, storage_dir, environment=None, output_to_file=True):
+        if codec is None:
+            codec = default_codec
+
+        if level is None:
+            level = default_level
+
+        self._codec = compression.lookup(codec)
+        self._level = level
+
+        # Compile the patterns of the per file codecs
+        self._file_codecs = []
+
+        for name, patterns in sorted(
+                package_xpd._data.get('file-compression', {}).iteritems()):
+            file_codec = compression.lookup(name)
+
+            for pattern in patterns:
+                self._file_codecs.append((re.compile(pattern), file_codec))
+
+
+    def package_settings(self):
+        """
+        Returns a dict of the settings which change the package we write, the
+        format, compression and reproducible timestamp.
+        """
+
+        return {
+            'xpa-format' : self._xpa_format,
+            'codec' : self._codec.name,
+            'level' : self._level,
+            'mtime' : self._mtime,
+        }
+
+
+    def build(self, storage_dir, environment=None, output_to_file=True,
+              resume=False):
         """
         Run the standard PackageBuilder then pack up the results in a package.
+
+          resume - keep the build directory if the build fails, and continue
+                   from the last completed phase if it's already there
         """
 
-        # Create our temporary directory
         name = self._xpd.name
-        self._work_dir = tempfile.mkdtemp(suffix = '-xpkg-install-' + name)
+        lock_file = None
+        build_dir = None
+
+        # Create our temporary directory, or use our persistent one
+        if resume:
+            input_hash = self._input_hash(environment)
+
+            # Only one build at a time can use the directory
+            resume_dir = self._resume_dir(environment, input_hash)
+            lock_file = self._lock_dir(resume_dir)
+
+            try:
+                checkpoint = BuildCheckpoint(resume_dir, input_hash)
+            except BaseException:
+                lock_file.close()
+                raise
+
+            self._work_dir = checkpoint.root
+        elif self._mtime is not None:
+            # Paths end up in the built files, so always use the same ones
+            checkpoint = None
+            self._work_dir, lock_file = self._lock_reproducible_dir(environment)
+            build_dir = os.path.join(self._work_dir, 'work')
+        else:
+            checkpoint = None
+            self._work_dir = tempfile.mkdtemp(suffix = '-xpkg-install-' + name)
 
-        # TODO: make this a hash of something meaning, full
-        pad_hash = util.hash_string(name)
-        install_dir = os.path.join(self._work_dir, 'install-' + pad_hash)
+        # Install into a long padded path, so the package can be relocated
+        # to any reasonable environment path
+        install_dir = padded_install_dir(self._work_dir, name)
+
+        # Throw away any partial install, it will be re-done
+        if checkpoint and not checkpoint.done('install'):
+            if os.path.exists(install_dir):
+                shutil.rmtree(install_dir)
 
         # TODO: LOG THIS
         print 'Binary working in:',self._work_dir
 
+        success = False
+
         try:
             # Build the package(s)
             builder = PackageBuilder(self._xpd)
-            infos = builder.build(install_dir, environment, output_to_file)
-
-            # Build packages and get their paths
-            dest_paths = [self._create_package(install_dir, storage_dir, info)
-                          for info in infos]
+            infos = builder.build(install_dir, environment, output_to_file,
+                                  checkpoint=checkpoint, defer_check=True,
+                                  work_dir=build_dir)
+
+            # Write the packages while the tests run, the tests only use
+            # the build directory while we only read the install directory
+            builder.start_check()
+
+            writers = []
+
+            try:
+                # Don't wait on a possibly long check when we have already
+                # failed
+                try:
+                    for info in infos:
+                        writers.append(self._create_package(install_dir,
+                                                            storage_dir, info))
+                except BaseException:
+                    builder.cancel_check()
+                    raise
+
+                builder.finish_check()
+
+                # The check passed so now we can add the manifests, which
+                # have the check stats, and publish the packages
+                for writer, info in zip(writers, infos):
+                    self._finish_package(writer, info)
+
+                dest_paths = [writer.commit() for writer in writers]
+            except BaseException:
+                for writer in writers:
+                    writer.abort()
+                raise
+
+            success = True
 
         finally:
-            # Make sure we cleanup after we are done
-            # Don't do this right now
-            shutil.rmtree(self._work_dir)
+            # Make sure we cleanup after we are done, unless we want to resume
+            # the failed build
+            if success or not resume:
+                shutil.rmtree(self._work_dir)
+            else:
+                # TODO: LOG THIS
+                print 'Build directory kept for --resume:',self._work_dir
+
+            # Let the next build of the same package have the directory
+            if lock_file:
+                lock_file.close()
 
         return dest_paths
 
+
+    def _input_hash(self, environment):
+        """
+        Hash of everything that goes into our build, the same inputs shared
+        builds are keyed on, so a kept build directory is only reused when
+        nothing has changed.
+        """
+
+        if environment:
+            return build_input_hash(self._xpd, environment.toolset,
+                                    environment._dep_versions(self._xpd),
+                                    self.package_settings())
+
+        return build_input_hash(self._xpd,
+                                package_settings=self.package_settings())
+
+
+    def _resume_dir(self, environment, input_hash):
+        """
+        The persistent directory we build in when we might resume the build.
+        Outside an environment it's in a temporary directory of our own user,
+        named after the build inputs as well.
+        """
+
+        name = '%s-%s' % (self._xpd.name, self._xpd.version)
+
+        if environment:
+            return os.path.join(environment.build_dir(environment.root), name)
+
+        return os.path.join(self._user_temp_dir(),
+                            '%s-%s' % (name, input_hash))
+
+
+    @staticmethod
+    def _user_temp_dir():
+        """
+        Returns our user's private directory for builds in the system
+        temporary directory, creating it if needed.  The path is predictable,
+        so an existing one must be a real directory owned by us that nobody
+        else can get into.
+        """
+
+        root = os.path.join(tempfile.gettempdir(),
+                            'xpkg-build-%d' % os.getuid())
+
+        try:
+            os.mkdir(root, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        info = os.lstat(root)
+
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or \
+           info.st_mode & 0077:
+            msg = 'Unsafe build directory, not a private directory: %s'
+            raise Exception(msg % root)
+
+        return root
+
+
+    def _lock_dir(self, path):
+        """
+        Locks the given directory for our build, waiting for any other build
+        using it to finish first.  It returns the open lock file, closing it
+        releases the lock.
+        """
+
+        util.ensure_dir(os.path.dirname(path))
+
+        lock_file = open(path + '.lock', 'a')
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                lock_file.close()
+                raise
+
+            # TODO: LOG THIS
+            print 'Waiting for another build in:', path
+
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        return lock_file
+
+
+    def _lock_reproducible_dir(self, environment):
+        """
+        Creates the fixed directory we do reproducible builds in, named after
+        the build inputs, and returns it along with the open lock file which
+        keeps other builds out of it until closed.
+        """
+
+        input_hash = self._input_hash(environment)
+
+        work_dir = os.path.join(self._user_temp_dir(), 'reproducible-%s-%s' %
+                                (self._xpd.name, input_hash))
+
+        lock_file = self._lock_dir(work_dir)
+
+        # Throw away anything left by a build that was killed
+        if os.path.exists(work_dir):
+            shutil.rmtree(work_dir)
+
+        os.mkdir(work_dir)
+
+        return work_dir, lock_file
+
+
     def _create_package(self, install_dir, storage_dir, info):
         """
-        Creates a package from the given package info.
+        Starts the package for the given package info in the storage
+        directory, with the files compressed straight into it.  It's returned
+        as an archive.ArchiveWriter, or an XPAWriter for the original format,
+        for _finish_package.
+        """
+
+        codec = self._codec
+        package_path = os.path.join(storage_dir, self._get_package_name(info))
+
+        if self._xpa_format == archive.VERSION:
+            writer = archive.ArchiveWriter(package_path, codec, self._level,
+                                           max_mtime=self._mtime)
+
+            try:
+                for entry_name in sorted(info['files']):
+                    full_path = os.path.join(install_dir, entry_name)
+                    codec, level = self._file_codec(entry_name)
+
+                    writer.add_file(full_path, entry_name, codec, level)
+
+                writer.flush()
+            except BaseException:
+                writer.abort()
+                raise
+
+            return writer
+
+        files_member = 'files.tar' + codec.suffix
+
+        writer = XPAWriter(package_path, mtime=self._mtime)
+
+        try:
+            # Compress straight into the package over all our cores
+            with writer.open_member(files_member) as stream:
+                with compression.ParallelCompressor(stream, codec,
+                                                    self._level) as compressed:
+                    with tarfile.open(fileobj=compressed, mode='w|') as tar:
+                        for entry_name in sorted(info['files']):
+                            full_path = os.path.join(install_dir, entry_name)
+                            tar.add(full_path, arcname=entry_name,
+                                    filter=self._normalise_member)
+        except BaseException:
+            writer.abort()
+            raise
+
+        return writer
+
+
+    def _file_codec(self, entry_name):
+        """
+        Returns the codec, and level, the XPD picks for the file, or None for
+        both if it leaves it to the package codec.
+        """
+
+        for regex, codec in self._file_codecs:
+            if regex.match(entry_name):
+                if codec is self._codec:
+                    return codec, self._level
+
+                return codec, None
+
+        return None, None
 
-        The path to that archive is returned.
+
+    def _normalise_member(self, tarinfo):
+        """
+        Drops who built the file, and for reproducible builds when.
         """
 
-        # Tar up the files
-        file_tar = os.path.join(self._work_dir, 'files.tar.gz')
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ''
+
+        if self._mtime is not None:
+            tarinfo.mtime = min(tarinfo.mtime, self._mtime)
+
+        return tarinfo
 
-        with tarfile.open(file_tar, "w:gz") as tar:
-            for entry_name in info['files']:
-                full_path = os.path.join(install_dir, entry_name)
-                tar.add(full_path, arcname=entry_name)
 
-        # Create our metadata file
-        meta_file = os.path.join(self._work_dir, 'xpkg.yml')
-        with open(meta_file, 'w') as f:
-            util.yaml_dump(info, f)
+    def _finish_package(self, writer, info):
+        """
+        Adds the manifest and install path offsets to the package started
+        with _create_package.
+        """
 
-        # Create our package
-        package_name = self._get_package_name(info)
-        package_tar = os.path.join(self._work_dir, package_name)
+        # The install path offsets can be huge, so they are packed into their
+        # own member which is only read on install, the manifest just notes
+        # where they are
+        offsets = info['install_path_offsets']
 
-        with tarfile.open(package_tar, "w") as tar:
-            tar.add(meta_file, arcname=os.path.basename(meta_file))
-            tar.add(file_tar, arcname=os.path.basename(file_tar))
+        info = dict(info)
+        info['install_path_offsets'] = {
+            'install_dir' : offsets['install_dir'],
+            'member' : PATH_OFFSETS_MEMBER,
+        }
 
-        # Move to the desired location
-        dest_path = os.path.join(storage_dir, package_name)
+        # Note how the files are compressed
+        info['payload'] = {
+            'codec' : self._codec.name,
+        }
 
-        if os.path.exists(dest_path):
-            os.remove(dest_path)
+        if self._xpa_format == 1:
+            info['payload']['member'] = 'files.tar' + self._codec.suffix
 
-        shutil.move(package_tar, storage_dir)
+        # How long the build took changes every time
+        if self._mtime is not None:
+            del info['build_stats']
 
-        return dest_path
+        writer.add_data('xpkg.yml', util.yaml_dump(info))
+        writer.add_data(PATH_OFFSETS_MEMBER, pack_path_offsets(offsets))
 
 
     def _get_package_name(self, info):
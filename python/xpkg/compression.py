@@ -0,0 +1,374 @@
+# Author: Joseph Lisee <jlisee@gmail.com>
+
+__doc__ = """
+Compression codecs for package payloads.  Data is compressed in independent
+blocks spread over a pool of threads, with each block a complete stream of the
+codec (a gzip member, a zstd frame, ...) so the results can simply be put one
+after another.  Readers decompress all the streams in turn.
+
+gzip, bz2 and store (no compression at all) are always available, xz, lz4 and
+zstd only when their Python modules are installed.
+"""
+
+# Python Imports
+import bz2
+import collections
+import os
+import zlib
+
+from multiprocessing.pool import ThreadPool
+
+# Library Imports
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Project Imports
+from xpkg import util
+
+
+# Environment variables which select the codec and level packages are
+# compressed with
+CODEC_VAR = 'XPKG_COMPRESSION'
+LEVEL_VAR = 'XPKG_COMPRESSION_LEVEL'
+
+# The codec used when none is chosen
+DEFAULT_CODEC = 'gzip'
+
+# Size of the uncompressed blocks compressed by each thread
+BLOCK_SIZE = 2**20
+
+# Size of the compressed reads when decompressing
+READ_SIZE = 2**16
+
+# How files in already compressed formats start, there is no point compressing
+# them again
+COMPRESSED_MAGIC = [
+    '\x1f\x8b',             # gzip
+    '\xfd7zXZ\x00',         # xz
+    '\x28\xb5\x2f\xfd',     # zstd
+    '\x04\x22\x4d\x18',     # lz4
+    'PK\x03\x04',           # zip, jar, whl, ...
+    '\x89PNG\r\n\x1a\n',    # png
+    '\xff\xd8\xff',         # jpeg
+] + ['BZh%d' % level for level in xrange(1, 10)]  # bz2
+
+
+class Codec(object):
+    """
+    A compression format, with functions to compress a block of data into
+    one complete stream, and start a decompressor for one stream.  The
+    decompressor must have decompress() and unused_data like
+    zlib.decompressobj.
+    """
+
+    def __init__(self, name, suffix, default_level, compress,
+                 decompressor=None, reader=None):
+        self.name = name
+        self.suffix = suffix
+        self.default_level = default_level
+
+        self._compress = compress
+        self._decompressor = decompressor
+        self._reader = reader
+
+
+    def compress(self, data, level=None):
+        """
+        Compresses the string into a complete stream.
+        """
+
+        if level is None:
+            level = self.default_level
+
+        return self._compress(data, level)
+
+
+    def open(self, fileobj):
+        """
+        Returns a file like object which reads the decompressed contents of
+        all the streams in the given file object.
+        """
+
+        if self._reader:
+            return self._reader(fileobj)
+
+        return StreamsReader(fileobj, self._decompressor)
+
+
+def _store_compress(data, level):
+    return data
+
+
+def _store_reader(fileobj):
+    return fileobj
+
+
+def _gzip_compress(data, level):
+    # A window of 16 + 15 bits gives us gzip headers (with a zero mtime)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    return compressor.compress(data) + compressor.flush()
+
+
+def _gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def _xz_compress(data, level):
+    return lzma.compress(data, preset=level)
+
+
+def _lz4_compress(data, level):
+    return lz4.frame.compress(data, compression_level=level)
+
+
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_reader(fileobj):
+    decompressor = zstandard.ZstdDecompressor()
+
+    return decompressor.stream_reader(fileobj, read_across_frames=True)
+
+
+# All the codecs we have support for here, by name
+CODECS = {
+    'gzip' : Codec('gzip', '.gz', 6, _gzip_compress,
+                   decompressor=_gzip_decompressor),
+    'bz2' : Codec('bz2', '.bz2', 9, bz2.compress,
+                  decompressor=bz2.BZ2Decompressor),
+    'store' : Codec('store', '', 0, _store_compress, reader=_store_reader),
+}
+
+if lzma:
+    CODECS['xz'] = Codec('xz', '.xz', 6, _xz_compress,
+                         decompressor=lzma.LZMADecompressor)
+
+if lz4:
+    CODECS['lz4'] = Codec('lz4', '.lz4', 0, _lz4_compress,
+                          decompressor=lz4.frame.LZ4FrameDecompressor)
+
+if zstandard:
+    CODECS['zstd'] = Codec('zstd', '.zst', 3, _zstd_compress,
+                           reader=_zstd_reader)
+
+
+def lookup(name):
+    """
+    Returns the codec with the given name, throwing an error if we don't
+    support it here.
+    """
+
+    if not name in CODECS:
+        args = (name, ', '.join(sorted(CODECS)))
+        raise Exception('Compression "%s" not available, have: %s' % args)
+
+    return CODECS[name]
+
+
+def is_compressed(data):
+    """
+    Returns true if the data, the start of a file, looks like it's already
+    compressed.
+    """
+
+    return any(data.startswith(magic) for magic in COMPRESSED_MAGIC)
+
+
+def default_settings():
+    """
+    Returns the codec name and level (None for the codec's default) from the
+    XPKG_COMPRESSION and XPKG_COMPRESSION_LEVEL environment variables.
+    """
+
+    name = os.environ.get(CODEC_VAR, DEFAULT_CODEC)
+    level = os.environ.get(LEVEL_VAR, None)
+
+    return name, int(level) if level else None
+
+
+class ParallelCompressor(object):
+    """
+    A write only file object which compresses what is written to it in
+    blocks, spread over a pool of threads, and writes the results to the
+    given file object in order.  Example:
+
+        with ParallelCompressor(out_file, compression.lookup('gzip')) as f:
+            f.write(data)
+
+    At most a couple of blocks per thread are held in memory.
+    """
+
+    def __init__(self, fileobj, codec, level=None, threads=None,
+                 block_size=BLOCK_SIZE):
+        self._fileobj = fileobj
+        self._codec = codec
+        self._level = level
+        self._block_size = block_size
+
+        if threads is None:
+            threads = util.cpu_count()
+
+        self._pool = ThreadPool(threads) if threads > 1 else None
+        self._max_pending = threads * 2
+
+        self._buffer = []
+        self._buffered = 0
+        self._blocks = 0
+        self._pending = collections.deque()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._shutdown()
+
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+
+        while self._buffered >= self._block_size:
+            self._submit(self._block_size)
+
+
+    def flush(self):
+        pass
+
+
+    def close(self):
+        """
+        Compresses the rest of the data, and waits until it's all written.
+        """
+
+        if self._buffered > 0 or self._blocks == 0:
+            self._submit(self._buffered)
+
+        try:
+            while len(self._pending):
+                self._fileobj.write(self._pending.popleft().get())
+        finally:
+            self._shutdown()
+
+
+    def _submit(self, size):
+        """
+        Starts compressing the first size bytes of the buffer.
+        """
+
+        data = ''.join(self._buffer)
+
+        block = data[:size]
+        rest = data[size:]
+
+        self._buffer = [rest] if len(rest) else []
+        self._buffered = len(rest)
+        self._blocks += 1
+
+        if self._pool is None:
+            self._fileobj.write(self._codec.compress(block, self._level))
+            return
+
+        result = self._pool.apply_async(self._codec.compress,
+                                        (block, self._level))
+        self._pending.append(result)
+
+        # Write out finished blocks once enough are queued up
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().get())
+
+
+    def _shutdown(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+class StreamsReader(object):
+    """
+    A read only file object which decompresses a series of streams, one after
+    another, from the given file object.  New decompressors are made with
+    the new_decompressor function, and one is done when it has unused data
+    (or says it is at the end with 'eof').
+    """
+
+    def __init__(self, fileobj, new_decompressor):
+        self._fileobj = fileobj
+        self._new_decompressor = new_decompressor
+        self._decompressor = None
+
+        self._buffer = ''
+        self._pos = 0
+        self._done = False
+
+
+    def read(self, size=-1):
+        # Decompress until we have enough data, or run out
+        while not self._done and (size < 0 or
+                                  len(self._buffer) - self._pos < size):
+            data = self._fileobj.read(READ_SIZE)
+
+            if len(data) == 0:
+                self._done = True
+            else:
+                self._decompress(data)
+
+        if size < 0:
+            size = len(self._buffer) - self._pos
+
+        result = self._buffer[self._pos:self._pos + size]
+        self._pos += len(result)
+
+        return result
+
+
+    def close(self):
+        pass
+
+
+    def _decompress(self, data):
+        # Throw away what has been read already
+        chunks = [self._buffer[self._pos:]]
+        self._pos = 0
+
+        while len(data):
+            if self._decompressor is None or \
+               getattr(self._decompressor, 'eof', False):
+                self._decompressor = self._new_decompressor()
+
+            try:
+                chunks.append(self._decompressor.decompress(data))
+            except EOFError:
+                # The last stream ended right at the end of the last data
+                self._decompressor = None
+                continue
+
+            # Anything past the end of the stream starts the next one
+            data = self._decompressor.unused_data or ''
+
+            if len(data):
+                self._decompressor = None
+
+        self._buffer = ''.join(chunks)
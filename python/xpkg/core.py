@@ -1,14 +1,20 @@
 # Author: Joseph Lisee <jlisee@gmail.com>
 
 # Python Imports
+import fcntl
 import json
 import os
+import shutil
 import tarfile
+import tempfile
+import time
 
 from collections import defaultdict
 
 # Project Imports
+from xpkg import archive
 from xpkg import build
+from xpkg import compression
 from xpkg import linux
 from xpkg import util
 from xpkg import paths
@@ -17,6 +23,7 @@ xpkg_root_var = 'XPKG_ROOT'
 xpkg_tree_var = 'XPKG_TREE'
 xpkg_repo_var = 'XPKG_REPO'
 xpkg_local_cache_var = 'XPKG_LOCAL_CACHE'
+xpkg_shared_builds_var = 'XPKG_SHARED_BUILDS'
 
 
 def parse_dependency(value):
@@ -210,6 +217,84 @@ class InstallDatabase(object):
         return os.path.join(root, 'var', 'xpkg')
 
 
+class BuildTimes(object):
+    """
+    Records how long package builds took in an environment, so that we can
+    estimate future ones.  The on disk format is:
+
+        {
+          'gcc' : {
+            '4.8.1' : {
+              'GNU' : 2437.2
+            }
+          }
+        }
+
+    Where the keys are the package name, version and toolset name, and the
+    value is the wall time in seconds.
+    """
+
+    def __init__(self, env_dir):
+        self._path = os.path.join(InstallDatabase.db_dir(env_dir),
+                                  'build-times.yml')
+
+        self._times = self._load()
+
+
+    def lookup(self, name, version, toolset_name):
+        """
+        Returns the last build time in seconds, or None if we have never
+        built the package.
+        """
+
+        versions = self._times.get(name, {})
+
+        return versions.get(version, {}).get(toolset_name, None)
+
+
+    def record(self, name, version, toolset_name, seconds):
+        """
+        Stores the build time, and saves it to disk.
+        """
+
+        util.ensure_dir(os.path.dirname(self._path))
+
+        # Other installs can record times at once, so we re-read the file
+        # while holding the lock to keep what they wrote
+        with open(self._path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            self._times = self._load()
+
+            versions = self._times.setdefault(name, {})
+            versions.setdefault(version, {})[toolset_name] = seconds
+
+            # Replace the file all at once, for readers without the lock
+            temp_path = self._path + '.tmp'
+
+            with open(temp_path, 'w') as f:
+                util.yaml_dump(self._times, f)
+
+            os.rename(temp_path, self._path)
+
+
+    def _load(self):
+        """
+        Reads the times from disk.
+        """
+
+        if os.path.exists(self._path):
+            times = util.yaml_load(open(self._path))
+        else:
+            times = None
+
+        # Handle the empty file case
+        if times is None:
+            times = {}
+
+        return times
+
+
 class Settings(object):
     """
     Settings for the current environment.
@@ -233,9 +318,11 @@ class Settings(object):
         if settings_data is None:
             toolset_dict = None
             self.name = 'none'
+            self.autoconf_cache = False
         else:
             toolset_dict = settings_data.get('toolset', None)
             self.name = settings_data.get('name', 'unknown')
+            self.autoconf_cache = settings_data.get('autoconf-cache', False)
 
         # Create toolset if possible otherwise get the default
         if toolset_dict is None:
@@ -252,10 +339,19 @@ class Environment(object):
 
     SETTINGS_PATH = os.path.join('var', 'xpkg', 'env.yml')
 
+    # Seconds we guess a build will take when we have never built it
+    DEFAULT_BUILD_ESTIMATE = 60
+
     @staticmethod
-    def init(env_dir, name, toolset_name=None):
+    def init(env_dir, name, toolset_name=None, compiler_cache=False,
+             autoconf_cache=False, profile=None, toolset=None):
         """
         Initialize the environment in the given directory.
+
+          compiler_cache - wrap the toolset compilers with ccache
+          autoconf_cache - share configure results between package builds
+          profile - name of the toolset performance profile to build with
+          toolset - Toolset object to use instead of looking up toolset_name
         """
 
         # Bail out with an error if the environment already exists
@@ -269,12 +365,24 @@ class Environment(object):
         linux.update_ld_so_symlink(env_dir)
 
         # Lookup our toolset and translate to dict
-        toolset = build.Toolset.lookup_by_name(toolset_name)
+        if toolset is None:
+            toolset = build.Toolset.lookup_by_name(toolset_name)
+
+        toolset_dict = toolset.to_dict()
+        toolset_dict['compiler-cache'] = compiler_cache or \
+                                         toolset.compiler_cache
+
+        if profile:
+            if not profile in build.PerformanceProfiles:
+                raise Exception("Can't find performance profile '%s'" % profile)
+
+            toolset_dict['profile'] = profile
 
         # Create our settings dict and write it disk
         settings = {
             'name' : name,
-            'toolset' : toolset.to_dict(),
+            'toolset' : toolset_dict,
+            'autoconf-cache' : autoconf_cache,
         }
 
         # For path to our settings files, and save it
@@ -285,13 +393,18 @@ class Environment(object):
 
 
     def __init__(self, env_dir=None, create=False, tree_path=None,
-                 repo_path=None, verbose=False):
+                 repo_path=None, verbose=False, build_spool=None,
+                 build_executor=None):
         """
           env_dir - path to the environment dir
           create - create the environment if it does exist
           tree_path - URL for a XPD tree
           repo_path - URL for a XPA package archive
           verbose - print all build commands to screen
+          build_spool - a farm.BuildSpool, when given packages are built by
+                        submitting jobs to it and waiting for the results
+          build_executor - an executor.ExecutorClient, when given packages are
+                           built by sending them to it
         """
 
         if env_dir is None:
@@ -305,6 +418,8 @@ class Environment(object):
         self.root = self._env_dir
 
         self.verbose = verbose
+        self.build_spool = build_spool
+        self.build_executor = build_executor
 
         # Error out if we are not creating and environment and this one does
         # not exist
@@ -323,6 +438,7 @@ class Environment(object):
 
         self.name = settings.name
         self.toolset = settings.toolset
+        self.autoconf_cache = settings.autoconf_cache
 
         def get_paths(base_path, env_var):
             """
@@ -370,63 +486,353 @@ class Environment(object):
         else:
             self._repo = EmptyPackageSource()
 
+        # Packages which failed to install, and why, along with the packages
+        # we skipped because of them (used when installs keep going)
+        self.failed_packages = {}
+        self.blocked_packages = {}
+
         # Make sure the package cache is created
         self._xpa_cache_dir = self.xpa_cache_dir(self._env_dir)
 
         util.ensure_dir(self._xpa_cache_dir)
 
 
-    def install(self, input_val):
+    def install(self, input_val, keep_going=False):
         """
         Installs the desired input this can be any of the following:
           path/to/description/package.xpd
           path/to/binary/package.xpa
           package
           package==version
+
+          keep_going - when a package fails, keep installing everything that
+                       doesn't depend on it.  The failures are recorded in
+                       failed_packages and blocked_packages.
         """
 
         # Check to make sure the install is allowed
         self._install_check(input_val)
 
-        # Install our input
-        if input_val.endswith('.xpa'):
+        # Work out everything that needs installing and the order to do it in
+        plan = self._plan_install(input_val)
+
+        # The farm can build everything whose dependencies are ready at once
+        if self.build_spool:
+            self._install_with_farm(plan, input_val, keep_going)
+            return
+
+        # Install everything, the dependencies will be done before the
+        # packages which need them
+        for idx, step in enumerate(plan):
+            if self._skip_step(step, input_val):
+                continue
+
+            if len(plan) > 1:
+                args = (idx + 1, len(plan), step['name'],
+                        self._format_eta(plan[idx:]))
+                print 'STEP [%d/%d]: %s (ETA: %s)' % args
+
+            try:
+                self._install_one(step['input'])
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except BaseException as e:
+                if not keep_going:
+                    raise
+
+                self.failed_packages[step['name']] = str(e)
+
+                print 'FAILED: %s: %s' % (step['name'], e)
+
+
+    def _install_with_farm(self, plan, input_val, keep_going):
+        """
+        Installs the plan (see install) with the build farm doing the builds.
+        Every package whose dependencies are installed is submitted at once,
+        so the farm's workers can all be busy, and each is installed as soon
+        as its job finishes.
+        """
+
+        waiting = list(plan)
+
+        # Job ids to the steps they build, and XPD paths to their job
+        jobs = {}
+        xpd_jobs = {}
+
+        while waiting or jobs:
+            # Start everything which doesn't need a package we don't have
+            for step in list(waiting):
+                building = [s['name'] for steps in jobs.itervalues()
+                            for s in steps]
+                unfinished = set([s['name'] for s in waiting] + building)
+
+                if any(d in unfinished for d in step['deps']):
+                    continue
+
+                waiting.remove(step)
+
+                if self._skip_step(step, input_val):
+                    continue
+
+                if len(plan) > 1:
+                    args = (plan.index(step) + 1, len(plan), step['name'],
+                            self._format_eta(waiting))
+                    print 'STEP [%d/%d]: %s (ETA: %s)' % args
+
+                try:
+                    package = self._resolve_input(step['input'])
+
+                    if isinstance(package, XPD):
+                        # Packages from one XPD are built by the same job
+                        xpd_path = os.path.abspath(package.path)
+
+                        if not xpd_path in xpd_jobs:
+                            print 'BUILDING(XPD): %s-%s' % (package.name,
+                                                            package.version)
+
+                            job_id = self._submit_job(package)
+                            xpd_jobs[xpd_path] = job_id
+                            jobs[job_id] = []
+
+                        jobs[xpd_jobs[xpd_path]].append(step)
+                    else:
+                        self._install_one(step['input'])
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except BaseException as e:
+                    if not keep_going:
+                        raise
+
+                    self.failed_packages[step['name']] = str(e)
+
+                    print 'FAILED: %s: %s' % (step['name'], e)
+
+            if len(jobs) == 0:
+                break
+
+            # Install the results of the next job to finish
+            job_id = self.build_spool.wait_any(jobs.keys())
+            steps = jobs.pop(job_id)
+
+            try:
+                job = self.build_spool.wait(job_id)
+
+                self._install_built(self._job_paths(job))
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except BaseException as e:
+                if not keep_going:
+                    raise
+
+                for step in steps:
+                    self.failed_packages[step['name']] = str(e)
+
+                    print 'FAILED: %s: %s' % (step['name'], e)
+
+
+    def _skip_step(self, step, input_val):
+        """
+        Returns True when the install step shouldn't be run, because an
+        earlier step installed it, it already failed, or a package it needs
+        failed (then it's recorded as blocked).
+        """
+
+        # Skip packages installed by an earlier step (XPDs with multiple
+        # packages install them all at once)
+        if step['input'] != input_val:
+            depname, version = self._parse_install_input(step['input'])
+
+            if self._pdb.installed(depname):
+                return True
+
+        # Don't retry packages that already failed for an earlier input
+        if step['name'] in self.failed_packages or \
+           step['name'] in self.blocked_packages:
+            return True
+
+        # Skip anything that depends on a failed package
+        bad_deps = [d for d in step['deps'] if d in self.failed_packages
+                    or d in self.blocked_packages]
+
+        if len(bad_deps) > 0:
+            self.blocked_packages[step['name']] = bad_deps
+
+            args = (step['name'], ', '.join(bad_deps))
+            print 'BLOCKED: %s (needs: %s)' % args
+            return True
+
+        return False
+
+
+    def _install_one(self, input_val):
+        """
+        Installs the given input, see install for the types of input.
+        """
+
+        package = self._resolve_input(input_val)
+
+        if package is None:
+            msg = "Cannot find description for package: %s" % input_val
+            raise Exception(msg)
+
+        if isinstance(package, XPA):
             # We have a binary package so install it
-            self._install_xpa(input_val)
+            self._install_xpa(package)
+        else:
+            # Build and install the description
+            self._install_xpd(package)
+
+
+    def _resolve_input(self, input_val):
+        """
+        Find the XPA or XPD for the given install input, preferring the
+        pre-compiled XPA.  None is returned if nothing can be found.
+        """
+
+        if input_val.endswith('.xpa'):
+            return XPA(input_val)
 
         elif input_val.endswith('.xpd'):
-            # Path is an xpd file load that then install
-            xpd = XPD(input_val)
+            return XPD(input_val)
 
-            self._install_xpd(xpd)
-        else:
-            # The input_val is a package name so parse out the desired version
-            # and name
-            name, version = self._parse_install_input(input_val)
+        # The input_val is a package name so parse out the desired version
+        # and name
+        name, version = self._parse_install_input(input_val)
+
+        # First try and find the xpa (pre-compiled) version of the package
+        xpa = self._repo.lookup(name, version)
+
+        if xpa:
+            return xpa
+
+        # No binary package try, so lets try and find a description in the
+        # package tree
+        return self._tree.lookup(name, version)
 
-            # First try and find the xpa (pre-compiled) version of the package
-            xpa = self._repo.lookup(name, version)
 
-            if xpa:
-                # Install the XPA
-                self._install_xpa(xpa)
+    def _plan_install(self, input_val):
+        """
+        Finds all the packages that need to be installed for the given input,
+        returning them in the order to install them.  Each entry is a dict:
+
+          {
+            'input' : 'libgreet==1.0.0',
+            'name' : 'libgreet',
+            'version' : '1.0.0',
+            'build' : True,
+            'estimate' : 42.5,
+            'deps' : ['faketools'],
+          }
 
+        When we have a choice, the package with the longest (by estimated
+        time) chain of packages waiting on it goes first.  The estimate is
+        None when we have never built the package.
+        """
+
+        build_times = BuildTimes(self._env_dir)
+
+        steps = {}
+        graph = {}
+
+        def visit(input_val):
+            # Find the package, we leave errors to the install itself
+            package = self._resolve_input(input_val)
+
+            if package is None:
+                return None
+
+            if package.name in steps:
+                return package.name
+
+            # Packages we build need their build dependencies too
+            need_build = isinstance(package, XPD)
+
+            deps = package.dependencies
+
+            if need_build:
+                deps = deps + self._resolve_build_deps(
+                    package.build_dependencies)
+
+            if need_build:
+                estimate = build_times.lookup(package.name, package.version,
+                                              self.toolset.name)
             else:
-                # No binary package try, so lets try and find a description in
-                # the package tree
-                xpd_data = self._tree.lookup(name, version)
+                estimate = 0
+
+            steps[package.name] = {
+                'input' : input_val,
+                'name' : package.name,
+                'version' : package.version,
+                'build' : need_build,
+                'estimate' : estimate,
+            }
+            graph[package.name] = steps[package.name]['deps'] = []
+
+            # Visit any dependencies that we still have to install
+            for dep in deps:
+                depname, version = self._parse_install_input(dep)
+
+                if not self._pdb.installed(depname):
+                    dep_name = visit(dep)
+
+                    if dep_name:
+                        graph[package.name].append(dep_name)
 
-                if xpd_data is None:
-                    msg = "Cannot find description for package: %s" % input_val
-                    raise Exception(msg)
+            return package.name
+
+        visit(input_val)
+
+        # Unknown build times get a guess, so they still count as work
+        weights = {}
+
+        for name, step in steps.iteritems():
+            if step['estimate'] is None:
+                weights[name] = self.DEFAULT_BUILD_ESTIMATE
+            else:
+                weights[name] = step['estimate']
 
-                # Install the XPD
-                self._install_xpd(xpd_data)
+        try:
+            order = util.critical_path_sort(graph, weights)
+        except ValueError as e:
+            raise Exception(str(e))
 
+        return [steps[name] for name in order]
 
-    def build_xpd(self, xpd, dest_path, verbose=False):
+
+    def _format_eta(self, steps):
+        """
+        Describe how long the given install steps are expected to take, only
+        counting the ones that will actually build something.
+        """
+
+        # Binary packages, and packages already installed (by an earlier
+        # step), failed or blocked, don't take any time
+        steps = [s for s in steps if s['build']
+                 and not self._pdb.installed(s['name'])
+                 and not s['name'] in self.failed_packages
+                 and not s['name'] in self.blocked_packages]
+
+        known = [s['estimate'] for s in steps if s['estimate'] is not None]
+        unknown = len(steps) - len(known)
+
+        eta = util.format_duration(sum(known))
+
+        if unknown:
+            eta += ' + %d unknown build(s)' % unknown
+
+        return eta
+
+
+    def build_xpd(self, xpd, dest_path, verbose=False, resume=False,
+                  codec=None, level=None, reproducible=None):
         """
         Builds the given package from it's package description (XPD) data.
 
+          resume - continue a previously failed build from its last phase
+          codec, level - how to compress the package, see BinaryPackageBuilder
+          reproducible - give identical packages for identical inputs, see
+                         BinaryPackageBuilder
+
         Returns the path to the package.
         """
 
@@ -436,15 +842,171 @@ class Environment(object):
         # Make sure all dependencies are properly installed
         self._install_deps(xpd, build=True)
 
-        # Build the package and return the path
-        builder = build.BinaryPackageBuilder(xpd)
+        builder = build.BinaryPackageBuilder(xpd, codec=codec, level=level,
+                                             reproducible=reproducible)
+
+        def run_build(storage_dir):
+            # Build the package and return the path
+            start = time.time()
+
+            res = builder.build(storage_dir, environment=self,
+                                output_to_file=not verbose_build,
+                                resume=resume)
+
+            # Record how long it took for future estimates, split across the
+            # packages so a plan with all of them counts the build only once
+            build_times = BuildTimes(self._env_dir)
+
+            packages = xpd.packages()
+            seconds = (time.time() - start) / len(packages)
+
+            for package in packages:
+                build_times.record(package['name'], package['version'],
+                                   self.toolset.name, seconds)
+
+            return res
+
+        # Resumed builds are tied to their own build directory
+        if resume:
+            return run_build(dest_path)
 
-        res = builder.build(dest_path, environment=self,
-                            output_to_file=not verbose_build)
+        # Only build if no other process on the host has built, or is
+        # building, the exact same thing
+        input_hash = build.build_input_hash(xpd, self.toolset,
+                                            self._dep_versions(xpd),
+                                            builder.package_settings())
+
+        shared_builds = build.SharedBuilds(self.shared_build_dir())
+        shared_paths = shared_builds.build(input_hash, run_build)
+
+        # Now copy them where they were requested
+        res = []
+
+        for shared_path in shared_paths:
+            path = os.path.join(dest_path, os.path.basename(shared_path))
+
+            shutil.copy(shared_path, path)
+
+            res.append(path)
 
         return res
 
 
+    def _submit_build(self, xpd):
+        """
+        Has a build farm worker build the package, against the same versions
+        of the dependencies we have, and returns the paths to the packages.
+        """
+
+        job_id = self._submit_job(xpd)
+        job = self.build_spool.wait(job_id)
+
+        return self._job_paths(job)
+
+
+    def _submit_job(self, xpd):
+        """
+        Queues up a build farm job for the package, against the same versions
+        of the dependencies we have, and returns its id.
+        """
+
+        # Make sure we know the dependency versions
+        self._install_deps(xpd, build=True)
+
+        deps = ['%s==%s' % (name, version) for name, version
+                in self._dep_versions(xpd).iteritems() if version]
+
+        job_id = self.build_spool.submit(xpd, self.toolset, deps)
+
+        # TODO: LOG THIS
+        print 'SUBMITTED(JOB): %s' % job_id
+
+        return job_id
+
+
+    def _job_paths(self, job):
+        """
+        The paths to the packages built by the finished farm job.
+        """
+
+        return [os.path.join(job['repo'], p) for p in job['packages']]
+
+
+    def _execute_build(self, xpd):
+        """
+        Has our build executor build the package, sending it the archives of
+        our installed dependencies, and returns the paths to the packages.
+        """
+
+        self._install_deps(xpd, build=True)
+
+        dep_paths = self._dep_xpa_paths(self._dep_versions(xpd))
+
+        return self.build_executor.build(xpd, self.toolset, dep_paths,
+                                         self._xpa_cache_dir,
+                                         log_dir=self.log_dir(self._env_dir))
+
+
+    def _dep_xpa_paths(self, versions):
+        """
+        Returns the paths to the archives (XPAs) of the given installed
+        packages (a dict of name to version), and everything they depend on.
+        """
+
+        sources = CombinePackageSource([FilePackageRepo(self._xpa_cache_dir),
+                                        self._repo])
+
+        paths = {}
+        to_visit = versions.items()
+
+        while len(to_visit):
+            name, version = to_visit.pop()
+
+            if name in paths or version is None:
+                continue
+
+            xpa = sources.lookup(name, version)
+
+            if xpa is None:
+                args = (name, version)
+                msg = 'No package archive found for dependency %s-%s' % args
+                raise Exception(msg)
+
+            paths[name] = xpa._xpa_path
+
+            # Include what it depends on
+            for dep in xpa.dependencies:
+                depname, _ = self._parse_install_input(dep)
+
+                info = self._pdb.get_info(depname)
+
+                if info:
+                    to_visit.append((depname, info['version']))
+
+        return sorted(paths.values())
+
+
+    def _dep_versions(self, xpd):
+        """
+        Returns a dict of the installed version of every package the XPD is
+        built against.
+        """
+
+        deps = xpd.dependencies + \
+               self._resolve_build_deps(xpd.build_dependencies)
+
+        versions = {}
+
+        for dep in deps:
+            depname, _ = self._parse_install_input(dep)
+
+            info = self._pdb.get_info(depname)
+
+            versions[depname] = info['version'] if info else None
+
+        return versions
+
+
     def _install_xpd(self, xpd, build_into_env=False):
         """
         Builds package and directly installs it into the given environment.
@@ -459,13 +1021,14 @@ class Environment(object):
             # Build the package as XPD and place it into our cache
             print 'BUILDING(XPD): %s-%s' % (xpd.name, xpd.version)
 
-            xpa_paths = self.build_xpd(xpd, self._xpa_cache_dir)
-
-            # Now install from the xpa package(s) in our cache
-            for xpa_path in xpa_paths:
-                print 'INSTALLING(XPD from XPA): %s' % xpa_path
+            if self.build_spool:
+                xpa_paths = self._submit_build(xpd)
+            elif self.build_executor:
+                xpa_paths = self._execute_build(xpd)
+            else:
+                xpa_paths = self.build_xpd(xpd, self._xpa_cache_dir)
 
-                self._install_xpa(xpa_path)
+            self._install_built(xpa_paths)
         else:
             # Build the package(s) and install directly into our environment
             builder = build.PackageBuilder(xpd)
@@ -477,6 +1040,17 @@ class Environment(object):
                 self._mark_installed(info['name'], info)
 
 
+    def _install_built(self, xpa_paths):
+        """
+        Installs the packages we just built.
+        """
+
+        for xpa_path in xpa_paths:
+            print 'INSTALLING(XPD from XPA): %s' % xpa_path
+
+            self._install_xpa(xpa_path)
+
+
     def _install_xpa(self, path):
         """
         Install the given binary Xpkg package.
@@ -499,7 +1073,10 @@ class Environment(object):
         # Install the files into the target environment location
         xpa.install(self._env_dir)
 
-        # Mark the package install
+        # Mark the package install, with all of its offsets
+        info = dict(info)
+        info['install_path_offsets'] = xpa.install_path_offsets()
+
         self._mark_installed(info['name'], info)
 
 
@@ -792,35 +1369,128 @@ class Environment(object):
         return self.toolset.get_env_var_info(subs)
 
 
-    def apply_env_variables(self, overwrite=False):
+    def apply_env_variables(self, overwrite=False, env=None, ld_so_root=None):
         """
-        Change the current environment variables so that we can use the things
+        Change the environment variables so that we can use the things
         are in that environment.
 
           overwrite - over write local environment variables, try to limit the
                       effect of other things installed on the system.
+          env - the dict of variables to change, by default our current
+                environment
+          ld_so_root - directory with the ld.so link programs should use, by
+                       default the environment itself
         """
 
+        if ld_so_root is None:
+            ld_so_root = self._env_dir
+
+        if env is None:
+            env = os.environ
+
         env_paths = self.get_env_variables()
 
         # Place the paths into our environment
         for varname, pathinfo in env_paths.iteritems():
             varpath, sep = pathinfo
 
-            cur_var = os.environ.get(varname, None)
+            cur_var = env.get(varname, None)
 
             if cur_var and not overwrite:
-                os.environ[varname] = varpath + sep + cur_var
+                env[varname] = varpath + sep + cur_var
             else:
-                os.environ[varname] = varpath
+                env[varname] = varpath
 
         # Setup the Xpkg path
-        os.environ[xpkg_root_var] = self._env_dir
+        env[xpkg_root_var] = self._env_dir
 
         # Apply toolset environment variables
         # TODO: only use this sub on linux
-        subs = {'LD_SO_PATH' : paths.ld_linux_path(self._env_dir)}
-        self.toolset.apply_env_vars(subs)
+        subs = {'LD_SO_PATH' : paths.ld_linux_path(ld_so_root)}
+        self.toolset.apply_env_vars(subs, env)
+
+
+    def autoconf_config_site(self):
+        """
+        Returns the path to a CONFIG_SITE file which points configure scripts
+        at a cache shared by all builds with the current toolset, and a lock
+        file the build must hold open while it uses the cache.  Returns
+        (None, None) if the cache is turned off.
+
+        The cache is keyed on the toolset and the installed versions of its
+        packages (libc, compiler, etc), and caches for any other key are
+        removed once no build is using them, so changing them starts with a
+        fresh cache.
+        """
+
+        if not self.autoconf_cache:
+            return None, None
+
+        # Build our key from the toolset and the packages that provide it
+        toolset_packages = {}
+
+        for depname in self.toolset.build_deps.itervalues():
+            info = self._pdb.get_info(depname)
+
+            if info:
+                toolset_packages[depname] = info['version']
+
+        key_data = {
+            'toolset' : self.toolset.to_dict(),
+            'packages' : toolset_packages,
+        }
+
+        key = util.hash_string(json.dumps(key_data, sort_keys=True))
+
+        root_dir = self.autoconf_cache_dir(self._env_dir)
+        cache_dir = os.path.join(root_dir, key)
+
+        util.ensure_dir(root_dir)
+
+        # Everything that adds or removes a cache holds this lock, so nobody
+        # can open the lock of a cache while it's being removed
+        with open(root_dir + '.lock', 'w') as root_lock:
+            fcntl.flock(root_lock, fcntl.LOCK_EX)
+
+            # Remove any out of date caches that no build is using
+            for name in os.listdir(root_dir):
+                if name == key or name.endswith('.lock'):
+                    continue
+
+                path = os.path.join(root_dir, name)
+                lock_path = path + '.lock'
+
+                with open(lock_path, 'w') as old_lock:
+                    try:
+                        fcntl.flock(old_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        # Still in use by a build
+                        continue
+
+                    shutil.rmtree(path)
+                    os.remove(lock_path)
+
+            # Hold our cache open for the whole build
+            cache_lock = open(cache_dir + '.lock', 'w')
+            fcntl.flock(cache_lock, fcntl.LOCK_SH)
+
+            # Create our site file which just turns on the cache, in a temp
+            # directory which is moved into place once complete
+            site_path = os.path.join(cache_dir, 'config.site')
+
+            if not os.path.exists(cache_dir):
+                temp_dir = tempfile.mkdtemp(dir=root_dir, prefix='.' + key)
+                cache_path = os.path.join(cache_dir, 'config.cache')
+
+                with open(os.path.join(temp_dir, 'config.site'), 'w') as f:
+                    f.write('# Generated by xpkg, shares configure results\n')
+                    f.write('if test "$cache_file" = /dev/null; then\n')
+                    f.write('  cache_file=%s\n' % cache_path)
+                    f.write('fi\n')
+
+                os.rename(temp_dir, cache_dir)
+
+        return site_path, cache_lock
 
 
     def _parse_install_input(self, value):
@@ -869,6 +1539,35 @@ class Environment(object):
             return os.path.expanduser(os.path.join('~', '.xpkg', 'cache'))
 
 
+    @staticmethod
+    def shared_build_dir():
+        """
+        Directory of packages shared by all environments on the host, to
+        avoid building the same thing twice.
+        """
+
+        if xpkg_shared_builds_var in os.environ:
+            return os.environ[xpkg_shared_builds_var]
+        else:
+            return os.path.join(Environment.local_cache_dir(), 'builds')
+
+
+    @staticmethod
+    def autoconf_cache_dir(root):
+        """
+        The directory we keep the shared configure cache in.
+        """
+        return os.path.join(root, 'var', 'xpkg', 'autoconf')
+
+
+    @staticmethod
+    def build_dir(root):
+        """
+        The directory we keep resumable builds in.
+        """
+        return os.path.join(root, 'var', 'xpkg', 'build')
+
+
     @staticmethod
     def log_dir(root):
         """
@@ -892,6 +1591,20 @@ class XPA(object):
           'files' : [
             'bin/hello'
           ],
+          'install_path_offsets' : {
+            'install_dir' : '/tmp/install-list',
+            'member' : 'offsets.bin',
+          }
+        }
+
+    Packages are usually in the indexed archive format (see the archive
+    module), older ones are tar files (see build.BinaryPackageBuilder), both
+    are read here.
+
+    The offsets themselves are packed into the 'member' of the archive, and
+    only read when needed by install_path_offsets.  Older packages have the
+    full offsets in the manifest, as returned by install_path_offsets:
+
           'install_path_offsets' : {
             'install_dir' : '/tmp/install-list',
             'binary_files' : {
@@ -904,7 +1617,6 @@ class XPA(object):
                'share/hello/msg.txt' : [5, 100]
             }
           }
-        }
     """
 
     def __init__(self, xpa_path, input_name=None, info=None):
@@ -920,6 +1632,7 @@ class XPA(object):
 
         # Only save the XPA path so we don't keep the tarfile itself open
         self._xpa_path = xpa_path
+        self._offsets = None
 
         # If not given the manifest info, read it out of the XPA
         if info is None:
@@ -943,23 +1656,99 @@ class XPA(object):
         """
 
         # Extract all the files
+        if archive.is_archive(self._xpa_path):
+            archive.ArchiveReader(self._xpa_path).extract_all(path)
+
+            self._fix_install_paths(path)
+            return
+
         with tarfile.open(self._xpa_path) as tar:
 
-            file_tar = tar.extractfile('files.tar.gz')
+            payload = self.info.get('payload', None)
 
-            with tarfile.open(fileobj = file_tar) as file_tar:
+            if payload is None:
+                # Older packages are always gzip
+                file_tar = tar.extractfile('files.tar.gz')
 
-                file_tar.extractall(path)
+                with tarfile.open(fileobj = file_tar) as file_tar:
+
+                    file_tar.extractall(path)
+            else:
+                codec = compression.lookup(payload['codec'])
+                stream = codec.open(tar.extractfile(payload['member']))
+
+                with tarfile.open(fileobj = stream, mode='r|') as file_tar:
+
+                    file_tar.extractall(path)
 
         # Fix up the install paths
         self._fix_install_paths(path)
 
 
+    def read_file(self, file_path):
+        """
+        Returns the contents of a single file in the package, as built (with
+        the install paths not fixed up).  Only the indexed format can go
+        straight to it, older packages are read up to the file.
+        """
+
+        if archive.is_archive(self._xpa_path):
+            return archive.ArchiveReader(self._xpa_path).read(file_path)
+
+        payload = self.info.get('payload', {'member' : 'files.tar.gz',
+                                            'codec' : 'gzip'})
+
+        with tarfile.open(self._xpa_path) as tar:
+            codec = compression.lookup(payload['codec'])
+            stream = codec.open(tar.extractfile(payload['member']))
+
+            with tarfile.open(fileobj = stream, mode='r|') as file_tar:
+                for member in file_tar:
+                    if member.name == file_path:
+                        if member.issym():
+                            return member.linkname
+
+                        return file_tar.extractfile(member).read()
+
+        args = (file_path, self._xpa_path)
+        raise Exception('No file "%s" in package: %s' % args)
+
+
+    def install_path_offsets(self):
+        """
+        Returns the full install path offsets of the package, reading them
+        out of the archive the first time if they are packed.
+        """
+
+        offsets = self.info['install_path_offsets']
+
+        if not 'member' in offsets:
+            return offsets
+
+        if self._offsets is None:
+            if archive.is_archive(self._xpa_path):
+                reader = archive.ArchiveReader(self._xpa_path)
+                data = reader.metadata(offsets['member'])
+            else:
+                with tarfile.open(self._xpa_path) as tar:
+                    data = tar.extractfile(offsets['member']).read()
+
+            self._offsets = build.unpack_path_offsets(data,
+                                                      offsets['install_dir'])
+
+        return self._offsets
+
+
     def _read_info(self, xpa_path):
         """
         Read the manifest data out of the xpa_path.
         """
 
+        if archive.is_archive(xpa_path):
+            reader = archive.ArchiveReader(xpa_path)
+
+            return util.yaml_load(reader.metadata('xpkg.yml'))
+
         with tarfile.open(xpa_path) as tar:
 
             # Pull out and parse the metadata
@@ -972,7 +1761,7 @@ class XPA(object):
         install path with the new install path.
         """
 
-        offset_info = self.info['install_path_offsets']
+        offset_info = self.install_path_offsets()
         # Make sure the type is a string, incase it because unicode somehow
         # TODO: see if our caching layer is giving us unicode strings
         install_dir = str(offset_info['install_dir'])
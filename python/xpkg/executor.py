@@ -0,0 +1,417 @@
+# Author: Joseph Lisee <jlisee@gmail.com>
+
+__doc__ = """
+Hands builds off to an executor process over a framed protocol on its
+stdin/stdout, so the executor can be a local process, or on a much bigger
+machine at the other end of ssh (or any other transport).
+
+Every frame is two 32-bit big endian lengths, then a JSON header of the
+first length and a body of the second.  A build goes like this:
+
+  client -> executor:
+    {'type' : 'job', 'xpd' : {...}, 'xpd-name' : 'gcc.xpd',
+     'toolset' : {...}, 'sources' : ['md5-...', ...]}
+
+  executor -> client:
+    {'type' : 'need', 'sources' : ['md5-...']}  (the ones it doesn't have)
+
+  client -> executor:
+    {'type' : 'source', 'hash' : 'md5-...'} + file contents, for each needed
+    {'type' : 'dep', 'name' : 'libgmp_5.1.2_....xpa'} + XPA, for each dep
+    {'type' : 'end'}
+
+  executor -> client:
+    {'type' : 'log', 'name' : 'gcc-4.8.1_build.log'} + log contents
+    {'type' : 'package', 'name' : 'gcc_4.8.1_....xpa'} + XPA
+    {'type' : 'done'} or {'type' : 'error', 'message' : '...'}
+
+An executor handles builds until its stdin is closed.
+"""
+
+# Python Imports
+import json
+import os
+import shlex
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import traceback
+
+# Project Imports
+from xpkg import build
+from xpkg import core
+from xpkg import util
+
+
+# Lengths of the header and body which start every frame
+FRAME_LENGTHS = struct.Struct('!II')
+
+# Size of the blocks we copy file bodies with
+BLOCK_SIZE = 2**20
+
+
+def write_frame(stream, header, body='', body_path=None):
+    """
+    Writes a frame with the given header dict, and either the body string or
+    the contents of the file at body_path.
+    """
+
+    header_data = json.dumps(header)
+
+    if body_path:
+        body_len = os.path.getsize(body_path)
+    else:
+        body_len = len(body)
+
+    stream.write(FRAME_LENGTHS.pack(len(header_data), body_len))
+    stream.write(header_data)
+
+    if body_path:
+        with open(body_path, 'rb') as f:
+            shutil.copyfileobj(f, stream, BLOCK_SIZE)
+    else:
+        stream.write(body)
+
+    stream.flush()
+
+
+def read_frame(stream, body_path_func=None):
+    """
+    Reads a frame returning its header dict and body.  If body_path_func is
+    given, it's called with the header and when it returns a path the body
+    is written to that file instead of being returned.
+
+    At the end of the stream (None, None) is returned.
+    """
+
+    lengths = _read_exactly(stream, FRAME_LENGTHS.size, allow_eof=True)
+
+    if lengths is None:
+        return None, None
+
+    header_len, body_len = FRAME_LENGTHS.unpack(lengths)
+
+    header = json.loads(_read_exactly(stream, header_len))
+
+    body_path = body_path_func(header) if body_path_func else None
+
+    if body_path is None:
+        return header, _read_exactly(stream, body_len)
+
+    with open(body_path, 'wb') as f:
+        remaining = body_len
+
+        while remaining > 0:
+            data = _read_exactly(stream, min(remaining, BLOCK_SIZE))
+            f.write(data)
+            remaining -= len(data)
+
+    return header, None
+
+
+def _read_exactly(stream, length, allow_eof=False):
+    """
+    Reads exactly length bytes from the stream.
+    """
+
+    parts = []
+    remaining = length
+
+    while remaining > 0:
+        data = stream.read(remaining)
+
+        if not data:
+            if allow_eof and remaining == length:
+                return None
+
+            raise core.Exception('Build executor connection closed early')
+
+        parts.append(data)
+        remaining -= len(data)
+
+    return ''.join(parts)
+
+
+def _expect(stream, frame_type, body_path_func=None):
+    """
+    Reads a frame making sure it's of the given type.
+    """
+
+    header, body = read_frame(stream, body_path_func)
+
+    if header is None:
+        raise core.Exception('Build executor connection closed early')
+
+    if header['type'] != frame_type:
+        args = (frame_type, header['type'])
+        raise core.Exception('Expected "%s" frame, got "%s"' % args)
+
+    return header, body
+
+
+class ExecutorClient(object):
+    """
+    Runs an executor command, by default a local 'xpkg executor' process, and
+    sends it builds.
+    """
+
+    def __init__(self, command=None):
+        if command is None:
+            self._command = [sys.executable, '-m', 'xpkg.main', 'executor']
+        else:
+            self._command = shlex.split(command)
+
+        self._proc = None
+
+
+    def build(self, xpd, toolset, dep_paths, storage_dir, log_dir=None):
+        """
+        Builds the XPD with the given toolset, against the given dependency
+        XPAs.  The resulting packages are placed in the storage directory,
+        and their paths returned.  The build logs go in log_dir if given.
+        """
+
+        if self._proc is None:
+            self._proc = subprocess.Popen(self._command, stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          close_fds=True)
+
+        # Failing part way through a job leaves the stream between frames,
+        # so that executor can't be used again, the next build starts a new
+        # one
+        try:
+            header, paths = self._run_job(xpd, toolset, dep_paths,
+                                          storage_dir, log_dir)
+        except BaseException:
+            self._discard()
+            raise
+
+        if header['type'] == 'error':
+            raise core.Exception('Remote build of %s failed: %s' %
+                                 (xpd.name, header['message']))
+
+        return paths
+
+
+    def _run_job(self, xpd, toolset, dep_paths, storage_dir, log_dir):
+        """
+        Sends the job to the executor and reads back the results, returning
+        the final 'done' or 'error' header along with the package paths.
+        """
+
+        to_exec = self._proc.stdin
+        from_exec = self._proc.stdout
+
+        # Find out what sources we need to send
+        sources = build.PackageBuilder(xpd)._source_urls()
+
+        write_frame(to_exec, {
+            'type' : 'job',
+            'xpd' : xpd._data,
+            'xpd-name' : os.path.basename(xpd.path),
+            'toolset' : toolset.to_dict(),
+            'sources' : [filehash for filehash, url, info in sources],
+        })
+
+        header, _ = _expect(from_exec, 'need')
+        needed = set(header['sources'])
+
+        # Send the sources, then the dependencies
+        for filehash, url, info in sources:
+            if filehash in needed:
+                write_frame(to_exec, {'type' : 'source', 'hash' : filehash},
+                            body_path=build.fetch_file(filehash, url))
+
+        for dep_path in dep_paths:
+            write_frame(to_exec, {
+                'type' : 'dep',
+                'name' : os.path.basename(dep_path),
+            }, body_path=dep_path)
+
+        write_frame(to_exec, {'type' : 'end'})
+
+        # Now get back the logs and packages
+        def body_path(header):
+            name = os.path.basename(header.get('name', ''))
+
+            if header['type'] == 'package':
+                return os.path.join(storage_dir, name)
+            elif header['type'] == 'log' and log_dir:
+                util.ensure_dir(log_dir)
+                return os.path.join(log_dir, name)
+
+            return None
+
+        paths = []
+
+        while True:
+            header, _ = read_frame(from_exec, body_path)
+
+            if header is None:
+                raise core.Exception('Build executor exited during build')
+
+            if header['type'] == 'package':
+                paths.append(body_path(header))
+            elif header['type'] in ('done', 'error'):
+                return header, paths
+
+
+    def close(self):
+        """
+        Shuts down the executor.
+        """
+
+        if self._proc:
+            # Closing both ends means an executor stuck in the middle of a
+            # job, after a failure on our side, exits instead of hanging
+            self._proc.stdin.close()
+            self._proc.stdout.close()
+            self._proc.wait()
+            self._proc = None
+
+
+    def _discard(self):
+        """
+        Kills the executor, without waiting for the job it's on to finish.
+        """
+
+        if self._proc:
+            try:
+                self._proc.kill()
+            except OSError:
+                pass
+
+            self.close()
+
+
+def serve(input_stream, output_stream, work_dir=None):
+    """
+    Runs builds sent by an ExecutorClient until the input is closed.
+    """
+
+    while True:
+        header, _ = read_frame(input_stream)
+
+        if header is None:
+            return
+
+        if header['type'] != 'job':
+            args = header['type']
+            raise core.Exception('Expected "job" frame, got "%s"' % args)
+
+        _run_job(header, input_stream, output_stream, work_dir)
+
+
+def _run_job(job, input_stream, output_stream, work_dir):
+    """
+    Receives everything needed for the build, runs it, then sends back the
+    logs and packages.
+    """
+
+    job_dir = tempfile.mkdtemp(prefix='xpkg-executor-', dir=work_dir)
+
+    try:
+        # Ask for the sources not in our cache
+        needed = [h for h in job['sources'] if not
+                  build.source_file_valid(h, build.source_cache_path(h))]
+
+        write_frame(output_stream, {'type' : 'need', 'sources' : needed})
+
+        # Receive the sources and dependencies, the sources go to the side
+        # so other builds never see them partly written
+        sources_dir = os.path.join(job_dir, 'sources')
+        deps_dir = os.path.join(job_dir, 'deps')
+        util.ensure_dir(sources_dir)
+        util.ensure_dir(deps_dir)
+
+        def body_path(header):
+            if header['type'] == 'source':
+                return os.path.join(sources_dir,
+                                    os.path.basename(header['hash']))
+            elif header['type'] == 'dep':
+                return os.path.join(deps_dir, os.path.basename(header['name']))
+
+            return None
+
+        while True:
+            header, _ = read_frame(input_stream, body_path)
+
+            if header is None:
+                raise core.Exception('Build client closed connection early')
+            elif header['type'] == 'end':
+                break
+
+        for filehash in os.listdir(sources_dir):
+            shutil.move(os.path.join(sources_dir, filehash),
+                        build.source_cache_path(filehash))
+
+        # Create an environment to build in
+        env_dir = os.path.join(job_dir, 'env')
+
+        try:
+            packages = _build(job, env_dir, deps_dir)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except BaseException as e:
+            traceback.print_exc()
+
+            _send_logs(output_stream, env_dir)
+            write_frame(output_stream, {'type' : 'error', 'message' : str(e)})
+        else:
+            _send_logs(output_stream, env_dir)
+
+            for package_path in packages:
+                write_frame(output_stream, {
+                    'type' : 'package',
+                    'name' : os.path.basename(package_path),
+                }, body_path=package_path)
+
+            write_frame(output_stream, {'type' : 'done'})
+    finally:
+        shutil.rmtree(job_dir)
+
+
+def _build(job, env_dir, deps_dir):
+    """
+    Builds the job in a new environment with the given dependencies, returning
+    the paths to the packages.
+    """
+
+    toolset = build.Toolset.create_from_dict(job['toolset'])
+
+    util.ensure_dir(env_dir)
+    core.Environment.init(env_dir, 'executor', toolset=toolset)
+
+    env = core.Environment(env_dir, repo_path=deps_dir)
+
+    # Install all the dependencies, the ones needed by other dependencies
+    # might already be in
+    for dep_path in util.match_files(deps_dir, '*.xpa'):
+        xpa = core.XPA(dep_path)
+
+        if not env._pdb.installed(xpa.name):
+            env.install('%s==%s' % (xpa.name, xpa.version))
+
+    xpd = core.XPD(os.path.join(env_dir, job['xpd-name']), data=job['xpd'])
+
+    output_dir = os.path.join(env_dir, 'output')
+    util.ensure_dir(output_dir)
+
+    return env.build_xpd(xpd, output_dir)
+
+
+def _send_logs(output_stream, env_dir):
+    """
+    Sends all the build logs in the environment.
+    """
+
+    log_dir = core.Environment.log_dir(env_dir)
+
+    if not os.path.exists(log_dir):
+        return
+
+    for file_name in sorted(os.listdir(log_dir)):
+        write_frame(output_stream, {'type' : 'log', 'name' : file_name},
+                    body_path=os.path.join(log_dir, file_name))
@@ -0,0 +1,493 @@
+# Author: Joseph Lisee <jlisee@gmail.com>
+
+__doc__ = """
+A simple build farm: build jobs are queued in a spool directory, and worker
+processes (possibly on several machines sharing the directory over NFS) claim
+them, build them, and publish the results to a shared package repository.
+"""
+
+# Python Imports
+import datetime
+import errno
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+# Project Imports
+from xpkg import core
+from xpkg import util
+
+
+# Environment variables giving how long, in seconds, a worker's claim on a job
+# lasts without being renewed, and how long to wait for a job to finish
+LEASE_VAR = 'XPKG_FARM_LEASE'
+WAIT_TIMEOUT_VAR = 'XPKG_FARM_TIMEOUT'
+
+
+class BuildSpool(object):
+    """
+    A queue of build jobs stored as files in a directory, with a sub directory
+    for each state a job can be in:
+
+      new/<job>.yml - submitted jobs waiting for a worker
+      claimed/<job>.yml - jobs a worker is building
+      done/<job>.yml - finished jobs, with the packages they built
+      failed/<job>.yml - failed jobs, with the error
+
+    Jobs move between states with rename, which is atomic, so exactly one
+    worker can claim each job.  A claim is a lease: the worker renews it by
+    touching the claimed file while it builds, and jobs whose lease runs out
+    (the worker died) are moved back to new for another worker.  Each job file
+    has the form:
+
+      {
+        'id' : '20140102-150405-123456-libgmp-1a2b3c4d',
+        'xpd-path' : '/path/to/libgmp.xpd',
+        'xpd' : { ... the XPD data ... },
+        'toolset' : { ... the toolset dict ... },
+        'deps' : ['libc==2.17', ...],
+        'worker' : 'buildbox1-1234',
+        'repo' : '/shared/repo',
+        'packages' : ['libgmp_5.1.2_x86_64_64bit_linux.xpa'],
+        'error' : 'Command "make" failed ...',
+      }
+
+    With 'worker' set once claimed, 'repo' and 'packages' once done and
+    'error' if it failed.
+    """
+
+    STATES = ['new', 'claimed', 'done', 'failed']
+
+    # Defaults for the lease and wait timeout, in seconds
+    DEFAULT_LEASE = 300
+    DEFAULT_WAIT_TIMEOUT = 24 * 60 * 60
+
+    def __init__(self, root, lease=None):
+        self.root = root
+
+        if lease is None:
+            lease = os.environ.get(LEASE_VAR, self.DEFAULT_LEASE)
+
+        self.lease = float(lease)
+
+        for state in self.STATES:
+            util.ensure_dir(os.path.join(self.root, state))
+
+
+    def submit(self, xpd, toolset, deps):
+        """
+        Queue up a build of the XPD with the given toolset, against the given
+        list of dependencies ('name==version').  Returns the job id.
+        """
+
+        # Down to the microsecond, so jobs are claimed in the order sent
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        job_id = '%s-%s-%s' % (stamp, xpd.name, uuid.uuid4().hex[:8])
+
+        job = {
+            'id' : job_id,
+            'xpd-path' : os.path.abspath(xpd.path),
+            'xpd' : xpd._data,
+            'toolset' : toolset.to_dict(),
+            'deps' : sorted(deps),
+        }
+
+        # Write it out of sight of the workers, then move it into the queue
+        temp_path = os.path.join(self.root, 'new', '.' + job_id)
+
+        with open(temp_path, 'w') as f:
+            util.yaml_dump(job, f)
+
+        os.rename(temp_path, self._job_path('new', job_id))
+
+        return job_id
+
+
+    def claim(self, worker_name):
+        """
+        Claims the oldest new job, returning its id and data, or (None, None)
+        if there are no jobs.  The claim must be kept alive with renew.
+        """
+
+        # Give the jobs of dead workers to somebody else
+        self.requeue_stale()
+
+        new_dir = os.path.join(self.root, 'new')
+
+        for file_name in sorted(os.listdir(new_dir)):
+            if file_name.startswith('.') or not file_name.endswith('.yml'):
+                continue
+
+            job_id = file_name[:-len('.yml')]
+
+            # Only one worker wins the rename, then start our lease before
+            # anyone takes the job for stale
+            try:
+                os.rename(self._job_path('new', job_id),
+                          self._job_path('claimed', job_id))
+                os.utime(self._job_path('claimed', job_id), None)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+
+            job = self._load('claimed', job_id)
+            job['worker'] = worker_name
+            self._save('claimed', job)
+
+            return job_id, job
+
+        return None, None
+
+
+    def renew(self, job):
+        """
+        Renews our lease on the claimed job, returns False if we lost it.
+        """
+
+        try:
+            os.utime(self._job_path('claimed', job['id']), None)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+
+        return True
+
+
+    def requeue_stale(self):
+        """
+        Moves claimed jobs whose lease has run out back into the queue,
+        returning their ids.
+        """
+
+        claimed_dir = os.path.join(self.root, 'claimed')
+        requeued = []
+
+        for file_name in sorted(os.listdir(claimed_dir)):
+            if file_name.startswith('.') or not file_name.endswith('.yml'):
+                continue
+
+            job_id = file_name[:-len('.yml')]
+            claimed_path = self._job_path('claimed', job_id)
+
+            # Only one process wins the rename, and the job could be finished
+            # at any time
+            try:
+                if time.time() - os.stat(claimed_path).st_mtime < self.lease:
+                    continue
+
+                os.rename(claimed_path, self._job_path('new', job_id))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+
+            requeued.append(job_id)
+
+        return requeued
+
+
+    def finish(self, job, packages=None, error=None):
+        """
+        Marks the claimed job as done with the given package file names, or
+        failed with the given error message.  Nothing happens if another
+        worker has already finished the job successfully.
+        """
+
+        if os.path.exists(self._job_path('done', job['id'])):
+            return
+
+        if error is None:
+            job['packages'] = packages
+            state = 'done'
+        else:
+            job['error'] = error
+            state = 'failed'
+
+        self._save('claimed', job)
+
+        os.rename(self._job_path('claimed', job['id']),
+                  self._job_path(state, job['id']))
+
+        # If our lease ran out the job went back into the queue, it doesn't
+        # need doing again
+        try:
+            os.remove(self._job_path('new', job['id']))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+    def status(self, job_id):
+        """
+        Returns the state the job is in and its data, or (None, None) if the
+        job can't be found.
+        """
+
+        # Look from the end, so we don't miss a job moving forward, and a job
+        # done by one worker counts as done even if another failed it
+        for state in ['done', 'failed', 'claimed', 'new']:
+            try:
+                return state, self._load(state, job_id)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        return None, None
+
+
+    def wait(self, job_id, poll_interval=1.0, timeout=None):
+        """
+        Waits for the job to finish, returning its data.  An exception is
+        thrown if the job failed, or didn't finish within timeout seconds
+        (by default the XPKG_FARM_TIMEOUT environment variable).
+        """
+
+        self.wait_any([job_id], poll_interval=poll_interval, timeout=timeout)
+
+        state, job = self.status(job_id)
+
+        if state == 'failed':
+            args = (job_id, job.get('worker'), job['error'])
+            raise core.Exception('Build job %s failed on %s: %s' % args)
+
+        return job
+
+
+    def wait_any(self, job_ids, poll_interval=1.0, timeout=None):
+        """
+        Waits for any of the jobs to finish, or fail, and returns its id.  An
+        exception is thrown if none finish within timeout seconds, see wait.
+        """
+
+        if timeout is None:
+            timeout = os.environ.get(WAIT_TIMEOUT_VAR,
+                                     self.DEFAULT_WAIT_TIMEOUT)
+
+        deadline = time.time() + float(timeout)
+
+        while True:
+            for job_id in job_ids:
+                state, job = self.status(job_id)
+
+                if state is None:
+                    msg = 'Build job %s does not exist' % job_id
+                    raise core.Exception(msg)
+                elif state in ('done', 'failed'):
+                    return job_id
+
+            if time.time() > deadline:
+                args = ', '.join(job_ids)
+                raise core.Exception('Timed out waiting for build jobs: %s' %
+                                     args)
+
+            time.sleep(poll_interval)
+
+
+    def _job_path(self, state, job_id):
+        return os.path.join(self.root, state, job_id + '.yml')
+
+
+    def _load(self, state, job_id):
+        with open(self._job_path(state, job_id)) as f:
+            return util.yaml_load(f)
+
+
+    def _save(self, state, job):
+        """
+        Re-write the job file, atomically so readers never see it partly
+        written.
+        """
+
+        job_path = self._job_path(state, job['id'])
+        temp_path = os.path.join(self.root, state, '.' + job['id'])
+
+        with open(temp_path, 'w') as f:
+            util.yaml_dump(job, f)
+
+        os.rename(temp_path, job_path)
+
+
+class Worker(object):
+    """
+    Claims jobs from a BuildSpool, builds them in a fresh environment, and
+    publishes the resulting packages to the repo directory along with their
+    build logs (in logs/<job id>).
+    """
+
+    def __init__(self, spool, repo_dir, tree_path=None, work_dir=None,
+                 name=None):
+        self._spool = spool
+        self._repo_dir = os.path.abspath(repo_dir)
+        self._tree_path = tree_path
+        self._work_dir = work_dir
+
+        if name is None:
+            self.name = '%s-%d' % (socket.gethostname(), os.getpid())
+        else:
+            self.name = name
+
+        util.ensure_dir(self._repo_dir)
+
+
+    def run(self, once=False, poll_interval=1.0):
+        """
+        Builds jobs as they show up.  When once is True we return as soon as
+        there are no jobs left, with the number of jobs we ran.
+        """
+
+        count = 0
+
+        while True:
+            job_id, job = self._spool.claim(self.name)
+
+            if job_id is None:
+                if once:
+                    return count
+
+                time.sleep(poll_interval)
+                continue
+
+            # TODO: LOG THIS
+            print 'BUILDING(JOB): %s' % job_id
+
+            lost = threading.Event()
+
+            try:
+                with self._keep_claim(job, lost):
+                    packages = self.build(job, lost)
+            except (KeyboardInterrupt, SystemExit):
+                if not lost.is_set():
+                    error = 'Worker %s stopped' % self.name
+                    self._spool.finish(job, error=error)
+                raise
+            except BaseException as e:
+                if lost.is_set():
+                    # The job is somebody else's now, leave it to them
+                    print 'LOST(JOB): %s' % job_id
+                else:
+                    traceback.print_exc()
+
+                    self._spool.finish(job, error=str(e))
+
+                    print 'FAILED(JOB): %s' % job_id
+            else:
+                job['repo'] = self._repo_dir
+                self._spool.finish(job, packages=packages)
+
+                print 'DONE(JOB): %s' % job_id
+
+            count += 1
+
+
+    @contextmanager
+    def _keep_claim(self, job, lost):
+        """
+        Renews our lease on the job in the background, until the block is
+        done.  If the lease ran out, and the job went to another worker, the
+        lost event is set and we stop renewing.
+        """
+
+        stop = threading.Event()
+
+        def renew():
+            while not stop.is_set():
+                if not self._spool.renew(job):
+                    lost.set()
+                    return
+
+                stop.wait(self._spool.lease / 4)
+
+        thread = threading.Thread(target=renew)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+
+    def build(self, job, lost=None):
+        """
+        Builds the job in a new temporary environment, returning the file
+        names of the packages published to the repo.  Nothing is published
+        once the lost event is set (see _keep_claim).
+        """
+
+        env_dir = tempfile.mkdtemp(prefix='xpkg-worker-', dir=self._work_dir)
+
+        try:
+            # Create an environment matching the one the job came from
+            toolset = core.build.Toolset.create_from_dict(job['toolset'])
+
+            core.Environment.init(env_dir, 'worker', toolset=toolset)
+
+            env = core.Environment(env_dir, tree_path=self._tree_path,
+                                   repo_path=self._repo_dir)
+
+            try:
+                for dep in job['deps']:
+                    env.install(dep)
+
+                # Build the package to the side, then publish it
+                xpd = core.XPD(job['xpd-path'], data=job['xpd'])
+
+                output_dir = os.path.join(env_dir, 'output')
+                util.ensure_dir(output_dir)
+
+                paths = env.build_xpd(xpd, output_dir)
+
+                if lost and lost.is_set():
+                    msg = 'Lost our claim on build job %s' % job['id']
+                    raise core.Exception(msg)
+
+                return [self._publish(p) for p in paths]
+            finally:
+                self._publish_logs(job['id'], env_dir)
+        finally:
+            shutil.rmtree(env_dir)
+
+
+    def _publish(self, path):
+        """
+        Moves the package into the repo, making sure it appears there all at
+        once.
+        """
+
+        # A unique temp file, since a requeued job can be published by two
+        # workers at once
+        file_name = os.path.basename(path)
+        fd, temp_path = tempfile.mkstemp(dir=self._repo_dir,
+                                         prefix='.' + file_name)
+        os.close(fd)
+
+        shutil.copy(path, temp_path)
+        os.rename(temp_path, os.path.join(self._repo_dir, file_name))
+
+        return file_name
+
+
+    def _publish_logs(self, job_id, env_dir):
+        """
+        Copies all the build logs from the environment into the repo.
+        """
+
+        log_dir = core.Environment.log_dir(env_dir)
+
+        if not os.path.exists(log_dir):
+            return
+
+        dest_dir = os.path.join(self._repo_dir, 'logs', job_id)
+        util.ensure_dir(dest_dir)
+
+        for file_name in os.listdir(log_dir):
+            shutil.copy(os.path.join(log_dir, file_name), dest_dir)
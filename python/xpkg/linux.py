@@ -7,10 +7,17 @@ Functionality that is very linux specific goes in this module.
 # Python Imports
 import os
 import re
+import struct
 import sys
 
 # Library Imports
+from elftools.common.exceptions import ELFError
+from elftools.construct.core import ConstructError
+from elftools.elf.constants import SH_FLAGS
+from elftools.elf.dynamic import DynamicSection
 from elftools.elf.elffile import ELFFile
+from elftools.elf.gnuversions import GNUVerDefSection, GNUVerNeedSection
+from elftools.elf.sections import SymbolTableSection
 from elftools.elf.segments import InterpSegment
 
 # Project Imports
@@ -18,6 +25,12 @@ from xpkg import paths
 from xpkg import util
 
 
+# What parsing a corrupt or truncated ELF file can throw, from pyelftools and
+# from seeking or unpacking past the end of the file
+ELF_PARSE_ERRORS = (ELFError, ConstructError, struct.error, ValueError,
+                    OverflowError, IOError, KeyError, IndexError)
+
+
 def readelf_interp(binary_path):
     """
     This reads the program interpreter (INTERP), usually ld-linux.so from the
@@ -37,6 +50,214 @@ def readelf_interp(binary_path):
     return interp
 
 
+def elf_data_ranges(f):
+    """
+    Returns the sorted (start, end) file offsets of the sections of the open
+    ELF file which can hold strings, so it skips code (SHF_EXECINSTR) and
+    sections without any contents in the file (SHT_NOBITS, like .bss).
+    Sections next to each other are merged into one range.
+
+    None is returned when the file is not ELF, has no section headers, or
+    can't be parsed, so callers know to look at the whole file.
+    """
+
+    f.seek(0)
+
+    if f.read(4) != '\x7fELF':
+        return None
+
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+
+    ranges = []
+
+    try:
+        for section in ELFFile(f).iter_sections():
+            if section['sh_type'] in ('SHT_NULL', 'SHT_NOBITS') or \
+               section['sh_flags'] & SH_FLAGS.SHF_EXECINSTR:
+                continue
+
+            start = min(section['sh_offset'], file_size)
+            end = min(start + section['sh_size'], file_size)
+
+            if end > start:
+                ranges.append((start, end))
+    except ELF_PARSE_ERRORS:
+        return None
+
+    if len(ranges) == 0:
+        return None
+
+    # Merge ranges which touch or overlap
+    ranges.sort()
+    merged = [ranges[0]]
+
+    for start, end in ranges[1:]:
+        prev_start, prev_end = merged[-1]
+
+        if start <= prev_end:
+            merged[-1] = (prev_start, max(prev_end, end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def relative_rpath(rpath, prefix, binary_dir):
+    """
+    Returns the RPATH (or RUNPATH) with every directory inside prefix made
+    relative to the binary_dir using $ORIGIN.
+    """
+
+    entries = []
+
+    for entry in rpath.split(':'):
+        if entry == prefix or entry.startswith(prefix + os.sep):
+            rel_path = os.path.relpath(entry, binary_dir)
+
+            if rel_path == os.curdir:
+                entry = '$ORIGIN'
+            else:
+                entry = os.path.join('$ORIGIN', rel_path)
+
+        entries.append(entry)
+
+    return ':'.join(entries)
+
+
+def make_rpaths_relative(binary_path, prefix):
+    """
+    Rewrites the RPATH and RUNPATH of the ELF binary at binary_path so that
+    directories inside prefix are relative to the binary, like:
+
+      /prefix/lib:/usr/local/lib -> $ORIGIN/../lib:/usr/local/lib
+
+    So the binary doesn't need to be changed when prefix moves.  The new
+    string is written over the old one in .dynstr, padded with nulls.  It's
+    left alone if it would be longer, or any other string in the binary
+    shares its bytes.
+
+    Returns True if the binary was changed.
+    """
+
+    with open(binary_path, 'rb') as f:
+        if f.read(4) != '\x7fELF':
+            return False
+
+        f.seek(0)
+
+        try:
+            edits = _rpath_edits(ELFFile(f), prefix,
+                                 os.path.dirname(binary_path))
+        except ELF_PARSE_ERRORS:
+            # Leave anything we can't make sense of alone
+            return False
+
+    if len(edits) == 0:
+        return False
+
+    # Make sure we can write to the file, and leave its mode as it was
+    mode = os.stat(binary_path).st_mode
+    os.chmod(binary_path, mode | 0200)
+
+    try:
+        with open(binary_path, 'r+b') as f:
+            for offset, data in edits:
+                f.seek(offset)
+                f.write(data)
+    finally:
+        os.chmod(binary_path, mode)
+
+    return True
+
+
+def _rpath_edits(elffile, prefix, binary_dir):
+    """
+    Returns the (file offset, data) writes needed to make the RPATH and
+    RUNPATH entries of the binary relative.
+    """
+
+    dynamic = [s for s in elffile.iter_sections()
+               if isinstance(s, DynamicSection)]
+
+    if len(dynamic) != 1:
+        return []
+
+    dynamic = dynamic[0]
+    strtab = elffile.get_section(dynamic['sh_link'])
+
+    # Find the RPATHs we want to change, and the other strings used by the
+    # loader while we are at it
+    string_offsets = set()
+    changes = []
+
+    for tag in dynamic.iter_tags():
+        if tag.entry.d_tag in ('DT_RPATH', 'DT_RUNPATH'):
+            offset = tag.entry.d_val
+            rpath = _read_cstring(elffile.stream, strtab['sh_offset'] + offset)
+            new_rpath = relative_rpath(rpath, prefix, binary_dir)
+
+            if new_rpath != rpath and len(new_rpath) <= len(rpath):
+                changes.append((offset, rpath, new_rpath))
+        elif tag.entry.d_tag in ('DT_NEEDED', 'DT_SONAME', 'DT_AUXILIARY',
+                                 'DT_FILTER', 'DT_CONFIG', 'DT_DEPAUDIT',
+                                 'DT_AUDIT'):
+            string_offsets.add(tag.entry.d_val)
+
+    if len(changes) == 0:
+        return []
+
+    # Gather the rest of the strings in the table
+    for section in elffile.iter_sections():
+        if section['sh_link'] != dynamic['sh_link']:
+            continue
+
+        if isinstance(section, SymbolTableSection):
+            for symbol in section.iter_symbols():
+                string_offsets.add(symbol['st_name'])
+        elif isinstance(section, GNUVerNeedSection):
+            for verneed, auxs in section.iter_versions():
+                string_offsets.add(verneed['vn_file'])
+                string_offsets.update(aux['vna_name'] for aux in auxs)
+        elif isinstance(section, GNUVerDefSection):
+            for verdef, auxs in section.iter_versions():
+                string_offsets.update(aux['vda_name'] for aux in auxs)
+
+    edits = []
+
+    for offset, rpath, new_rpath in changes:
+        # Skip strings which share their tail with another one
+        end = offset + len(rpath)
+
+        if any(offset < o < end for o in string_offsets):
+            continue
+
+        padding = '\0' * (len(rpath) - len(new_rpath) + 1)
+        edits.append((strtab['sh_offset'] + offset, new_rpath + padding))
+
+    return edits
+
+
+def _read_cstring(stream, offset):
+    """
+    Reads the raw null terminated string at the offset in the stream.
+    """
+
+    stream.seek(offset)
+    data = ''
+
+    while True:
+        block = stream.read(256)
+        end = block.find('\0')
+
+        if end != -1:
+            return data + block[:end]
+        elif len(block) == 0:
+            return data
+
+        data += block
+
+
 def update_ld_so_symlink(root, target_dir = None):
     """
     Maintains a symlink from <env_dir>/lib/ld-linux-xpkg.so to the
@@ -11,6 +11,9 @@ import sys
 from xpkg import core
 from xpkg import util
 from xpkg import build
+from xpkg import compression
+from xpkg import executor
+from xpkg import farm
 
 
 def init(args):
@@ -25,7 +28,10 @@ def init(args):
         toolset_name = args.toolset
 
     # Create our environment
-    core.Environment.init(args.root, args.name, toolset_name)
+    core.Environment.init(args.root, args.name, toolset_name,
+                          compiler_cache=args.compiler_cache,
+                          autoconf_cache=args.autoconf_cache,
+                          profile=args.profile)
 
 
 def install(args):
@@ -38,11 +44,48 @@ def install(args):
     else:
         tree_path = None
 
-    env = _create_env(args.root, create=True, tree_path=tree_path,
-                      verbose=args.verbose)
+    # Hand our builds off to the build farm, or an executor if requested
+    if args.farm:
+        build_spool = farm.BuildSpool(os.path.abspath(args.farm))
+    else:
+        build_spool = None
 
-    for name in args.names:
-        env.install(name)
+    if args.executor is not None:
+        build_executor = executor.ExecutorClient(args.executor or None)
+    else:
+        build_executor = None
+
+    # Make sure the executor is shut down even when a build fails
+    try:
+        env = _create_env(args.root, create=True, tree_path=tree_path,
+                          verbose=args.verbose, build_spool=build_spool,
+                          build_executor=build_executor)
+
+        for name in args.names:
+            # Skip packages we know can't be installed
+            pkg_name, version = core.parse_dependency(name)
+
+            if pkg_name in env.failed_packages or \
+               pkg_name in env.blocked_packages:
+                continue
+
+            env.install(name, keep_going=args.keep_going)
+    finally:
+        if build_executor:
+            build_executor.close()
+
+    # Report on everything that didn't work out
+    if len(env.failed_packages) or len(env.blocked_packages):
+        print 'SUMMARY:'
+        print '  failed:'
+        for name, error in sorted(env.failed_packages.iteritems()):
+            print '    - %s: %s' % (name, error)
+        print '  blocked:'
+        for name, deps in sorted(env.blocked_packages.iteritems()):
+            print '    - %s (needs: %s)' % (name, ', '.join(deps))
+
+        num_bad = len(env.failed_packages) + len(env.blocked_packages)
+        raise core.Exception('%d package(s) not installed' % num_bad)
 
 
 def remove(args):
@@ -72,16 +115,59 @@ def build_(args):
         # If we have dependencies build within the enviornemnt
         env = _create_env(args.root)
 
-        res = env.build_xpd(xpd, dest_path, verbose=args.verbose)
+        res = env.build_xpd(xpd, dest_path, verbose=args.verbose,
+                            resume=args.resume, codec=args.compression,
+                            level=args.level, reproducible=args.reproducible)
     else:
         # If there are no dependencies, preform a free standing build
-        builder = core.build.BinaryPackageBuilder(xpd)
+        builder = core.build.BinaryPackageBuilder(
+            xpd, codec=args.compression, level=args.level,
+            reproducible=args.reproducible)
 
-        res = builder.build(dest_path, output_to_file=not args.verbose)
+        res = builder.build(dest_path, output_to_file=not args.verbose,
+                            resume=args.resume)
 
     print 'Package in:', res
 
 
+def worker(args):
+    """
+    Run a build farm worker, building jobs from the spool directory.
+    """
+
+    if args.tree:
+        tree_path = os.path.abspath(args.tree)
+    else:
+        tree_path = None
+
+    spool = farm.BuildSpool(os.path.abspath(args.spool))
+
+    build_worker = farm.Worker(spool, args.repo, tree_path=tree_path,
+                               work_dir=args.work_dir)
+
+    build_worker.run(once=args.once, poll_interval=args.poll)
+
+
+def executor_(args):
+    """
+    Run builds sent over stdin, replying on stdout.
+    """
+
+    # Keep our protocol streams to ourselves, and send anything else
+    # printed by us or the builds to stderr
+    input_stream = os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+    output_stream = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, sys.stdin.fileno())
+    os.close(devnull)
+
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    executor.serve(input_stream, output_stream, work_dir=args.work_dir)
+
+
 def jump(args):
     """
     Jumps into an activated environment.
@@ -172,6 +258,9 @@ def _environment_info(env, verbose):
 
     print '  name:',env.name
     print '  toolset:',env.toolset.name
+
+    if env.toolset.profile:
+        print '  profile:',env.toolset.profile
     print '  root:',env.root
 
     def print_path(name, paths, depth=2):
@@ -267,6 +356,15 @@ def main(argv = None):
     parser_j.add_argument('name', type=str, help='Name for the environment')
     parser_j.add_argument('-t','--toolset', type=str, default=None,
                           help='Name for the environment')
+    parser_j.add_argument('--compiler-cache', action='store_true',
+                          default=False,
+                          help='Use ccache to speed up compiles')
+    parser_j.add_argument('--autoconf-cache', action='store_true',
+                          default=False,
+                          help='Share configure results between builds')
+    parser_j.add_argument('-p','--profile', type=str, default=None,
+                          choices=sorted(build.PerformanceProfiles),
+                          help='Build faster, or build faster programs')
     parser_j.set_defaults(func=init)
 
     parser_j = subparsers.add_parser('jump', help=jump.__doc__)
@@ -282,9 +380,37 @@ def main(argv = None):
                           help='Package description tree')
     parser_i.add_argument('-v','--verbose', action='store_true', default=False,
                           help='Print build output to screen')
+    parser_i.add_argument('-k','--keep-going', action='store_true',
+                          default=False,
+                          help='Install what we can when a package fails')
+    parser_i.add_argument('--farm', type=str, default=None,
+                          help='Build farm spool directory to build with')
+    parser_i.add_argument('--executor', type=str, default=None, nargs='?',
+                          const='',
+                          help='Command for a build executor to build with, '
+                          'by default a local one')
     parser_i.add_argument(*root_args, **root_kwargs)
     parser_i.set_defaults(func=install)
 
+    parser_w = subparsers.add_parser('worker', help=worker.__doc__)
+    parser_w.add_argument('spool', type=str, help='Build farm spool directory')
+    parser_w.add_argument('repo', type=str,
+                          help='Repository to publish packages to')
+    parser_w.add_argument('-t', '--tree', type=str, default=None,
+                          help='Package description tree')
+    parser_w.add_argument('-w', '--work-dir', type=str, default=None,
+                          help='Directory to build in')
+    parser_w.add_argument('--once', action='store_true', default=False,
+                          help='Exit once there are no jobs left')
+    parser_w.add_argument('--poll', type=float, default=1.0,
+                          help='Seconds between checks for new jobs')
+    parser_w.set_defaults(func=worker)
+
+    parser_e = subparsers.add_parser('executor', help=executor_.__doc__)
+    parser_e.add_argument('-w', '--work-dir', type=str, default=None,
+                          help='Directory to build in')
+    parser_e.set_defaults(func=executor_)
+
     parser_i = subparsers.add_parser('build', help=build_.__doc__)
     parser_i.add_argument(*root_args, **root_kwargs)
     parser_i.add_argument('path', type=str, help='YAML install file')
@@ -292,6 +418,16 @@ def main(argv = None):
                           help='Where to place the package')
     parser_i.add_argument('-e','--use-env', action='store_true', default=False,
                           help='Force environment usage')
+    parser_i.add_argument('--resume', action='store_true', default=False,
+                          help='Keep failed builds and continue them')
+    parser_i.add_argument('-c', '--compression', type=str, default=None,
+                          choices=sorted(compression.CODECS),
+                          help='How to compress the package')
+    parser_i.add_argument('-l', '--level', type=int, default=None,
+                          help='Compression level')
+    parser_i.add_argument('--reproducible', action='store_true', default=None,
+                          help='Make identical packages for identical inputs '
+                          '(default when SOURCE_DATE_EPOCH is set)')
     parser_i.add_argument('-v','--verbose', action='store_true', default=False,
                           help='Print build output to screen')
     parser_i.set_defaults(func=build_)
@@ -15,3 +15,24 @@ def ld_linux_path(root):
     """
 
     return os.path.join(root, 'lib', 'ld-linux-xpkg.so')
+
+
+def compiler_cache_dir():
+    """
+    Returns the directory the compiler cache (ccache) stores its objects in.
+    This is shared between all environments of the current user.
+    """
+
+    if 'XPKG_COMPILER_CACHE' in os.environ:
+        return os.environ['XPKG_COMPILER_CACHE']
+    else:
+        return os.path.expanduser(os.path.join('~', '.xpkg', 'ccache'))
+
+
+def source_cache_dir():
+    """
+    Returns the directory downloaded source files are cached in, by hash.  This
+    is shared between all environments of the current user.
+    """
+
+    return os.path.expanduser(os.path.join('~', '.xpkg', 'cache'))
@@ -2,6 +2,7 @@
 
 # Python Imports
 import copy
+import errno
 import fnmatch
 import hashlib
 import multiprocessing
@@ -32,9 +33,10 @@ except ImportError:
     from yaml import SafeDumper as Dumper
 
 
-def shellcmd(cmd, echo=True, stream=True, shell=True):
+def shellcmd(cmd, echo=True, stream=True, shell=True, env=None):
     """
-    Run 'cmd' in the shell and return its standard out.
+    Run 'cmd' in the shell and return its standard out.  The command gets
+    the given env dict as its environment, or our own if it's None.
     """
 
     if echo:
@@ -44,10 +46,11 @@ def shellcmd(cmd, echo=True, stream=True, shell=True):
         out = None
 
         subprocess.check_call(cmd, stderr=sys.stderr, stdout=sys.stdout,
-                              shell=shell)
+                              shell=shell, env=env)
     else:
         try:
-            out = subprocess.check_output(cmd, stderr=sys.stderr, shell=shell)
+            out = subprocess.check_output(cmd, stderr=sys.stderr, shell=shell,
+                                          env=env)
 
         except subprocess.CalledProcessError as c:
             # Capture the process output
@@ -119,6 +122,66 @@ def hash_file(f, hash_type, block_size=2**20):
     return hash_state.hexdigest()
 
 
+def pack_varints(values):
+    """
+    Packs a list of integers into a compact string, as zig-zag encoded
+    variable length integers: values near zero (positive or negative) take
+    one byte, and each 7 bits of magnitude past that another byte.
+    """
+
+    data = bytearray()
+
+    for value in values:
+        # Zig-zag encode so small negative numbers are small too
+        if value >= 0:
+            value = value << 1
+        else:
+            value = (-value << 1) - 1
+
+        # Seven bits a byte, with the high bit set on all but the last
+        while value >= 0x80:
+            data.append((value & 0x7f) | 0x80)
+            value >>= 7
+
+        data.append(value)
+
+    return str(data)
+
+
+def unpack_varints(data, pos=0, count=None):
+    """
+    Unpacks integers packed by pack_varints from the data string, starting at
+    pos, reading count of them or until the end of the data.  Returns the
+    list of integers, and the position just past them.
+    """
+
+    data = bytearray(data)
+    end = len(data)
+    values = []
+
+    while pos < end and (count is None or len(values) < count):
+        value = 0
+        shift = 0
+
+        while True:
+            byte = data[pos]
+            pos += 1
+
+            value |= (byte & 0x7f) << shift
+            shift += 7
+
+            if byte < 0x80:
+                break
+
+        # Undo the zig-zag encoding
+        if value & 1:
+            values.append(-((value + 1) >> 1))
+        else:
+            values.append(value >> 1)
+
+    return values, pos
+
+
 def unpack_tarball(tar_url, extract_path='.'):
     """
     Extracts a tar file to disk, return root directory (and assumes
@@ -240,13 +303,36 @@ def list_files(path):
     return sorted(results)
 
 
+def find_executable(name, env=None):
+    """
+    Search the PATH of the given env dict (by default the current one) for the
+    given program, returning the full path to it or None if it can't be found.
+    """
+
+    if env is None:
+        env = os.environ
+
+    for path_dir in env.get('PATH', '').split(os.pathsep):
+        full_path = os.path.join(path_dir, name)
+
+        if os.path.isfile(full_path) and os.access(full_path, os.X_OK):
+            return full_path
+
+    return None
+
+
 def ensure_dir(path):
     """
-    Make sure a given directory exists
+    Make sure a given directory exists, even if another process is creating
+    it at the same time.
     """
 
     if not os.path.exists(path):
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not os.path.isdir(path):
+                raise
 
 
 def touch(path, times=None):
@@ -296,6 +382,29 @@ def match_files(path, pattern):
                 yield full_path
 
 
+def tail_lines(path, count, block_size=4096):
+    """
+    Returns the last count lines of the file, reading back from the end so
+    large files are cheap.
+    """
+
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = ''
+
+        # Read blocks until we have more newlines than lines requested (the
+        # first line can be partial) or we hit the start
+        while pos > 0 and data.count('\n') <= count:
+            read_size = min(block_size, pos)
+            pos -= read_size
+
+            f.seek(pos)
+            data = f.read(read_size) + data
+
+    return data.splitlines(True)[-count:]
+
+
 class EnvStorage(object):
     """
     Helper class for saving and restoring environment variables.
@@ -726,6 +835,104 @@ def robust_topological_sort(graph):
     return topological_sort(component_graph)
 
 
+def critical_path_sort(graph, weights):
+    """
+    Orders the graph so that every node comes after its successors (the
+    things it depends on), and when there is a choice of which node to do
+    next, picks the one with the longest weighted path of nodes waiting on it.
+    This is the order which gets the whole graph finished soonest when the
+    nodes are worked on in parallel.
+
+    graph should be a dictionary mapping node names to lists of successor
+    nodes, and weights a dictionary mapping node names to their cost.  A
+    ValueError naming the cycle is raised if the graph has one.
+    """
+
+    # Build the reverse graph, nodes to the nodes which depend on them
+    dependents = dict((node, []) for node in graph)
+
+    for node, successors in graph.iteritems():
+        for successor in successors:
+            dependents[successor].append(node)
+
+    # Peel off nodes with nothing left to wait on, whatever is left over is
+    # stuck in, or waiting on, a cycle
+    remaining = dict((node, len(set(graph[node]))) for node in graph)
+    ready = [node for node, count in remaining.iteritems() if count == 0]
+    left = set(graph)
+
+    while ready:
+        node = ready.pop()
+        left.discard(node)
+
+        for dependent in set(dependents[node]):
+            remaining[dependent] -= 1
+
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+
+    if left:
+        # Follow the stuck successors around until we come back to one
+        path = [min(left)]
+
+        while True:
+            node = min(s for s in graph[path[-1]] if s in left)
+
+            if node in path:
+                cycle = path[path.index(node):] + [node]
+                raise ValueError('Dependency cycle: ' + ' -> '.join(cycle))
+
+            path.append(node)
+
+    # The priority of a node is it's weight plus the priority of the most
+    # costly chain of nodes that depend on it
+    priority = {}
+
+    def get_priority(node):
+        if not node in priority:
+            chain = [get_priority(d) for d in dependents[node]]
+            priority[node] = weights.get(node, 0) + max([0] + chain)
+
+        return priority[node]
+
+    # Nodes are ready when everything they depend on is done
+    remaining = dict((node, len(set(graph[node]))) for node in graph)
+    ready = [node for node, count in remaining.iteritems() if count == 0]
+
+    result = []
+
+    while ready:
+        # Grab the ready node with the highest priority, using the name to
+        # break ties
+        ready.sort(key=lambda n: (get_priority(n), n))
+        node = ready.pop(-1)
+        result.append(node)
+
+        for dependent in set(dependents[node]):
+            remaining[dependent] -= 1
+
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+
+    return result
+
+
+def format_duration(seconds):
+    """
+    Format a number of seconds as a short human readable string, like:
+    '42s', '5m03s', or '1h20m'.
+    """
+
+    seconds = int(round(seconds))
+
+    if seconds < 60:
+        return '%ds' % seconds
+    elif seconds < 3600:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    else:
+        return '%dh%02dm' % (seconds // 3600, (seconds % 3600) // 60)
+
+
 def is_64bit():
     """
     Returns true if we are on 64bit platform.